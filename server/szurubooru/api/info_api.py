@@ -1,8 +1,7 @@
 import datetime
-import os
 from szurubooru import config
 from szurubooru.rest import routes
-from szurubooru.func import posts, users, util
+from szurubooru.func import files, posts, users, util
 
 
 _cache_time = None
@@ -15,11 +14,7 @@ def _get_disk_usage():
     now = datetime.datetime.utcnow()
     if _cache_time and _cache_time > now - threshold:
         return _cache_result
-    total_size = 0
-    for dir_path, _, file_names in os.walk(config.config['data_dir']):
-        for file_name in file_names:
-            file_path = os.path.join(dir_path, file_name)
-            total_size += os.path.getsize(file_path)
+    total_size = files.get_disk_usage()
     _cache_time = now
     _cache_result = total_size
     return total_size
@@ -1,10 +1,12 @@
 import datetime
-from szurubooru import search, db
-from szurubooru.rest import routes
+import logging
+from szurubooru import search, db, errors
+from szurubooru.rest import routes, context
 from szurubooru.func import (
     auth, tags, posts, snapshots, favorites, scores, util, versions)
 
 
+logger = logging.getLogger(__name__)
 _search_executor = search.Executor(search.configs.PostSearchConfig())
 
 
@@ -20,7 +22,10 @@ def get_posts(ctx, _params=None):
     auth.verify_privilege(ctx.user, 'posts:list')
     _search_executor.config.user = ctx.user
     return _search_executor.execute_and_serialize(
-        ctx, lambda post: _serialize_post(ctx, post))
+        ctx,
+        lambda post: _serialize_post(ctx, post),
+        estimate_count=ctx.get_param_as_bool(
+            'estimateCount', default=False))
 
 
 @routes.post('/posts/?')
@@ -61,6 +66,166 @@ def create_post(ctx, _params=None):
     return _serialize_post(ctx, post)
 
 
+def _create_import_context(ctx, index, item):
+    if not isinstance(item, dict):
+        raise errors.InvalidParameterError('Expected an object.')
+    files = {}
+    for name in ('content', 'thumbnail'):
+        if ctx.has_file('%s%d' % (name, index)):
+            files[name] = ctx.get_file('%s%d' % (name, index))
+    return context.Context(ctx.method, ctx.url, params=item, files=files)
+
+
+def _serialize_import_error(index, ex):
+    return {
+        'index': index,
+        'status': 'error',
+        'name': type(ex).__name__,
+        'description': str(ex),
+    }
+
+
+def _import_post(ctx, item_ctx, content, tags_by_name, user):
+    tag_names = util.icase_unique(
+        item_ctx.get_param_as_list('tags', required=False, default=[]))
+    safety = item_ctx.get_param_as_string('safety', required=True)
+    source = item_ctx.get_param_as_string(
+        'source', required=False, default=None)
+    if item_ctx.has_param('contentUrl') and not source:
+        source = item_ctx.get_param_as_string('contentUrl')
+    relations = item_ctx.get_param_as_list('relations', required=False) or []
+    notes = item_ctx.get_param_as_list('notes', required=False) or []
+    flags = item_ctx.get_param_as_list('flags', required=False) or []
+
+    post, _ = posts.create_post(content, [], user, check_for_duplicates=False)
+    existing_tags = []
+    missing_names = []
+    for name in tag_names:
+        if name.lower() in tags_by_name:
+            existing_tags.append(tags_by_name[name.lower()])
+        else:
+            missing_names.append(name)
+    new_tags = []
+    if missing_names:
+        found_tags, new_tags = tags.get_or_create_tags_by_names(missing_names)
+        existing_tags.extend(found_tags)
+        if len(new_tags):
+            auth.verify_privilege(ctx.user, 'tags:create')
+    post_tags = []
+    for tag in existing_tags + new_tags:
+        if tag not in post_tags:
+            post_tags.append(tag)
+    post.tags = post_tags
+    posts.update_post_safety(post, safety)
+    posts.update_post_source(post, source)
+    posts.update_post_relations(post, relations)
+    posts.update_post_notes(post, notes)
+    posts.update_post_flags(post, flags)
+    if item_ctx.has_file('thumbnail'):
+        posts.update_post_thumbnail(post, item_ctx.get_file('thumbnail'))
+    ctx.session.add(post)
+    ctx.session.flush()
+    snapshots.create(post, user)
+    for tag in new_tags:
+        snapshots.create(tag, user)
+    return post, post_tags
+
+
+@routes.post('/post-import/?')
+def import_posts(ctx, _params=None):
+    auth.verify_privilege(ctx.user, 'posts:import')
+    anonymous = ctx.get_param_as_bool('anonymous', default=False)
+    if anonymous:
+        auth.verify_privilege(ctx.user, 'posts:create:anonymous')
+    else:
+        auth.verify_privilege(ctx.user, 'posts:create:identified')
+    user = None if anonymous else ctx.user
+    items = ctx.get_param_as_list('items', required=True)
+
+    results = [None] * len(items)
+    pending = []
+    for index, item in enumerate(items):
+        try:
+            item_ctx = _create_import_context(ctx, index, item)
+            content = item_ctx.get_file('content', required=True)
+        except errors.BaseError as ex:
+            results[index] = _serialize_import_error(index, ex)
+            continue
+        pending.append(
+            (index, item_ctx, content, posts.get_content_checksum(content)))
+
+    post_ids_by_checksum = posts.get_post_ids_by_checksums(
+        [checksum for _, _, _, checksum in pending])
+    tag_names = []
+    for _, item_ctx, _, _ in pending:
+        try:
+            tag_names.extend(
+                item_ctx.get_param_as_list('tags', required=False) or [])
+        except errors.BaseError:
+            pass
+    tags_by_name = {}
+    for tag in tags.get_tags_by_names(tag_names):
+        for tag_name in tag.names:
+            tags_by_name[tag_name.name.lower()] = tag
+
+    for index, item_ctx, content, checksum in pending:
+        if checksum in post_ids_by_checksum:
+            results[index] = {
+                'index': index,
+                'status': 'duplicate',
+                'otherPostId': post_ids_by_checksum[checksum],
+            }
+            continue
+        savepoint = ctx.session.begin_nested()
+        try:
+            post, post_tags = _import_post(
+                ctx, item_ctx, content, tags_by_name, user)
+            savepoint.commit()
+        except errors.BaseError as ex:
+            savepoint.rollback()
+            results[index] = _serialize_import_error(index, ex)
+            continue
+        except Exception:  # pylint: disable=broad-except
+            # e.g. database or storage errors; the other items can still
+            # be saved
+            savepoint.rollback()
+            logger.exception('Failed to import item %d', index)
+            results[index] = _serialize_import_error(
+                index, errors.ProcessingError('Failed to save the post.'))
+            continue
+        post_ids_by_checksum[checksum] = post.post_id
+        for tag in post_tags:
+            for tag_name in tag.names:
+                tags_by_name[tag_name.name.lower()] = tag
+        results[index] = {
+            'index': index,
+            'status': 'created',
+            'postId': post.post_id,
+        }
+
+    ctx.session.commit()
+    if any(result['status'] == 'created' for result in results):
+        tags.export_to_json()
+    return {'results': results}
+
+
+@routes.post('/posts/reverse-search/?')
+def get_posts_by_image(ctx, _params=None):
+    auth.verify_privilege(ctx.user, 'posts:reverse_search')
+    content = ctx.get_file('content', required=True)
+    exact_post = posts.search_by_image_exact(content)
+    similar_posts = [
+        {
+            'distance': distance,
+            'post': _serialize_post(ctx, post),
+        }
+        for distance, post in posts.search_by_image(content)]
+    return {
+        'exactPost': _serialize_post(ctx, exact_post),
+        'similarPosts': similar_posts,
+    }
+
+
 @routes.get('/post/(?P<post_id>[^/]+)/?')
 def get_post(ctx, params):
     auth.verify_privilege(ctx.user, 'posts:view')
@@ -12,6 +12,15 @@ from szurubooru.db.post import (
     PostFeature)
 from szurubooru.db.comment import (Comment, CommentScore)
 from szurubooru.db.snapshot import Snapshot
+from szurubooru.db.index_generation import (
+    IndexGeneration,
+    get_index_generation,
+    bump_index_generation)
 from szurubooru.db.session import (
-    session, sessionmaker, reset_query_count, get_query_count)
+    session,
+    sessionmaker,
+    reset_query_count,
+    get_query_count,
+    get_transaction_info,
+    pop_committed_info)
 import szurubooru.db.util
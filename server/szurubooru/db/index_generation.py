@@ -0,0 +1,37 @@
+from sqlalchemy import Column, Integer, Unicode
+from sqlalchemy.sql.expression import select
+from szurubooru.db.base import Base
+
+
+class IndexGeneration(Base):
+    '''
+    Counter bumped by every transaction that changes data mirrored by an
+    in-process index, so that server processes can tell whether their copy
+    is still current.
+    '''
+    __tablename__ = 'index_generation'
+
+    name = Column('name', Unicode(32), primary_key=True)
+    value = Column('value', Integer, nullable=False, default=0)
+
+
+def get_index_generation(session, name):
+    table = IndexGeneration.__table__
+    return session.execute(
+        select([table.c.value]).where(table.c.name == name)).scalar() or 0
+
+
+def bump_index_generation(session, name):
+    '''
+    Increment the counter within the current transaction and return its new
+    value. The updated row stays locked until the transaction ends, so
+    concurrent transactions bump it one after another.
+    '''
+    table = IndexGeneration.__table__
+    result = session.execute(
+        table.update()
+        .where(table.c.name == name)
+        .values(value=table.c.value + 1))
+    if not result.rowcount:
+        session.execute(table.insert().values(name=name, value=1))
+    return get_index_generation(session, name)
@@ -1,8 +1,9 @@
-from sqlalchemy.sql.expression import func, select
+from sqlalchemy.sql.expression import func, select, update
 from sqlalchemy import (
-    Column, Integer, DateTime, Unicode, UnicodeText, PickleType, ForeignKey)
+    Column, Integer, DateTime, Unicode, UnicodeText, PickleType, ForeignKey,
+    event, inspect)
 from sqlalchemy.orm import (
-    relationship, column_property, object_session, backref)
+    Session, relationship, column_property, object_session, backref)
 from szurubooru.db.base import Base
 from szurubooru.db.comment import Comment
 
@@ -168,6 +169,10 @@ class Post(Base):
     canvas_width = Column('image_width', Integer)
     canvas_height = Column('image_height', Integer)
     mime_type = Column('mime-type', Unicode(32), nullable=False)
+    # perceptual hash, see func.similarity; the old value is needed to update
+    # the similarity index
+    image_hash = column_property(
+        Column('image_hash', Unicode(16)), active_history=True)
 
     # foreign tables
     user = relationship('User')
@@ -188,12 +193,28 @@ class Post(Base):
         'PostNote', cascade='all, delete-orphan', lazy='joined')
     comments = relationship('Comment', cascade='all, delete-orphan')
 
-    # dynamic columns
-    tag_count = column_property(
-        select([func.count(PostTag.tag_id)])
-        .where(PostTag.post_id == post_id)
-        .correlate_except(PostTag))
+    # counters, kept in sync by the flush hooks below
+    tag_count = Column(
+        'tag_count', Integer, nullable=False, default=0, index=True)
+    score = Column('score', Integer, nullable=False, default=0, index=True)
+    favorite_count = Column(
+        'favorite_count', Integer, nullable=False, default=0, index=True)
+    last_favorite_time = Column('last_favorite_time', DateTime, index=True)
+    feature_count = Column(
+        'feature_count', Integer, nullable=False, default=0, index=True)
+    last_feature_time = Column('last_feature_time', DateTime, index=True)
+    comment_count = Column(
+        'comment_count', Integer, nullable=False, default=0, index=True)
+    last_comment_creation_time = Column(
+        'last_comment_creation_time', DateTime, index=True)
+    last_comment_edit_time = Column(
+        'last_comment_edit_time', DateTime, index=True)
+    note_count = Column(
+        'note_count', Integer, nullable=False, default=0, index=True)
+    relation_count = Column(
+        'relation_count', Integer, nullable=False, default=0, index=True)
 
+    # dynamic columns
     canvas_area = column_property(canvas_width * canvas_height)
 
     @property
@@ -204,59 +225,154 @@ class Post(Base):
             .first()
         return featured_post and featured_post.post_id == self.post_id
 
-    score = column_property(
-        select([func.coalesce(func.sum(PostScore.score), 0)])
-        .where(PostScore.post_id == post_id)
-        .correlate_except(PostScore))
-
-    favorite_count = column_property(
-        select([func.count(PostFavorite.post_id)])
-        .where(PostFavorite.post_id == post_id)
-        .correlate_except(PostFavorite))
-
-    last_favorite_time = column_property(
-        select([func.max(PostFavorite.time)])
-        .where(PostFavorite.post_id == post_id)
-        .correlate_except(PostFavorite))
-
-    feature_count = column_property(
-        select([func.count(PostFeature.post_id)])
-        .where(PostFeature.post_id == post_id)
-        .correlate_except(PostFeature))
-
-    last_feature_time = column_property(
-        select([func.max(PostFeature.time)])
-        .where(PostFeature.post_id == post_id)
-        .correlate_except(PostFeature))
-
-    comment_count = column_property(
-        select([func.count(Comment.post_id)])
-        .where(Comment.post_id == post_id)
-        .correlate_except(Comment))
-
-    last_comment_creation_time = column_property(
-        select([func.max(Comment.creation_time)])
-        .where(Comment.post_id == post_id)
-        .correlate_except(Comment))
-
-    last_comment_edit_time = column_property(
-        select([func.max(Comment.last_edit_time)])
-        .where(Comment.post_id == post_id)
-        .correlate_except(Comment))
-
-    note_count = column_property(
-        select([func.count(PostNote.post_id)])
-        .where(PostNote.post_id == post_id)
-        .correlate_except(PostNote))
-
-    relation_count = column_property(
-        select([func.count(PostRelation.child_id)])
-        .where(
-            (PostRelation.parent_id == post_id)
-            | (PostRelation.child_id == post_id))
-        .correlate_except(PostRelation))
-
     __mapper_args__ = {
         'version_id_col': version,
         'version_id_generator': False,
     }
+
+
+def get_counter_expressions():
+    '''
+    Return mapping of counter columns to scalar subqueries computing their
+    true values, correlated to the post table.
+    '''
+    post_id = Post.post_id
+    return {
+        'tag_count':
+            select([func.count(PostTag.tag_id)])
+            .where(PostTag.post_id == post_id),
+        'score':
+            select([func.coalesce(func.sum(PostScore.score), 0)])
+            .where(PostScore.post_id == post_id),
+        'favorite_count':
+            select([func.count(PostFavorite.post_id)])
+            .where(PostFavorite.post_id == post_id),
+        'last_favorite_time':
+            select([func.max(PostFavorite.time)])
+            .where(PostFavorite.post_id == post_id),
+        'feature_count':
+            select([func.count(PostFeature.post_id)])
+            .where(PostFeature.post_id == post_id),
+        'last_feature_time':
+            select([func.max(PostFeature.time)])
+            .where(PostFeature.post_id == post_id),
+        'comment_count':
+            select([func.count(Comment.post_id)])
+            .where(Comment.post_id == post_id),
+        'last_comment_creation_time':
+            select([func.max(Comment.creation_time)])
+            .where(Comment.post_id == post_id),
+        'last_comment_edit_time':
+            select([func.max(Comment.last_edit_time)])
+            .where(Comment.post_id == post_id),
+        'note_count':
+            select([func.count(PostNote.post_id)])
+            .where(PostNote.post_id == post_id),
+        'relation_count':
+            select([func.count(PostRelation.child_id)])
+            .where(
+                (PostRelation.parent_id == post_id)
+                | (PostRelation.child_id == post_id)),
+    }
+
+
+def update_counters(session, post_ids=None):
+    '''
+    Recompute counters of given posts (or all posts if post_ids is None) and
+    expire their stale values in the session.
+
+    The posts are locked first, so that concurrent transactions recompute
+    them one after another. The UPDATE must come as a separate statement:
+    under READ COMMITTED, a statement that waits for a row lock still reads
+    the rest of the database as of its start, so it would miss the rows
+    committed by the transaction it waited for.
+    '''
+    lock_stmt = select([Post.post_id]) \
+        .order_by(Post.post_id) \
+        .with_for_update()
+    stmt = update(Post.__table__).values({
+        name: expr.as_scalar()
+        for name, expr in get_counter_expressions().items()})
+    if post_ids is not None:
+        post_ids = set(post_ids)
+        if not post_ids:
+            return
+        lock_stmt = lock_stmt.where(Post.post_id.in_(post_ids))
+        stmt = stmt.where(Post.post_id.in_(post_ids))
+    session.execute(lock_stmt)
+    session.execute(stmt)
+    counter_names = list(get_counter_expressions().keys())
+    for entity in list(session.identity_map.values()):
+        if isinstance(entity, Post) \
+                and (post_ids is None or entity.post_id in post_ids):
+            session.expire(entity, counter_names)
+
+
+def _get_history_post_ids(entity, attr_name):
+    history = inspect(entity).attrs[attr_name].history
+    return [
+        post.post_id
+        for post in list(history.added or ()) + list(history.deleted or ())]
+
+
+def _get_modified_post_ids(session, entities, is_dirty):
+    post_ids = set()
+    for entity in entities:
+        if isinstance(entity, Post):
+            for attr_name in ('relations', 'related_by'):
+                related_ids = _get_history_post_ids(entity, attr_name)
+                if related_ids:
+                    post_ids.add(entity.post_id)
+                    post_ids.update(related_ids)
+            if inspect(entity).attrs.tags.history.has_changes():
+                post_ids.add(entity.post_id)
+        elif isinstance(
+                entity,
+                (PostScore, PostFavorite, PostFeature, PostNote, Comment)):
+            if not is_dirty or session.is_modified(entity):
+                post_ids.add(entity.post_id)
+                for post_id in inspect(entity).attrs.post_id.history.deleted \
+                        or ():
+                    post_ids.add(post_id)
+    post_ids.discard(None)
+    return post_ids
+
+
+@event.listens_for(Session, 'before_flush')
+def _before_flush(session, _flush_context, _instances):
+    # rows removed implicitly by deleting posts and tags don't show up as
+    # separate entities, so the affected posts need to be looked up now
+    deleted_post_ids = [
+        entity.post_id for entity in session.deleted
+        if isinstance(entity, Post)]
+    deleted_tag_ids = [
+        entity.tag_id for entity in session.deleted
+        if entity.__table__.name == 'tag']
+    post_ids = session.info.setdefault('post_counters_to_update', set())
+    if deleted_post_ids:
+        for parent_id, child_id in session \
+                .query(PostRelation.parent_id, PostRelation.child_id) \
+                .filter(
+                    PostRelation.parent_id.in_(deleted_post_ids)
+                    | PostRelation.child_id.in_(deleted_post_ids)):
+            post_ids.update((parent_id, child_id))
+    if deleted_tag_ids:
+        post_ids.update(
+            post_id for post_id, in session
+            .query(PostTag.post_id)
+            .filter(PostTag.tag_id.in_(deleted_tag_ids)))
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, _flush_context):
+    post_ids = session.info.setdefault('post_counters_to_update', set())
+    post_ids.update(_get_modified_post_ids(session, session.new, False))
+    post_ids.update(_get_modified_post_ids(session, session.dirty, True))
+    post_ids.update(_get_modified_post_ids(session, session.deleted, False))
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _after_flush_postexec(session, _flush_context):
+    post_ids = session.info.pop('post_counters_to_update', None)
+    if post_ids:
+        update_counters(session, post_ids)
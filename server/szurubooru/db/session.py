@@ -25,3 +25,62 @@ def _bump_query_count():
 
 sqlalchemy.event.listen(
     _engine, 'after_execute', lambda *args: _bump_query_count())
+
+
+def _get_real_transaction(transaction):
+    # flushes run in subtransactions, which share state with their parents
+    while transaction.parent is not None and not transaction.nested:
+        transaction = transaction.parent
+    return transaction
+
+
+def _merge_info(target, source):
+    if isinstance(target, dict):
+        for key, value in source.items():
+            target[key] = _merge_info(target[key], value) \
+                if key in target else value
+    elif isinstance(target, list):
+        target.extend(source)
+    elif isinstance(target, set):
+        target.update(source)
+    elif isinstance(target, bool):
+        return target or source
+    return target
+
+
+def get_transaction_info(session):
+    '''
+    Return dictionary for state of the current transaction, such as changes
+    to act upon once it's committed. State of a savepoint is merged into the
+    enclosing transaction when the savepoint is released, and dropped when
+    it's rolled back, so the outermost commit sees exactly the changes that
+    get committed. Values may be lists, sets, booleans and such dictionaries.
+    '''
+    infos = session.info.setdefault('transaction_info', {})
+    return infos.setdefault(_get_real_transaction(session.transaction), {})
+
+
+def pop_committed_info(session, key):
+    '''
+    Return and remove state of the transaction being committed, or None if
+    it's only a savepoint being released. To be called from after_commit.
+    '''
+    if session.transaction.nested:
+        return None
+    infos = session.info.get('transaction_info', {})
+    return infos.get(session.transaction, {}).pop(key, None)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _after_commit(session):
+    transaction = session.transaction
+    infos = session.info.get('transaction_info', {})
+    if transaction.nested and transaction in infos:
+        parent_info = infos.setdefault(
+            _get_real_transaction(transaction.parent), {})
+        _merge_info(parent_info, infos.pop(transaction))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_transaction_end')
+def _after_transaction_end(session, transaction):
+    session.info.get('transaction_info', {}).pop(transaction, None)
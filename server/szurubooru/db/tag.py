@@ -1,9 +1,11 @@
+from collections import defaultdict
 from sqlalchemy import (
-    Column, Integer, DateTime, Unicode, UnicodeText, ForeignKey)
-from sqlalchemy.orm import relationship, column_property
-from sqlalchemy.sql.expression import func, select
+    Column, Integer, DateTime, Unicode, UnicodeText, ForeignKey, Index, event,
+    inspect)
+from sqlalchemy.orm import Session, relationship, column_property
+from sqlalchemy.sql.expression import func, select, update
 from szurubooru.db.base import Base
-from szurubooru.db.post import PostTag
+from szurubooru.db.post import Post, PostTag
 
 
 class TagSuggestion(Base):
@@ -66,6 +68,9 @@ class TagName(Base):
         self.order = order
 
 
+Index('ix_tag_name_lower_name', func.lower(TagName.name))
+
+
 class Tag(Base):
     __tablename__ = 'tag'
 
@@ -100,10 +105,9 @@ class Tag(Base):
         secondaryjoin=tag_id == TagImplication.child_id,
         lazy='joined')
 
-    post_count = column_property(
-        select([func.count(PostTag.post_id)])
-        .where(PostTag.tag_id == tag_id)
-        .correlate_except(PostTag))
+    # usage counter, kept in sync by the flush hooks below
+    post_count = Column(
+        'post_count', Integer, nullable=False, default=0, index=True)
 
     first_name = column_property(
         select([TagName.name])
@@ -129,3 +133,85 @@ class Tag(Base):
         'version_id_col': version,
         'version_id_generator': False,
     }
+
+
+def _expire_post_counts(session, tag_ids):
+    for entity in list(session.identity_map.values()):
+        if isinstance(entity, Tag) \
+                and (tag_ids is None or entity.tag_id in tag_ids):
+            session.expire(entity, ['post_count'])
+
+
+def update_post_counts(session, tag_ids=None):
+    '''
+    Recount usages of given tags (or all tags if tag_ids is None) from
+    scratch.
+    '''
+    stmt = update(Tag.__table__).values(
+        post_count=select([func.count(PostTag.post_id)])
+        .where(PostTag.tag_id == Tag.tag_id)
+        .as_scalar())
+    if tag_ids is not None:
+        tag_ids = set(tag_ids)
+        if not tag_ids:
+            return
+        stmt = stmt.where(Tag.tag_id.in_(tag_ids))
+    session.execute(stmt)
+    _expire_post_counts(session, tag_ids)
+
+
+def adjust_post_counts(session, deltas):
+    '''
+    Add given amounts to usage counters of tags, passed as a dictionary of
+    tag ids to deltas.
+    '''
+    tag_ids_by_delta = defaultdict(set)
+    for tag_id, delta in deltas.items():
+        if delta and tag_id is not None:
+            tag_ids_by_delta[delta].add(tag_id)
+    for delta, tag_ids in tag_ids_by_delta.items():
+        session.execute(
+            update(Tag.__table__)
+            .where(Tag.tag_id.in_(tag_ids))
+            .values(post_count=Tag.post_count + delta))
+        _expire_post_counts(session, tag_ids)
+
+
+def _get_post_count_deltas(session):
+    return session.info.setdefault('tag_post_count_deltas', defaultdict(int))
+
+
+@event.listens_for(Session, 'before_flush')
+def _before_flush(session, _flush_context, _instances):
+    # post_tag rows of deleted posts are removed implicitly, so look them up
+    # while they still exist
+    deleted_post_ids = [
+        entity.post_id for entity in session.deleted
+        if isinstance(entity, Post)]
+    if not deleted_post_ids:
+        return
+    deltas = _get_post_count_deltas(session)
+    for tag_id, in session \
+            .query(PostTag.tag_id) \
+            .filter(PostTag.post_id.in_(deleted_post_ids)):
+        deltas[tag_id] -= 1
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, _flush_context):
+    deltas = _get_post_count_deltas(session)
+    for entity in list(session.new) + list(session.dirty):
+        if not isinstance(entity, Post):
+            continue
+        history = inspect(entity).attrs.tags.history
+        for tag in history.added or ():
+            deltas[tag.tag_id] += 1
+        for tag in history.deleted or ():
+            deltas[tag.tag_id] -= 1
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _after_flush_postexec(session, _flush_context):
+    deltas = session.info.pop('tag_post_count_deltas', None)
+    if deltas:
+        adjust_post_counts(session, deltas)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Unicode, DateTime
+from sqlalchemy import Column, Integer, Unicode, DateTime, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.expression import func
 from szurubooru.db.base import Base
@@ -80,3 +80,7 @@ class User(Base):
         'version_id_col': version,
         'version_id_generator': False,
     }
+
+
+Index('ix_user_lower_name', func.lower(User.name))
+Index('ix_user_lower_email', func.lower(User.email))
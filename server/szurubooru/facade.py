@@ -77,6 +77,9 @@ def validate_config():
     if not config.config['database']:
         raise errors.ConfigError('Database is not configured')
 
+    from szurubooru.func import files
+    files.get_storage()
+
 
 def create_app():
     ''' Create a WSGI compatible App object. '''
@@ -95,4 +98,10 @@ def create_app():
     rest.errors.handle(errors.ProcessingError, _on_processing_error)
     rest.errors.handle(sqlalchemy.orm.exc.StaleDataError, _on_stale_data_error)
 
+    from szurubooru.func import tag_index, similarity
+    if tag_index.is_enabled():
+        tag_index.get_index().start_loading()
+    if similarity.is_enabled():
+        similarity.get_index().start_loading()
+
     return rest.application
@@ -1,64 +1,529 @@
-from datetime import datetime
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from szurubooru import config, errors
+from szurubooru.func import util
+
+
+# not owned by the values that refer to them
+_SHARED_TYPES = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.MethodType,
+    types.BuiltinFunctionType)
+
+
+def _get_size(value, seen=None):
+    '''
+    Approximate the memory footprint of the value in bytes. Containers and
+    attributes of objects, such as ORM entities, are walked recursively.
+    '''
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(_get_size(item, seen) for item in value)
+    elif isinstance(value, dict):
+        size += sum(
+            _get_size(key, seen) + _get_size(item, seen)
+            for key, item in value.items())
+    elif hasattr(value, '__dict__') and not isinstance(value, _SHARED_TYPES):
+        size += sys.getsizeof(value.__dict__)
+        size += sum(
+            _get_size(item, seen)
+            for key, item in value.__dict__.items()
+            # bookkeeping of SQLAlchemy, which links to the whole session
+            if key != '_sa_instance_state')
+    return size
+
+
+_ANY_DEPENDENCY = '*'
+
+
+def _get_dependency_names(dependencies):
+    if dependencies is None:
+        return [_ANY_DEPENDENCY]
+    return list(sorted(set(dependencies)))
+
+
+def _get_dependency_keys(item):
+    return [None] if item.dependencies is None else item.dependencies
 
 
 class LruCacheItem(object):
-    def __init__(self, key, value):
+    def __init__(self, key, value, size=None, dependencies=None):
         self.key = key
         self.value = value
+        self.size = _get_size(value) if size is None else size
+        self.dependencies = \
+            frozenset(dependencies) if dependencies is not None else None
         self.timestamp = datetime.utcnow()
 
 
 class LruCache(object):
-    def __init__(self, length, delta=None):
-        self.length = length
+    '''
+    Least recently used cache with O(1) lookups, insertions and evictions.
+    The capacity is expressed as the approximate total size of the stored
+    values in bytes; items older than delta are treated as missing.
+
+    Each item may name the resource types it was computed from, so that
+    writes can drop only the items they affect. Items without dependencies
+    are dropped on every invalidation.
+    '''
+
+    def __init__(self, max_size, delta=None):
+        self.max_size = max_size
         self.delta = delta
-        self.hash = {}
-        self.item_list = []
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._dependents = defaultdict(set)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _is_expired(self, item):
+        return self.delta is not None \
+            and item.timestamp + self.delta < datetime.utcnow()
+
+    def _try_get_item(self, key):
+        item = self._items.get(key, None)
+        if item is not None and self._is_expired(item):
+            self.remove_item(key)
+            return None
+        return item
+
+    def has(self, key):
+        if self._try_get_item(key) is not None:
+            return True
+        self.misses += 1
+        return False
+
+    def get(self, key):
+        item = self._try_get_item(key)
+        if item is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        self._items.move_to_end(key, last=False)
+        return item.value
 
     def insert_item(self, item):
-        if item.key in self.hash:
-            item_index = next(
-                i
-                for i, v in enumerate(self.item_list)
-                if v.key == item.key)
-            self.item_list[:] \
-                = self.item_list[:item_index] \
-                + self.item_list[item_index + 1:]
-            self.item_list.insert(0, item)
-        else:
-            if len(self.item_list) > self.length:
-                self.remove_item(self.item_list[-1])
-            self.hash[item.key] = item
-            self.item_list.insert(0, item)
+        if item.size > self.max_size:
+            return
+        self.remove_item(item.key)
+        self._items[item.key] = item
+        self._items.move_to_end(item.key, last=False)
+        self.size += item.size
+        for dependency in _get_dependency_keys(item):
+            self._dependents[dependency].add(item.key)
+        while self.size > self.max_size:
+            _, evicted_item = self._items.popitem(last=True)
+            self._unlink_item(evicted_item)
+            self.evictions += 1
 
     def remove_all(self):
-        self.hash = {}
-        self.item_list = []
+        self._items.clear()
+        self._dependents.clear()
+        self.size = 0
+
+    def remove_item(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._unlink_item(item)
+
+    def invalidate(self, dependencies):
+        keys = set(self._dependents.get(None, ()))
+        for dependency in dependencies:
+            keys.update(self._dependents.get(dependency, ()))
+        for key in keys:
+            self.remove_item(key)
+
+    def _unlink_item(self, item):
+        self.size -= item.size
+        for dependency in _get_dependency_keys(item):
+            dependents = self._dependents[dependency]
+            dependents.discard(item.key)
+            if not dependents:
+                del self._dependents[dependency]
+
+    def get_stats(self):
+        return {
+            'items': len(self._items),
+            'size': self.size,
+            'maxSize': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class BaseBackend(object):
+    '''
+    Storage used by the module level cache functions.
+
+    Generations count the invalidations of each resource type. A value put
+    together with the generations read before it was computed is dropped if
+    an invalidation happened in the meantime, as it may be stale already.
+    '''
+
+    def has(self, key):
+        raise NotImplementedError()
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def get_generations(self, dependencies):
+        raise NotImplementedError()
+
+    def put(self, key, value, dependencies=None, generations=None):
+        raise NotImplementedError()
+
+    def remove(self, key):
+        raise NotImplementedError()
+
+    def invalidate(self, dependencies):
+        raise NotImplementedError()
+
+    def purge(self):
+        raise NotImplementedError()
+
+    def get_stats(self):
+        raise NotImplementedError()
+
+
+class MemoryBackend(BaseBackend):
+    ''' Cache private to the current process. '''
+
+    def __init__(self, max_size, delta=None):
+        self.lru_cache = LruCache(max_size=max_size, delta=delta)
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def has(self, key):
+        with self._lock:
+            return self.lru_cache.has(key)
 
-    def remove_item(self, item):
-        del self.hash[item.key]
-        del self.item_list[self.item_list.index(item)]
+    def get(self, key):
+        with self._lock:
+            return self.lru_cache.get(key)
 
+    def _get_generations(self, dependencies):
+        return {
+            name: self._generations[name]
+            for name in _get_dependency_names(dependencies)}
 
-_CACHE = LruCache(length=100)
+    def get_generations(self, dependencies):
+        with self._lock:
+            return self._get_generations(dependencies)
+
+    def put(self, key, value, dependencies=None, generations=None):
+        item = LruCacheItem(key, value, dependencies=dependencies)
+        with self._lock:
+            if generations is not None \
+                    and generations != self._get_generations(dependencies):
+                return
+            self.lru_cache.insert_item(item)
+
+    def remove(self, key):
+        with self._lock:
+            self.lru_cache.remove_item(key)
+
+    def invalidate(self, dependencies):
+        with self._lock:
+            for name in set(dependencies) | {_ANY_DEPENDENCY}:
+                self._generations[name] += 1
+            self.lru_cache.invalidate(dependencies)
+
+    def purge(self):
+        with self._lock:
+            self.lru_cache.remove_all()
+
+    def get_stats(self):
+        with self._lock:
+            return self.lru_cache.get_stats()
+
+
+class SqliteBackend(BaseBackend):
+    '''
+    Cache kept in a SQLite database, shared by all worker processes on the
+    machine. Values must be picklable.
+
+    Invalidation bumps a generation counter for every affected resource type.
+    Entries remember the generations they were computed at and are treated
+    as missing once any of them changes, so invalidation issued by one worker
+    reaches all of them.
+    '''
+
+    def __init__(self, path, max_size, delta=None):
+        self.path = path
+        self.max_size = max_size
+        self.delta = delta
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        with self._transaction() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache_entry ('
+                'key TEXT PRIMARY KEY, '
+                'value BLOB NOT NULL, '
+                'size INTEGER NOT NULL, '
+                'generations TEXT NOT NULL, '
+                'creation_time REAL NOT NULL, '
+                'access_order INTEGER NOT NULL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS cache_entry_access_order '
+                'ON cache_entry (access_order)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache_generation ('
+                'name TEXT PRIMARY KEY, '
+                'value INTEGER NOT NULL)')
+            # running total of the entry sizes, kept up to date by triggers
+            # so that eviction doesn't have to sum them up
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache_size ('
+                'id INTEGER PRIMARY KEY, '
+                'value INTEGER NOT NULL)')
+            connection.execute(
+                'INSERT OR IGNORE INTO cache_size '
+                'SELECT 0, COALESCE(SUM(size), 0) FROM cache_entry')
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS cache_entry_insert '
+                'AFTER INSERT ON cache_entry BEGIN '
+                'UPDATE cache_size SET value = value + NEW.size; END')
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS cache_entry_delete '
+                'AFTER DELETE ON cache_entry BEGIN '
+                'UPDATE cache_size SET value = value - OLD.size; END')
+
+    def _get_connection(self):
+        # connections must not be shared across forked workers either
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    @staticmethod
+    def _get_digest(key):
+        return util.get_sha1(repr(key))
+
+    @staticmethod
+    def _get_generations(connection, names):
+        generations = {name: 0 for name in names}
+        for name, value in connection.execute(
+                'SELECT name, value FROM cache_generation '
+                'WHERE name IN (%s)' % ','.join('?' * len(names)),
+                names):
+            generations[name] = value
+        return generations
+
+    def _try_get_value(self, key, touch):
+        connection = self._get_connection()
+        digest = self._get_digest(key)
+        row = connection.execute(
+            'SELECT value, generations, creation_time FROM cache_entry '
+            'WHERE key = ?', (digest,)).fetchone()
+        if row is None:
+            return None
+        value, generations, creation_time = row
+        generations = json.loads(generations)
+        is_expired = self.delta is not None \
+            and creation_time + self.delta.total_seconds() < time.time()
+        if is_expired or generations != self._get_generations(
+                connection, list(generations.keys())):
+            connection.execute(
+                'DELETE FROM cache_entry WHERE key = ?', (digest,))
+            return None
+        if touch:
+            connection.execute(
+                'UPDATE cache_entry SET access_order = ('
+                'SELECT MAX(access_order) + 1 FROM cache_entry) '
+                'WHERE key = ?',
+                (digest,))
+        return (value,)
+
+    def has(self, key):
+        if self._try_get_value(key, touch=False) is not None:
+            return True
+        self.misses += 1
+        return False
+
+    def get(self, key):
+        row = self._try_get_value(key, touch=True)
+        if row is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def get_generations(self, dependencies):
+        return self._get_generations(
+            self._get_connection(), _get_dependency_names(dependencies))
+
+    def put(self, key, value, dependencies=None, generations=None):
+        try:
+            payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        if len(payload) > self.max_size:
+            return
+        names = _get_dependency_names(dependencies)
+        digest = self._get_digest(key)
+        with self._transaction() as connection:
+            current_generations = self._get_generations(connection, names)
+            if generations is not None \
+                    and generations != current_generations:
+                return
+            # replacing with INSERT OR REPLACE wouldn't fire the trigger
+            connection.execute(
+                'DELETE FROM cache_entry WHERE key = ?', (digest,))
+            connection.execute(
+                'INSERT INTO cache_entry VALUES (?, ?, ?, ?, ?, ('
+                'SELECT COALESCE(MAX(access_order), 0) + 1 FROM cache_entry))',
+                (
+                    digest,
+                    payload,
+                    len(payload),
+                    json.dumps(current_generations),
+                    time.time(),
+                ))
+            self._evict(connection)
+
+    def _evict(self, connection):
+        excess = connection.execute(
+            'SELECT value FROM cache_size').fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+        evicted_keys = []
+        for key, size in connection.execute(
+                'SELECT key, size FROM cache_entry ORDER BY access_order'):
+            if excess <= 0:
+                break
+            evicted_keys.append(key)
+            excess -= size
+        connection.executemany(
+            'DELETE FROM cache_entry WHERE key = ?',
+            [(key,) for key in evicted_keys])
+        self.evictions += len(evicted_keys)
+
+    def remove(self, key):
+        self._get_connection().execute(
+            'DELETE FROM cache_entry WHERE key = ?', (self._get_digest(key),))
+
+    def invalidate(self, dependencies):
+        names = set(dependencies)
+        names.add(_ANY_DEPENDENCY)
+        with self._transaction() as connection:
+            for name in names:
+                connection.execute(
+                    'INSERT OR IGNORE INTO cache_generation VALUES (?, 0)',
+                    (name,))
+                connection.execute(
+                    'UPDATE cache_generation SET value = value + 1 '
+                    'WHERE name = ?',
+                    (name,))
+
+    def purge(self):
+        self._get_connection().execute('DELETE FROM cache_entry')
+
+    def get_stats(self):
+        items, size = self._get_connection().execute(
+            'SELECT (SELECT COUNT(*) FROM cache_entry), value '
+            'FROM cache_size').fetchone()
+        return {
+            'items': items,
+            'size': size,
+            'maxSize': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def _create_backend():
+    cache_config = config.config.get('cache', None) or {}
+    ttl = int(cache_config.get('ttl', None) or 0)
+    max_size = int(cache_config.get('max_size', None) or 100 * 1024 ** 2)
+    delta = timedelta(seconds=ttl) if ttl > 0 else None
+    backend = cache_config.get('backend', None) or 'memory'
+    if backend == 'memory':
+        return MemoryBackend(max_size=max_size, delta=delta)
+    if backend == 'sqlite':
+        path = cache_config.get('path', None) or os.path.join(
+            tempfile.gettempdir(), 'szurubooru-cache.sqlite')
+        return SqliteBackend(path, max_size=max_size, delta=delta)
+    raise errors.ConfigError('Unknown cache backend: %r' % backend)
+
+
+_BACKEND = None
+
+
+def _get_backend():
+    global _BACKEND  # pylint: disable=global-statement
+    if _BACKEND is None:
+        _BACKEND = _create_backend()
+    return _BACKEND
 
 
 def purge():
-    _CACHE.remove_all()
+    _get_backend().purge()
 
 
 def has(key):
-    return key in _CACHE.hash
+    return _get_backend().has(key)
 
 
 def get(key):
-    return _CACHE.hash[key].value
+    return _get_backend().get(key)
 
 
 def remove(key):
-    if has(key):
-        del _CACHE.hash[key]
+    _get_backend().remove(key)
+
+
+def get_generations(dependencies=None):
+    ''' Return generations to pass to put, read before computing a value. '''
+    return _get_backend().get_generations(dependencies)
+
+
+def put(key, value, dependencies=None, generations=None):
+    _get_backend().put(
+        key, value, dependencies=dependencies, generations=generations)
+
+
+def invalidate(dependencies):
+    _get_backend().invalidate(dependencies)
 
 
-def put(key, value):
-    _CACHE.insert_item(LruCacheItem(key, value))
+def get_stats():
+    return _get_backend().get_stats()
@@ -0,0 +1,173 @@
+'''
+Reads dimensions of images and videos straight from their headers, which is
+a lot cheaper than asking ffprobe. The parsers only look at the few fields
+they need; anything they don't understand makes them give up and return
+None, so that the caller can fall back to ffprobe.
+'''
+
+import struct
+from szurubooru.func import mime
+
+
+def _get_png_dimensions(content):
+    if content[12:16] != b'IHDR' or len(content) < 24:
+        return None
+    return struct.unpack('>II', content[16:24])
+
+
+def _get_gif_dimensions(content):
+    if len(content) < 10:
+        return None
+    return struct.unpack('<HH', content[6:10])
+
+
+# start of frame markers, i.e. all 0xCn except DHT, JPG and DAC
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# markers that aren't followed by a segment length
+_JPEG_STANDALONE_MARKERS = set(range(0xD0, 0xDA)) | {0x01}
+
+
+def _get_jpeg_dimensions(content):
+    pos = 2
+    while pos + 4 <= len(content):
+        if content[pos] != 0xFF:
+            return None
+        marker = content[pos + 1]
+        if marker == 0xFF:
+            # padding
+            pos += 1
+            continue
+        if marker in _JPEG_STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if marker == 0xDA:
+            # start of scan without any frame header
+            return None
+        length = struct.unpack('>H', content[pos + 2:pos + 4])[0]
+        if marker in _JPEG_SOF_MARKERS:
+            if pos + 9 > len(content):
+                return None
+            height, width = struct.unpack('>HH', content[pos + 5:pos + 9])
+            return (width, height)
+        pos += 2 + length
+    return None
+
+
+_EBML_SEGMENT = 0x18538067
+_EBML_TRACKS = 0x1654AE6B
+_EBML_TRACK_ENTRY = 0xAE
+_EBML_VIDEO = 0xE0
+_EBML_PIXEL_WIDTH = 0xB0
+_EBML_PIXEL_HEIGHT = 0xBA
+_EBML_CLUSTER = 0x1F43B675
+# master elements on the way to video track settings
+_EBML_PARENTS = {_EBML_SEGMENT, _EBML_TRACKS, _EBML_TRACK_ENTRY, _EBML_VIDEO}
+
+
+def _read_ebml_number(content, pos, keep_marker):
+    if pos >= len(content) or not content[pos]:
+        raise ValueError('Invalid EBML number')
+    first = content[pos]
+    length = 1
+    while not first & (0x80 >> (length - 1)):
+        length += 1
+    if pos + length > len(content):
+        raise ValueError('Truncated EBML number')
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in content[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, length, unknown
+
+
+def _get_matroska_dimensions(content):
+    pos = 0
+    width = None
+    height = None
+    try:
+        while pos < len(content):
+            element_id, id_length, _ = _read_ebml_number(content, pos, True)
+            size, size_length, unknown_size = _read_ebml_number(
+                content, pos + id_length, False)
+            data_pos = pos + id_length + size_length
+            if element_id in _EBML_PARENTS:
+                # step inside; its children are followed by its siblings,
+                # so they can all be read as if they were on the same level
+                pos = data_pos
+                continue
+            if element_id == _EBML_CLUSTER or unknown_size:
+                # past the track information
+                return None
+            if element_id in (_EBML_PIXEL_WIDTH, _EBML_PIXEL_HEIGHT):
+                value = int.from_bytes(
+                    content[data_pos:data_pos + size], 'big')
+                if element_id == _EBML_PIXEL_WIDTH:
+                    width = value
+                else:
+                    height = value
+                if width is not None and height is not None:
+                    return (width, height)
+            pos = data_pos + size
+    except ValueError:
+        return None
+    return None
+
+
+# boxes on the way to track headers
+_MP4_PARENTS = {b'moov', b'trak'}
+
+
+def _get_mp4_dimensions(content, pos=0, end=None):
+    end = len(content) if end is None else end
+    while pos + 8 <= end:
+        size, box_type = struct.unpack('>I4s', content[pos:pos + 8])
+        header_size = 8
+        if size == 1:
+            if pos + 16 > end:
+                return None
+            size = struct.unpack('>Q', content[pos + 8:pos + 16])[0]
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size:
+            return None
+        if box_type in _MP4_PARENTS:
+            result = _get_mp4_dimensions(
+                content, pos + header_size, min(end, pos + size))
+            if result:
+                return result
+        elif box_type == b'tkhd':
+            # width and height are 16.16 fixed point numbers at the end
+            tkhd_end = pos + size
+            if tkhd_end > end:
+                return None
+            width, height = struct.unpack(
+                '>II', content[tkhd_end - 8:tkhd_end])
+            if width and height:
+                # audio tracks have zero dimensions
+                return (width >> 16, height >> 16)
+        pos += size
+    return None
+
+
+_PARSERS = {
+    'image/png': _get_png_dimensions,
+    'image/gif': _get_gif_dimensions,
+    'image/jpeg': _get_jpeg_dimensions,
+    'video/webm': _get_matroska_dimensions,
+    'video/mp4': _get_mp4_dimensions,
+}
+
+
+def get_dimensions(content):
+    ''' Return (width, height) tuple, or None if it can't be determined. '''
+    parser = _PARSERS.get(mime.get_mime_type(content))
+    if not parser:
+        return None
+    try:
+        dimensions = parser(content)
+    except (struct.error, IndexError):
+        return None
+    if not dimensions or not dimensions[0] or not dimensions[1]:
+        return None
+    return tuple(dimensions)
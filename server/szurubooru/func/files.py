@@ -1,35 +1,431 @@
+import contextlib
+import mimetypes
 import os
-from szurubooru import config
+import posixpath
+import tempfile
+import threading
+from szurubooru import config, errors
+from szurubooru.func import util
 
+try:
+    import boto3
+except ImportError:
+    boto3 = None  # pylint: disable=invalid-name
 
-def _get_full_path(path):
+
+_TEMPORARY_DIR = 'temporary-uploads'
+
+
+class TemporaryFile(object):
+    '''
+    Uploaded content spooled to a file in the data directory, so that it
+    doesn't have to be kept in memory, and can be stored with a rename.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.is_stored = False
+
+    def __len__(self):
+        return os.path.getsize(self.path)
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def read(self, size=-1):
+        with self.open() as handle:
+            return handle.read(size)
+
+    def delete(self):
+        if not self.is_stored and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def create_temporary_file():
+    ''' Return new file opened for writing, and its TemporaryFile. '''
+    temporary_dir = get_full_path(_TEMPORARY_DIR)
+    os.makedirs(temporary_dir, exist_ok=True)
+    handle, path = tempfile.mkstemp(dir=temporary_dir)
+    return os.fdopen(handle, 'w+b'), TemporaryFile(path)
+
+
+def get_full_path(path):
+    ''' Return path in the local data directory, regardless of storage. '''
     return os.path.join(config.config['data_dir'], path)
 
 
+_BLOB_DIR = '.blobs'
+_THREAD_STATE = threading.local()
+
+
+def _get_pending_writes():
+    return getattr(_THREAD_STATE, 'pending_writes', None)
+
+
+def _get_temporary_path(full_path):
+    # unique to the thread, so that concurrent writes don't mix, and reused
+    # by the next write if a crash left it behind
+    dir_path, file_name = os.path.split(full_path)
+    return os.path.join(dir_path, '.%s.%d-%d.tmp' % (
+        file_name, os.getpid(), threading.get_ident()))
+
+
+def _fsync_path(path):
+    handle = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+
+def _write_temporary_file(full_path, content):
+    temporary_path = _get_temporary_path(full_path)
+    try:
+        handle = open(temporary_path, 'wb')
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        handle = open(temporary_path, 'wb')
+    try:
+        with handle:
+            handle.write(content)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+    return temporary_path
+
+
+def _replace_file(temporary_path, full_path, fsync):
+    if fsync:
+        _fsync_path(temporary_path)
+    os.replace(temporary_path, full_path)
+    if fsync:
+        _fsync_path(os.path.dirname(full_path))
+
+
+@contextlib.contextmanager
+def batched_sync():
+    '''
+    Defer syncing the files saved in the block to disk until its end, where
+    they're all synced, renamed into place and have their directories synced
+    at once. Only matters with fsync enabled; until the end of the block, the
+    saved files aren't in place yet.
+    '''
+    if _get_pending_writes() is not None:
+        yield
+        return
+    pending_writes = {}
+    _THREAD_STATE.pending_writes = pending_writes
+    try:
+        yield
+    except BaseException:
+        for temporary_path in pending_writes.values():
+            if os.path.exists(temporary_path):
+                os.unlink(temporary_path)
+        raise
+    finally:
+        _THREAD_STATE.pending_writes = None
+    for temporary_path in pending_writes.values():
+        _fsync_path(temporary_path)
+    for full_path, temporary_path in pending_writes.items():
+        os.replace(temporary_path, full_path)
+    for dir_path in {os.path.dirname(path) for path in pending_writes}:
+        _fsync_path(dir_path)
+
+
+class LocalStorage(object):
+    '''
+    Files in the local data directory. Contents are written to a temporary
+    file next to the target and renamed over it, so that readers never see
+    partially written files, and with fsync enabled, a crash doesn't leave
+    them behind either.
+    '''
+
+    def __init__(self, data_dir, fsync=False, deduplicate=True):
+        self.data_dir = data_dir
+        self.fsync = fsync
+        self.deduplicate = deduplicate
+
+    def get_local_path(self, key):
+        return os.path.join(self.data_dir, key)
+
+    def has(self, key):
+        return os.path.exists(self.get_local_path(key))
+
+    def get(self, key):
+        full_path = self.get_local_path(key)
+        if not os.path.exists(full_path):
+            return None
+        with open(full_path, 'rb') as handle:
+            return handle.read()
+
+    def _replace(self, temporary_path, full_path, batch=True):
+        pending_writes = _get_pending_writes()
+        if self.fsync and batch and pending_writes is not None:
+            pending_writes[full_path] = temporary_path
+            return
+        _replace_file(temporary_path, full_path, self.fsync)
+
+    def _write(self, full_path, content, batch=True):
+        temporary_path = _write_temporary_file(full_path, content)
+        self._replace(temporary_path, full_path, batch)
+
+    def _link(self, source_path, full_path):
+        ''' Return False if the file system can't link the files. '''
+        pending_writes = _get_pending_writes() or {}
+        if full_path not in pending_writes and os.path.exists(full_path) \
+                and os.path.samefile(source_path, full_path):
+            return True
+        temporary_path = _get_temporary_path(full_path)
+        if os.path.lexists(temporary_path):
+            os.unlink(temporary_path)
+        try:
+            try:
+                os.link(source_path, temporary_path)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                os.link(source_path, temporary_path)
+        except OSError:
+            # e.g. no hard links on the file system, or too many of them
+            return False
+        self._replace(temporary_path, full_path)
+        return True
+
+    def save(self, key, content, deduplicate=False):
+        full_path = self.get_local_path(key)
+        if isinstance(content, TemporaryFile):
+            # the temporary file is on the same file system, so this is a
+            # rename
+            assert not content.is_stored
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            os.chmod(content.path, 0o644)
+            self._replace(content.path, full_path, batch=False)
+            content.path = full_path
+            content.is_stored = True
+        elif deduplicate and self.deduplicate:
+            # files are only ever replaced, never written to in place, so
+            # the ones with the same content can share it
+            digest = util.get_sha1(content)
+            blob_path = os.path.join(
+                self.data_dir, _BLOB_DIR, digest[0:2], digest)
+            if not os.path.exists(blob_path):
+                self._write(blob_path, content, batch=False)
+            if not self._link(blob_path, full_path):
+                self._write(full_path, content)
+        else:
+            self._write(full_path, content)
+
+    def delete(self, key):
+        full_path = self.get_local_path(key)
+        if os.path.exists(full_path):
+            os.unlink(full_path)
+
+    def move(self, source_key, target_key):
+        target_path = self.get_local_path(target_key)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        os.rename(self.get_local_path(source_key), target_path)
+
+    def get_usage(self):
+        total_size = 0
+        linked_files = set()
+        for dir_path, _, file_names in os.walk(self.data_dir):
+            for file_name in file_names:
+                stat = os.stat(os.path.join(dir_path, file_name))
+                # deduplicated contents take space only once
+                if stat.st_nlink > 1:
+                    if (stat.st_dev, stat.st_ino) in linked_files:
+                        continue
+                    linked_files.add((stat.st_dev, stat.st_ino))
+                total_size += stat.st_size
+        return total_size
+
+
+def _is_missing_object_error(ex):
+    code = getattr(ex, 'response', {}).get('Error', {}).get('Code')
+    return code in ('404', 'NoSuchKey', 'NotFound')
+
+
+class S3Storage(object):
+    '''
+    Objects in a bucket of S3 or a compatible service. The data URL must
+    point to the bucket (and prefix), as the files are served from there.
+    '''
+
+    def __init__(self, bucket, prefix='', client=None, **client_options):
+        if client is None:
+            if boto3 is None:
+                raise errors.ConfigError(
+                    'The s3 storage backend requires boto3 to be installed.')
+            client = boto3.client('s3', **client_options)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get_local_path(self, _key):
+        return None
+
+    def has(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as ex:
+            if _is_missing_object_error(ex):
+                return False
+            raise
+        return True
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as ex:
+            if _is_missing_object_error(ex):
+                return None
+            raise
+        return response['Body'].read()
+
+    def save(self, key, content, _deduplicate=False):
+        # objects are replaced atomically, and can't be shared
+        content_type = mimetypes.guess_type(key)[0] \
+            or 'application/octet-stream'
+        if isinstance(content, TemporaryFile):
+            # the temporary file is deleted when the request is over
+            with content.open() as handle:
+                self.client.put_object(
+                    Bucket=self.bucket, Key=self.prefix + key,
+                    Body=handle, ContentType=content_type)
+            return
+        self.client.put_object(
+            Bucket=self.bucket, Key=self.prefix + key,
+            Body=content, ContentType=content_type)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def move(self, source_key, target_key):
+        self.client.copy_object(
+            Bucket=self.bucket,
+            Key=self.prefix + target_key,
+            CopySource={
+                'Bucket': self.bucket,
+                'Key': self.prefix + source_key,
+            })
+        self.delete(source_key)
+
+    def get_usage(self):
+        total_size = 0
+        options = {'Bucket': self.bucket, 'Prefix': self.prefix}
+        while True:
+            response = self.client.list_objects_v2(**options)
+            for item in response.get('Contents', []):
+                total_size += item['Size']
+            if not response.get('IsTruncated'):
+                return total_size
+            options['ContinuationToken'] = response['NextContinuationToken']
+
+
+def _get_storage_config():
+    return config.config.get('storage') or {}
+
+
+def _create_storage():
+    storage_config = _get_storage_config()
+    backend = storage_config.get('backend') or 'local'
+    if backend == 'local':
+        return LocalStorage(
+            config.config['data_dir'],
+            fsync=bool(storage_config.get('fsync')),
+            deduplicate=bool(storage_config.get('deduplicate', True)))
+    if backend == 's3':
+        s3_config = storage_config.get('s3') or {}
+        if not s3_config.get('bucket'):
+            raise errors.ConfigError('S3 storage bucket is not configured.')
+        return S3Storage(
+            s3_config['bucket'],
+            prefix=s3_config.get('prefix') or '',
+            endpoint_url=s3_config.get('endpoint_url') or None,
+            region_name=s3_config.get('region') or None,
+            aws_access_key_id=s3_config.get('access_key') or None,
+            aws_secret_access_key=s3_config.get('secret_key') or None)
+    raise errors.ConfigError('Unknown storage backend: %r.' % backend)
+
+
+_STORAGES = {}
+
+
+def get_storage():
+    ''' Return the configured storage backend. '''
+    cache_key = (config.config['data_dir'], repr(_get_storage_config()))
+    if cache_key not in _STORAGES:
+        _STORAGES[cache_key] = _create_storage()
+    return _STORAGES[cache_key]
+
+
+def get_sharded_key(path):
+    '''
+    Return path with two levels of directories named after the hash of the
+    file name inserted before it, e.g. posts/1.png -> posts/4a/47/1.png,
+    so that no directory ends up with more than a few files.
+    '''
+    dir_name, file_name = posixpath.split(path)
+    if not dir_name:
+        return path
+    digest = util.get_md5(file_name)
+    return posixpath.join(dir_name, digest[0:2], digest[2:4], file_name)
+
+
+def get_storage_key(path):
+    ''' Return where the file is kept in the storage. '''
+    if _get_storage_config().get('layout') == 'sharded':
+        return get_sharded_key(path)
+    return path
+
+
+def get_url(path):
+    return '%s/%s' % (
+        config.config['data_url'].rstrip('/'), get_storage_key(path))
+
+
+def write_atomically(full_path, content):
+    '''
+    Replace file at full_path with content, so that readers never see it
+    partially written. Meant for files that are kept in the data directory
+    regardless of the storage backend.
+    '''
+    _replace_file(
+        _write_temporary_file(full_path, content),
+        full_path,
+        bool(_get_storage_config().get('fsync')))
+
+
+def get_local_path(path):
+    ''' Return path of the stored file, or None if it isn't stored locally. '''
+    return get_storage().get_local_path(get_storage_key(path))
+
+
+def get_disk_usage():
+    return get_storage().get_usage()
+
+
 def delete(path):
-    full_path = _get_full_path(path)
-    if os.path.exists(full_path):
-        os.unlink(full_path)
+    get_storage().delete(get_storage_key(path))
 
 
 def has(path):
-    return os.path.exists(_get_full_path(path))
+    return get_storage().has(get_storage_key(path))
 
 
 def move(source_path, target_path):
-    return os.rename(_get_full_path(source_path), _get_full_path(target_path))
+    get_storage().move(
+        get_storage_key(source_path), get_storage_key(target_path))
 
 
 def get(path):
-    full_path = _get_full_path(path)
-    if not os.path.exists(full_path):
-        return None
-    with open(full_path, 'rb') as handle:
-        return handle.read()
+    return get_storage().get(get_storage_key(path))
 
 
-def save(path, content):
-    full_path = _get_full_path(path)
-    os.makedirs(os.path.dirname(full_path), exist_ok=True)
-    with open(full_path, 'wb') as handle:
-        handle.write(content)
+def save(path, content, deduplicate=False):
+    '''
+    Store content under the path. With deduplicate, files in the data
+    directory with the same content share it, which suits contents that are
+    saved over and over, such as placeholders.
+    '''
+    get_storage().save(get_storage_key(path), content, deduplicate)
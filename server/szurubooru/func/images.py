@@ -1,10 +1,18 @@
+import io
+import os
 import logging
 import json
 import shlex
 import subprocess
+import tempfile
 import math
-from szurubooru import errors
-from szurubooru.func import mime, util
+from szurubooru import config, errors
+from szurubooru.func import files, mime, util
+
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None  # pylint: disable=invalid-name
 
 
 logger = logging.getLogger(__name__)
@@ -14,17 +22,87 @@ _SCALE_FIT_FMT = \
     r'scale=iw*max({width}/iw\,{height}/ih):ih*max({width}/iw\,{height}/ih)'
 
 
+# format: (ffmpeg output options, Pillow format, whether it has transparency)
+_ENCODERS = {
+    'jpeg': (['-vcodec', 'mjpeg', '-f', 'image2', '-update', '1'],
+             'JPEG', False),
+    'png': (['-vcodec', 'png', '-f', 'image2', '-update', '1'], 'PNG', True),
+    'webp': (['-vcodec', 'libwebp', '-f', 'webp'], 'WEBP', True),
+    # the fastest preset is still good enough for thumbnails
+    'avif': (['-vcodec', 'libaom-av1', '-still-picture', '1',
+              '-cpu-used', '8', '-f', 'avif'], 'AVIF', True),
+}
+
+
+def get_formats():
+    return list(sorted(_ENCODERS.keys()))
+
+
+def _can_pillow_encode(image_format):
+    # registers all the plugins, if it hasn't been done yet
+    PIL.Image.init()
+    return _ENCODERS[image_format][1] in PIL.Image.SAVE
+
+
+def _is_pillow_enabled():
+    thumbnails_config = config.config.get('thumbnails') or {}
+    return PIL is not None and thumbnails_config.get('backend') == 'pillow'
+
+
 class Image(object):
-    def __init__(self, content):
+    '''
+    Still frame of an image, animation or video, processed with ffmpeg.
+
+    The input is probed once, when its properties are first needed.
+    Transformations such as resize_fill are only recorded, and are applied
+    together with the encoding by a single ffmpeg run in to_png or to_jpeg.
+    If path (or a files.TemporaryFile) is given, ffmpeg reads the file in
+    place instead of a temporary copy of the content.
+
+    With the "pillow" backend enabled in the config, still JPEG, PNG and GIF
+    images are handled in-process by Pillow instead, which only has to read
+    the headers to tell the dimensions. Everything else, as well as images
+    Pillow fails to open, still goes through ffmpeg.
+    '''
+
+    def __init__(self, content=None, path=None):
+        assert content or path
+        if isinstance(content, files.TemporaryFile):
+            content, path = None, content.path
         self.content = content
-        self._reload_info()
+        self.path = path
+        self._info = None
+        self._filters = []
+        self._seek_time = None
+        self._size = None
+        self._pillow_image = None
+        if _is_pillow_enabled():
+            self._pillow_image = self._open_with_pillow()
+
+    @property
+    def backend(self):
+        return 'pillow' if self._pillow_image else 'ffmpeg'
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = self._probe()
+        return self._info
 
     @property
     def width(self):
+        if self._size:
+            return self._size[0]
+        if self._pillow_image:
+            return self._pillow_image.width
         return self.info['streams'][0]['width']
 
     @property
     def height(self):
+        if self._size:
+            return self._size[1]
+        if self._pillow_image:
+            return self._pillow_image.height
         return self.info['streams'][0]['height']
 
     @property
@@ -32,79 +110,261 @@ class Image(object):
         return self.info['streams'][0]['nb_read_frames']
 
     def resize_fill(self, width, height):
-        cli = [
-            '-i', '{path}',
-            '-f', 'image2',
-            '-vf', _SCALE_FIT_FMT.format(width=width, height=height),
+        self._choose_frame()
+        self._size = self._get_fill_size(width, height)
+        self._filters.append(
+            _SCALE_FIT_FMT.format(width=width, height=height))
+
+    def to_gray_pixels(self, width, height):
+        '''
+        Return the frame squeezed to exactly width x height, as raw 8-bit
+        grayscale pixels, row by row.
+        '''
+        if self._pillow_image:
+            return self._render_gray_with_pillow(width, height)
+        self._choose_frame()
+        cli = self._get_input_cli() + [
+            '-vf', ','.join(self._filters + [
+                'scale=%d:%d:flags=area' % (width, height),
+                'format=gray',
+            ]),
+            '-f', 'rawvideo',
             '-vframes', '1',
-            '-vcodec', 'png',
+            '-pix_fmt', 'gray',
             '-',
         ]
-        if 'duration' in self.info['format'] \
-                and self.info['format']['format_name'] != 'swf':
-            duration = float(self.info['format']['duration'])
-            if duration > 3:
-                cli = [
-                    '-ss',
-                    '%d' % math.floor(duration * 0.3),
-                ] + cli
-        self.content = self._execute(cli)
-        assert self.content
-        self._reload_info()
+        return self._execute(cli)
+
+    def to_variants(self, variants):
+        '''
+        Encode the frame in several sizes and formats, decoding it only once.
+        variants is a list of (width, height, format) tuples: the frame is
+        scaled to fill width x height like with resize_fill, and encoded in
+        one of the formats from get_formats(). Return list of the encoded
+        images in the same order, with None in place of variants that failed
+        to encode, e.g. because ffmpeg was built without their encoder.
+        '''
+        for _width, _height, image_format in variants:
+            if image_format not in _ENCODERS:
+                raise errors.ProcessingError(
+                    'Unknown image format: %r.' % image_format)
+        if self._pillow_image and all(
+                _can_pillow_encode(image_format)
+                for _width, _height, image_format in variants):
+            return self._render_variants_with_pillow(variants)
+        self._choose_frame()
+        try:
+            return self._render_variants(variants)
+        except errors.ProcessingError as ex:
+            if len(variants) == 1:
+                raise
+            error = ex
+        # a single failing output fails the whole run, so find out which
+        outputs = []
+        for variant in variants:
+            try:
+                outputs += self._render_variants([variant])
+            except errors.ProcessingError:
+                outputs.append(None)
+        if all(output is None for output in outputs):
+            raise error
+        return outputs
+
+    def _render_variants(self, variants):
+        graph = ['[0:v]split=%d%s' % (
+            len(variants),
+            ''.join('[s%d]' % i for i in range(len(variants))))]
+        for i, (width, height, image_format) in enumerate(variants):
+            width, height = self._get_fill_size(width, height)
+            if _ENCODERS[image_format][2]:
+                graph.append('[s%d]scale=%d:%d[v%d]' % (i, width, height, i))
+                continue
+            # no transparency, so paste the frame onto white background
+            graph += [
+                '[s%d]scale=%d:%d[f%d]' % (i, width, height, i),
+                'color=white:s=%dx%d[b%d]' % (width, height, i),
+                '[b%d][f%d]overlay=shortest=1[v%d]' % (i, i, i),
+            ]
+        cli = self._get_input_cli() + ['-filter_complex', ';'.join(graph)]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            paths = []
+            for i, (_width, _height, image_format) in enumerate(variants):
+                paths.append(os.path.join(temp_dir, str(i)))
+                cli += ['-map', '[v%d]' % i, '-vframes', '1'] \
+                    + _ENCODERS[image_format][0] + [paths[-1]]
+            self._execute(cli)
+            outputs = []
+            for path in paths:
+                with open(path, 'rb') as handle:
+                    outputs.append(handle.read())
+            return outputs
 
     def to_png(self):
-        return self._execute([
-            '-i', '{path}',
-            '-f', 'image2',
-            '-vframes', '1',
-            '-vcodec', 'png',
-            '-',
-        ])
+        if self._pillow_image:
+            return self._render_with_pillow('PNG')
+        cli = self._get_input_cli()
+        if self._filters:
+            cli += ['-vf', ','.join(self._filters)]
+        return self._execute(cli + self._get_output_cli('png'))
 
     def to_jpeg(self):
-        return self._execute([
+        if self._pillow_image:
+            return self._render_with_pillow('JPEG')
+        # JPEG has no transparency, so paste the frame onto white background
+        cli = self._get_input_cli() + [
             '-f', 'lavfi',
             '-i', 'color=white:s=%dx%d' % (self.width, self.height),
-            '-i', '{path}',
+            '-filter_complex', '[0:v]%s[fg];[1:v][fg]overlay' % (
+                ','.join(self._filters or ['null'])),
+        ]
+        return self._execute(cli + self._get_output_cli('mjpeg'))
+
+    def _get_fill_size(self, width, height):
+        if not self.width or not self.height:
+            raise errors.ProcessingError('Image has no dimensions.')
+        # mimics how ffmpeg evaluates the scale filter expressions
+        ratio = max(width / self.width, height / self.height)
+        return (int(self.width * ratio), int(self.height * ratio))
+
+    def _choose_frame(self):
+        # skip the intros of longer videos
+        if not self._pillow_image \
+                and self._seek_time is None \
+                and 'duration' in self.info['format'] \
+                and self.info['format']['format_name'] != 'swf':
+            duration = float(self.info['format']['duration'])
+            if duration > 3:
+                self._seek_time = math.floor(duration * 0.3)
+
+    def _open_with_pillow(self):
+        if self.content:
+            header = self.content[0:16]
+        else:
+            with open(self.path, 'rb') as handle:
+                header = handle.read(16)
+        if not mime.is_image(mime.get_mime_type(header)):
+            return None
+        try:
+            image = PIL.Image.open(
+                io.BytesIO(self.content) if self.content else self.path)
+        except (OSError, ValueError, PIL.Image.DecompressionBombError):
+            return None
+        if getattr(image, 'is_animated', False) or not image.width:
+            return None
+        return image
+
+    def _render_with_pillow(self, image_format):
+        image = self._pillow_image
+        try:
+            if self._size and image.format == 'JPEG':
+                # let the decoder downscale by a power of two while decoding
+                image.draft('RGB', self._size)
+            image = image.convert('RGBA')
+            if self._size:
+                image = image.resize(self._size, PIL.Image.BICUBIC)
+            if image_format == 'JPEG':
+                # JPEG has no transparency, so paste the image onto white
+                image = PIL.Image.alpha_composite(
+                    PIL.Image.new('RGBA', image.size, 'white'), image) \
+                    .convert('RGB')
+            output = io.BytesIO()
+            image.save(output, format=image_format)
+        except (OSError, ValueError, PIL.Image.DecompressionBombError) as ex:
+            raise errors.ProcessingError(
+                'Error while processing image.\n' + str(ex))
+        return output.getvalue()
+
+    def _render_variants_with_pillow(self, variants):
+        image = self._pillow_image
+        sizes = [
+            self._get_fill_size(width, height)
+            for width, height, _image_format in variants]
+        outputs = []
+        try:
+            if image.format == 'JPEG':
+                # the decoder can only downscale once, so do it for the
+                # largest variant
+                image.draft('RGB', max(sizes))
+            image = image.convert('RGBA')
+            for size, (_width, _height, image_format) in zip(sizes, variants):
+                variant = image.resize(size, PIL.Image.BICUBIC)
+                _options, pillow_format, has_transparency = \
+                    _ENCODERS[image_format]
+                if not has_transparency:
+                    variant = PIL.Image.alpha_composite(
+                        PIL.Image.new('RGBA', variant.size, 'white'),
+                        variant).convert('RGB')
+                output = io.BytesIO()
+                variant.save(output, format=pillow_format)
+                outputs.append(output.getvalue())
+        except (OSError, ValueError, PIL.Image.DecompressionBombError) as ex:
+            raise errors.ProcessingError(
+                'Error while processing image.\n' + str(ex))
+        return outputs
+
+    def _render_gray_with_pillow(self, width, height):
+        image = self._pillow_image
+        try:
+            if image.format == 'JPEG':
+                image.draft('L', (width, height))
+            image = image.convert('L').resize((width, height), PIL.Image.BOX)
+        except (OSError, ValueError, PIL.Image.DecompressionBombError) as ex:
+            raise errors.ProcessingError(
+                'Error while processing image.\n' + str(ex))
+        return image.tobytes()
+
+    def _get_input_cli(self):
+        cli = []
+        if self._seek_time:
+            cli += ['-ss', '%d' % self._seek_time]
+        return cli + ['-i', '{path}']
+
+    def _get_output_cli(self, codec):
+        return [
             '-f', 'image2',
-            '-filter_complex', 'overlay',
             '-vframes', '1',
-            '-vcodec', 'mjpeg',
+            '-vcodec', codec,
             '-',
-        ])
+        ]
 
     def _execute(self, cli, program='ffmpeg'):
+        if self.path:
+            return self._execute_on_path(cli, program, self.path)
         extension = mime.get_extension(mime.get_mime_type(self.content))
         assert extension
         with util.create_temp_file(suffix='.' + extension) as handle:
             handle.write(self.content)
             handle.flush()
-            cli = [program, '-loglevel', '24'] + cli
-            cli = [part.format(path=handle.name) for part in cli]
-            proc = subprocess.Popen(
-                cli,
-                stdout=subprocess.PIPE,
-                stdin=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-            out, err = proc.communicate(input=self.content)
-            if proc.returncode != 0:
-                logger.warning(
-                    'Failed to execute ffmpeg command (cli=%r, err=%r)',
-                    ' '.join(shlex.quote(arg) for arg in cli),
-                    err)
-                raise errors.ProcessingError(
-                    'Error while processing image.\n' + err.decode('utf-8'))
-            return out
+            return self._execute_on_path(cli, program, handle.name)
+
+    def _execute_on_path(self, cli, program, path):
+        cli = [program, '-loglevel', '24'] + cli
+        cli = [part.format(path=path) for part in cli]
+        proc = subprocess.Popen(
+            cli,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            logger.warning(
+                'Failed to execute ffmpeg command (cli=%r, err=%r)',
+                ' '.join(shlex.quote(arg) for arg in cli),
+                err)
+            raise errors.ProcessingError(
+                'Error while processing image.\n' + err.decode('utf-8'))
+        return out
 
-    def _reload_info(self):
-        self.info = json.loads(self._execute([
+    def _probe(self):
+        info = json.loads(self._execute([
             '-i', '{path}',
             '-of', 'json',
             '-select_streams', 'v',
             '-show_format',
             '-show_streams',
         ], program='ffprobe').decode('utf-8'))
-        assert 'format' in self.info
-        assert 'streams' in self.info
-        if len(self.info['streams']) != 1:
+        assert 'format' in info
+        assert 'streams' in info
+        if len(info['streams']) != 1:
             raise errors.ProcessingError('Multiple video streams detected.')
+        return info
@@ -0,0 +1,116 @@
+'''
+Common parts of in-process indexes mirroring database contents.
+
+Every transaction that changes the mirrored data bumps a generation counter
+stored in the database, and each lookup checks it first, so changes made by
+other server processes are never missed. Changes committed through this
+process are applied to the index directly, as long as no other transaction
+got in between; otherwise the whole index is loaded again.
+
+Within the server, loading happens in a background thread and lookups made
+in the meantime return None, so that callers can fall back to plain SQL.
+Elsewhere, e.g. in scripts and tests, the index is loaded on first use.
+'''
+
+import contextlib
+import logging
+import threading
+from szurubooru import db
+
+
+logger = logging.getLogger(__name__)
+
+
+class LoadableIndex(object):
+    # name of the generation counter in the database
+    name = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = None
+        self._generation = None
+        self._in_background = False
+        self._loader = None
+
+    def _load(self, session):
+        ''' Return contents of the index, read through given session. '''
+        raise NotImplementedError()
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+            self._generation = None
+
+    def load(self, session):
+        '''
+        Load contents of the index within the current transaction of given
+        session. The generation is read before the contents and stored along
+        with them, so a transaction committed in between leaves the contents
+        newer than their generation rather than the other way round; the next
+        lookup then sees a newer generation and loads them again.
+        '''
+        generation = db.get_index_generation(session, self.name)
+        data = self._load(session)
+        with self._lock:
+            if self._generation is None or self._generation < generation:
+                self._data = data
+                self._generation = generation
+
+    def start_loading(self):
+        ''' Load the index now and whenever it gets stale in background. '''
+        self._in_background = True
+        self._start_loader()
+
+    def _start_loader(self):
+        with self._lock:
+            if self._loader and self._loader.is_alive():
+                return
+            self._loader = threading.Thread(target=self._run_loader)
+            self._loader.daemon = True
+            self._loader.start()
+
+    def _run_loader(self):
+        try:
+            self.load(db.session)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to load %s', self.name)
+        finally:
+            db.session.remove()
+
+    def _is_current(self, generation):
+        return self._generation is not None and self._generation >= generation
+
+    @contextlib.contextmanager
+    def _locked_data(self, session):
+        '''
+        Hold the lock over current contents of the index, which are None
+        while they're being loaded in background.
+        '''
+        generation = db.get_index_generation(session, self.name)
+        with self._lock:
+            is_current = self._is_current(generation)
+        if not is_current:
+            if self._in_background:
+                self._start_loader()
+            else:
+                self.load(session)
+        with self._lock:
+            yield self._data if self._is_current(generation) else None
+
+    def apply_committed(self, generations, apply):
+        '''
+        Apply changes of a committed transaction that bumped the generation
+        to given values by calling apply() with the loaded contents, if they
+        were current right before the transaction.
+        '''
+        if not generations:
+            return
+        generations = sorted(generations)
+        with self._lock:
+            if self._data is None \
+                    or generations != list(range(
+                        self._generation + 1,
+                        self._generation + 1 + len(generations))):
+                return
+            apply(self._data)
+            self._generation = generations[-1]
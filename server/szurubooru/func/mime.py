@@ -1,4 +1,8 @@
-import re
+import io
+
+
+# enough to tell all the supported types apart
+_HEADER_SIZE = 12
 
 
 def get_mime_type(content):
@@ -26,6 +30,14 @@ def get_mime_type(content):
     return 'application/octet-stream'
 
 
+def get_mime_type_from_file(handle):
+    ''' Sniff the type from the first bytes, then rewind the file. '''
+    position = handle.tell()
+    header = handle.read(_HEADER_SIZE)
+    handle.seek(position)
+    return get_mime_type(header)
+
+
 def get_extension(mime_type):
     extension_map = {
         'application/x-shockwave-flash': 'swf',
@@ -51,6 +63,67 @@ def is_image(mime_type):
     return mime_type.lower() in ('image/jpeg', 'image/png', 'image/gif')
 
 
+def _skip_gif_sub_blocks(handle):
+    while True:
+        size = handle.read(1)
+        if not size:
+            return False
+        if not size[0]:
+            return True
+        if len(handle.read(size[0])) < size[0]:
+            return False
+
+
+def _skip_gif_color_table(handle, flags):
+    if flags & 0x80:
+        size = 3 * 2 ** ((flags & 0x07) + 1)
+        return len(handle.read(size)) == size
+    return True
+
+
+def _has_multiple_gif_frames(handle):
+    # header and logical screen descriptor
+    header = handle.read(13)
+    if len(header) < 13 or not _skip_gif_color_table(handle, header[10]):
+        return False
+    frames = 0
+    while True:
+        introducer = handle.read(1)
+        if introducer == b'\x2C':
+            frames += 1
+            if frames > 1:
+                return True
+            descriptor = handle.read(9)
+            if len(descriptor) < 9 \
+                    or not _skip_gif_color_table(handle, descriptor[8]):
+                return False
+            # LZW minimum code size, followed by the image data
+            if not handle.read(1):
+                return False
+        elif introducer == b'\x21':
+            # extension label, followed by the extension data
+            if not handle.read(1):
+                return False
+        else:
+            # trailer, end of file or garbage
+            return False
+        if not _skip_gif_sub_blocks(handle):
+            return False
+
+
 def is_animated_gif(content):
     return get_mime_type(content) == 'image/gif' \
-        and len(re.findall(b'\x21\xF9\x04.{4}\x00[\x2C\x21]', content)) > 1
+        and _has_multiple_gif_frames(io.BytesIO(content))
+
+
+def is_animated_gif_from_file(handle):
+    '''
+    Walk GIF blocks until the second frame, without reading the file into
+    memory, then rewind the file.
+    '''
+    position = handle.tell()
+    try:
+        return get_mime_type_from_file(handle) == 'image/gif' \
+            and _has_multiple_gif_frames(handle)
+    finally:
+        handle.seek(position)
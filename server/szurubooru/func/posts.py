@@ -1,8 +1,16 @@
 import datetime
+import logging
 import sqlalchemy
 from szurubooru import config, db, errors
 from szurubooru.func import (
-    users, scores, comments, tags, util, mime, images, files)
+    users, scores, comments, tags, util, mime, images, files, dimensions,
+    similarity, thumbnail_queue)
+
+
+logger = logging.getLogger(__name__)
+
+
+_HEADER_SIZE = 64 * 1024
 
 
 EMPTY_PIXEL = \
@@ -77,17 +85,57 @@ FLAG_MAP = {
 
 def get_post_content_url(post):
     assert post
-    return '%s/posts/%d.%s' % (
-        config.config['data_url'].rstrip('/'),
-        post.post_id,
-        mime.get_extension(post.mime_type) or 'dat')
+    return files.get_url(get_post_content_path(post))
 
 
 def get_post_thumbnail_url(post):
     assert post
-    return '%s/generated-thumbnails/%d.jpg' % (
-        config.config['data_url'].rstrip('/'),
-        post.post_id)
+    return files.get_url(get_post_thumbnail_path(post))
+
+
+_THUMBNAIL_EXTENSIONS = {
+    'jpeg': 'jpg',
+    'png': 'png',
+    'webp': 'webp',
+    'avif': 'avif',
+}
+_DEFAULT_THUMBNAIL_VARIANT = '1x-jpeg'
+
+
+def get_thumbnail_variants():
+    '''
+    Return list of (name, scale, format) of the configured post thumbnail
+    variants, other than the default thumbnail.
+    '''
+    variants = []
+    thumbnails_config = config.config.get('thumbnails') or {}
+    for variant in thumbnails_config.get('post_variants') or []:
+        scale = float(variant.get('scale') or 1)
+        image_format = (variant.get('format') or 'jpeg').lower()
+        if image_format not in _THUMBNAIL_EXTENSIONS or scale <= 0:
+            raise errors.ConfigError(
+                'Invalid post thumbnail variant: %r.' % variant)
+        name = '%gx-%s' % (scale, image_format)
+        if name != _DEFAULT_THUMBNAIL_VARIANT:
+            variants.append((name, scale, image_format))
+    return variants
+
+
+def get_post_thumbnail_variant_path(post, variant):
+    assert post
+    name, _scale, image_format = variant
+    return 'generated-thumbnails/%s/%d.%s' % (
+        name, post.post_id, _THUMBNAIL_EXTENSIONS[image_format])
+
+
+def get_post_thumbnail_variant_urls(post):
+    ''' Return URLs of the post thumbnail, including variants, by name. '''
+    assert post
+    urls = {_DEFAULT_THUMBNAIL_VARIANT: get_post_thumbnail_url(post)}
+    for variant in get_thumbnail_variants():
+        urls[variant[0]] = files.get_url(
+            get_post_thumbnail_variant_path(post, variant))
+    return urls
 
 
 def get_post_content_path(post):
@@ -133,6 +181,8 @@ def serialize_post(post, auth_user, options=None):
             'canvasHeight': lambda: post.canvas_height,
             'contentUrl': lambda: get_post_content_url(post),
             'thumbnailUrl': lambda: get_post_thumbnail_url(post),
+            'thumbnailVariants':
+                lambda: get_post_thumbnail_variant_urls(post),
             'flags': lambda: post.flags,
             'tags': lambda: [
                 tag.names[0].name for tag in tags.sort_tags(post.tags)],
@@ -217,7 +267,18 @@ def try_get_featured_post():
     return post_feature.post if post_feature else None
 
 
-def create_post(content, tag_names, user):
+def get_post_ids_by_checksums(checksums):
+    ''' Return dictionary mapping given checksums to ids of their posts. '''
+    if not checksums:
+        return {}
+    return dict(
+        db.session
+        .query(db.Post.checksum, db.Post.post_id)
+        .filter(db.Post.checksum.in_(set(checksums)))
+        .all())
+
+
+def create_post(content, tag_names, user, check_for_duplicates=True):
     post = db.Post()
     post.safety = db.Post.SAFETY_SAFE
     post.user = user
@@ -229,7 +290,8 @@ def create_post(content, tag_names, user):
     post.mime_type = ''
     db.session.add(post)
 
-    update_post_content(post, content)
+    update_post_content(
+        post, content, check_for_duplicates=check_for_duplicates)
     new_tags = update_post_tags(post, tag_names)
     return (post, new_tags)
 
@@ -279,18 +341,71 @@ def _sync_post_content(post):
         regenerate_thumb = True
 
     if regenerate_thumb:
-        generate_post_thumbnail(post)
+        if thumbnail_queue.is_enabled():
+            _queue_post_thumbnail(post)
+        else:
+            generate_post_thumbnail(post)
 
 
-def update_post_content(post, content):
+def _save_placeholder_thumbnails(post, only_missing=False):
+    # browsers tell image formats by their contents, so the GIF will do for
+    # any of the variants
+    paths = [get_post_thumbnail_path(post)] + [
+        get_post_thumbnail_variant_path(post, variant)
+        for variant in get_thumbnail_variants()]
+    with files.batched_sync():
+        for path in paths:
+            if not only_missing or not files.has(path):
+                files.save(path, EMPTY_PIXEL, deduplicate=True)
+
+
+def _queue_post_thumbnail(post):
+    _save_placeholder_thumbnails(post, only_missing=True)
+    # workers must not see the post before it's committed
+    session = sqlalchemy.orm.object_session(post)
+    db.get_transaction_info(session) \
+        .setdefault('queued_thumbnails', set()) \
+        .add(post.post_id)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _after_commit(session):
+    post_ids = db.pop_committed_info(session, 'queued_thumbnails')
+    for post_id in sorted(post_ids or ()):
+        thumbnail_queue.add(post_id)
+
+
+def _read_header(content):
+    if isinstance(content, files.TemporaryFile):
+        return content.read(_HEADER_SIZE)
+    return content
+
+
+def get_content_checksum(content):
+    ''' Return SHA-1 of uploaded content, either bytes or a file. '''
+    if isinstance(content, files.TemporaryFile):
+        with content.open() as handle:
+            return util.get_sha1_from_file(handle)
+    return util.get_sha1(content)
+
+
+def _is_animated_gif(content):
+    if isinstance(content, files.TemporaryFile):
+        with content.open() as handle:
+            return mime.is_animated_gif_from_file(handle)
+    return mime.is_animated_gif(content)
+
+
+def update_post_content(post, content, check_for_duplicates=True):
     assert post
     if not content:
         raise InvalidPostContentError('Post content missing.')
-    post.mime_type = mime.get_mime_type(content)
+    header = _read_header(content)
+    post.mime_type = mime.get_mime_type(header)
     if mime.is_flash(post.mime_type):
         post.type = db.Post.TYPE_FLASH
     elif mime.is_image(post.mime_type):
-        if mime.is_animated_gif(content):
+        if _is_animated_gif(content):
             post.type = db.Post.TYPE_ANIMATION
         else:
             post.type = db.Post.TYPE_IMAGE
@@ -300,31 +415,100 @@ def update_post_content(post, content):
         raise InvalidPostContentError(
             'Unhandled file type: %r' % post.mime_type)
 
-    post.checksum = util.get_sha1(content)
-    other_post = db.session \
-        .query(db.Post) \
-        .filter(db.Post.checksum == post.checksum) \
-        .filter(db.Post.post_id != post.post_id) \
-        .one_or_none()
-    if other_post \
-            and other_post.post_id \
-            and other_post.post_id != post.post_id:
-        raise PostAlreadyUploadedError(other_post)
+    post.checksum = get_content_checksum(content)
+    if check_for_duplicates:
+        other_post = db.session \
+            .query(db.Post) \
+            .filter(db.Post.checksum == post.checksum) \
+            .filter(db.Post.post_id != post.post_id) \
+            .one_or_none()
+        if other_post \
+                and other_post.post_id \
+                and other_post.post_id != post.post_id:
+            raise PostAlreadyUploadedError(other_post)
 
     post.file_size = len(content)
-    try:
-        image = images.Image(content)
-        post.canvas_width = image.width
-        post.canvas_height = image.height
-    except errors.ProcessingError:
-        post.canvas_width = None
-        post.canvas_height = None
-    if post.canvas_width <= 0 or post.canvas_height <= 0:
+    # a header is enough unless the metadata is at the end, like in some
+    # MP4 files; these are left to ffprobe
+    size = dimensions.get_dimensions(header)
+    if not size:
+        try:
+            image = images.Image(content)
+            size = (image.width, image.height)
+        except errors.ProcessingError:
+            size = None
+    if size and size[0] > 0 and size[1] > 0:
+        post.canvas_width, post.canvas_height = size
+    else:
         post.canvas_width = None
         post.canvas_height = None
+    if similarity.is_enabled() and post.type != db.Post.TYPE_FLASH:
+        post.image_hash = similarity.get_image_hash(content)
+    else:
+        post.image_hash = None
     setattr(post, '__content', content)
 
 
+def _get_stored_file_source(path):
+    '''
+    Return content and path to process the stored file from: files in the
+    data directory are read in place, others have to be downloaded.
+    '''
+    local_path = files.get_local_path(path)
+    if local_path:
+        return None, local_path
+    content = files.get(path)
+    if not content:
+        raise errors.ProcessingError('File %r is missing.' % path)
+    return content, None
+
+
+def update_post_image_hash(post):
+    ''' Compute perceptual hash of the stored content of the post. '''
+    assert post
+    if post.type == db.Post.TYPE_FLASH:
+        post.image_hash = None
+        return
+    try:
+        content, path = _get_stored_file_source(get_post_content_path(post))
+    except errors.ProcessingError:
+        post.image_hash = None
+        return
+    post.image_hash = similarity.get_image_hash(content=content, path=path)
+
+
+def search_by_image_exact(content):
+    checksum = get_content_checksum(content)
+    return db.session \
+        .query(db.Post) \
+        .filter(db.Post.checksum == checksum) \
+        .one_or_none()
+
+
+def search_by_image(content):
+    '''
+    Return (distance, post) pairs of posts that look like the content,
+    closest first.
+    '''
+    similarity.verify_enabled()
+    image_hash = similarity.get_image_hash(content)
+    if not image_hash:
+        return []
+    matches = similarity.find_similar(image_hash)
+    if not matches:
+        return []
+    posts_by_id = {
+        post.post_id: post
+        for post in db.session
+        .query(db.Post)
+        .filter(db.Post.post_id.in_(
+            [post_id for post_id, _distance in matches]))}
+    return [
+        (distance, posts_by_id[post_id])
+        for post_id, distance in matches
+        if post_id in posts_by_id]
+
+
 def update_post_thumbnail(post, content=None):
     assert post
     setattr(post, '__thumbnail', content)
@@ -333,17 +517,58 @@ def update_post_thumbnail(post, content=None):
 def generate_post_thumbnail(post):
     assert post
     if files.has(get_post_thumbnail_backup_path(post)):
-        content = files.get(get_post_thumbnail_backup_path(post))
+        path = get_post_thumbnail_backup_path(post)
     else:
-        content = files.get(get_post_content_path(post))
+        path = get_post_content_path(post)
+    width = int(config.config['thumbnails']['post_width'])
+    height = int(config.config['thumbnails']['post_height'])
+    variants = get_thumbnail_variants()
     try:
-        image = images.Image(content)
-        image.resize_fill(
-            int(config.config['thumbnails']['post_width']),
-            int(config.config['thumbnails']['post_height']))
-        files.save(get_post_thumbnail_path(post), image.to_jpeg())
+        content, local_path = _get_stored_file_source(path)
+        image = images.Image(content=content, path=local_path)
+        if not variants:
+            image.resize_fill(width, height)
+            files.save(get_post_thumbnail_path(post), image.to_jpeg())
+            return
+        # all the variants come from a single decoding of the content
+        outputs = image.to_variants([(width, height, 'jpeg')] + [
+            (int(width * scale), int(height * scale), image_format)
+            for _name, scale, image_format in variants])
     except errors.ProcessingError:
-        files.save(get_post_thumbnail_path(post), EMPTY_PIXEL)
+        _save_placeholder_thumbnails(post)
+        return
+    paths = [get_post_thumbnail_path(post)] + [
+        get_post_thumbnail_variant_path(post, variant)
+        for variant in variants]
+    with files.batched_sync():
+        for path, output in zip(paths, outputs):
+            # keep serving the other variants if one failed to encode
+            if output is None:
+                files.save(path, EMPTY_PIXEL, deduplicate=True)
+            else:
+                files.save(path, output)
+
+
+def generate_queued_post_thumbnail():
+    '''
+    Generate thumbnail of the oldest post in the thumbnail queue. Return
+    False if there was nothing to do.
+    '''
+    job = thumbnail_queue.claim()
+    if not job:
+        return False
+    try:
+        post = try_get_post_by_id(job.post_id)
+        if post:
+            generate_post_thumbnail(post)
+    except Exception:
+        # keep the placeholder rather than retrying the post forever
+        logger.exception(
+            'Failed to generate thumbnail of post %d', job.post_id)
+    finally:
+        db.session.rollback()
+        thumbnail_queue.complete(job)
+    return True
 
 
 def update_post_tags(post, tag_names):
@@ -435,3 +660,19 @@ def feature_post(post, user):
 def delete(post):
     assert post
     db.session.delete(post)
+
+
+def get_post_ids_with_stale_counters():
+    expressions = db.post.get_counter_expressions()
+    condition = sqlalchemy.or_(*[
+        getattr(db.Post, name).is_distinct_from(expr.as_scalar())
+        for name, expr in expressions.items()])
+    return [
+        post_id for post_id, in db.session
+        .query(db.Post.post_id)
+        .filter(condition)
+        .order_by(db.Post.post_id.asc())]
+
+
+def update_post_counters(post_ids=None):
+    db.post.update_counters(db.session, post_ids)
@@ -0,0 +1,260 @@
+'''
+Perceptual hashes of post contents, and an in-process index for finding
+posts that look alike even though their files differ, e.g. because they were
+resized or re-encoded.
+
+The hash is a 64-bit difference hash (dHash) of a 9x8 grayscale frame, so
+similar images have hashes that differ in a few bits. The index splits each
+hash into four 16-bit chunks: two hashes within distance d must have at least
+one chunk within distance d // 4 of each other, so only the buckets of such
+chunks are looked at (multi-index hashing). With d below 8, that's 17 buckets
+per chunk; from 8 to 11, 137 of them.
+
+Like the tag index, it follows the changes committed through this process
+and is loaded again after changes made by other processes; until it's
+loaded, lookups compare the hash with all the others instead.
+'''
+
+import array
+import itertools
+import sqlalchemy
+from szurubooru import config, db, errors
+from szurubooru.func import images, loadable_index
+
+
+class SimilaritySearchDisabledError(errors.ValidationError):
+    pass
+
+
+def _get_config():
+    return config.config.get('similarity') or {}
+
+
+def is_enabled():
+    return bool(_get_config().get('enabled'))
+
+
+def get_max_distance():
+    return int(_get_config().get('max_distance', 7))
+
+
+def get_max_results():
+    return int(_get_config().get('max_results') or 100)
+
+
+def verify_enabled():
+    if not is_enabled():
+        raise SimilaritySearchDisabledError('Similarity search is disabled.')
+
+
+_HASH_WIDTH = 9
+_HASH_HEIGHT = 8
+
+
+def get_image_hash(content=None, path=None):
+    '''
+    Return perceptual hash of an image, animation or video as a hexadecimal
+    string, or None if it can't be processed.
+    '''
+    try:
+        pixels = images.Image(content=content, path=path) \
+            .to_gray_pixels(_HASH_WIDTH, _HASH_HEIGHT)
+    except errors.ProcessingError:
+        return None
+    if len(pixels) != _HASH_WIDTH * _HASH_HEIGHT:
+        return None
+    value = 0
+    for y in range(_HASH_HEIGHT):
+        row = pixels[y * _HASH_WIDTH:(y + 1) * _HASH_WIDTH]
+        for x in range(_HASH_WIDTH - 1):
+            value = (value << 1) | (row[x] > row[x + 1])
+    return '%016x' % value
+
+
+_CHUNKS = 4
+_CHUNK_BITS = 16
+_CHUNK_MASK = (1 << _CHUNK_BITS) - 1
+
+
+def _get_chunks(value):
+    return [
+        (value >> (i * _CHUNK_BITS)) & _CHUNK_MASK for i in range(_CHUNKS)]
+
+
+_FLIP_MASKS = {}
+
+
+def _get_flip_masks(distance):
+    ''' Return masks flipping up to distance bits of a chunk. '''
+    if distance not in _FLIP_MASKS:
+        masks = []
+        for count in range(min(distance, _CHUNK_BITS) + 1):
+            for bits in itertools.combinations(range(_CHUNK_BITS), count):
+                mask = 0
+                for bit in bits:
+                    mask |= 1 << bit
+                masks.append(mask)
+        _FLIP_MASKS[distance] = masks
+    return _FLIP_MASKS[distance]
+
+
+def _get_distance(value1, value2):
+    return bin(value1 ^ value2).count('1')
+
+
+def _create_buckets():
+    # for each chunk: chunk value -> (post ids, full hashes), and hash of each
+    # indexed post, so that it can be found again when the post changes
+    return [{} for _ in range(_CHUNKS)], {}
+
+
+def _remove(buckets, post_id):
+    chunk_buckets, values_by_post_id = buckets
+    value = values_by_post_id.pop(post_id, None)
+    if value is None:
+        return
+    for i, chunk in enumerate(_get_chunks(value)):
+        post_ids, values = chunk_buckets[i].get(chunk, ((), ()))
+        if post_id in post_ids:
+            pos = post_ids.index(post_id)
+            del post_ids[pos]
+            del values[pos]
+
+
+def _add(buckets, post_id, value):
+    _remove(buckets, post_id)
+    chunk_buckets, values_by_post_id = buckets
+    values_by_post_id[post_id] = value
+    for i, chunk in enumerate(_get_chunks(value)):
+        if chunk not in chunk_buckets[i]:
+            chunk_buckets[i][chunk] = (array.array('I'), array.array('Q'))
+        post_ids, values = chunk_buckets[i][chunk]
+        post_ids.append(post_id)
+        values.append(value)
+
+
+def _sort_matches(distances):
+    return sorted(distances.items(), key=lambda item: (item[1], item[0]))
+
+
+def _find(buckets, value, max_distance):
+    chunk_buckets, _values_by_post_id = buckets
+    masks = _get_flip_masks(max_distance // _CHUNKS)
+    distances = {}
+    for i, chunk in enumerate(_get_chunks(value)):
+        for mask in masks:
+            bucket = chunk_buckets[i].get(chunk ^ mask)
+            if not bucket:
+                continue
+            for post_id, other_value in zip(*bucket):
+                distance = _get_distance(value, other_value)
+                if distance <= max_distance:
+                    distances[post_id] = distance
+    return _sort_matches(distances)
+
+
+class SimilarityIndex(loadable_index.LoadableIndex):
+    name = 'similarity'
+
+    def _load(self, session):
+        buckets = _create_buckets()
+        for post_id, image_hash in session \
+                .query(db.Post.post_id, db.Post.image_hash) \
+                .filter(db.Post.image_hash.isnot(None)) \
+                .yield_per(10000):
+            _add(buckets, post_id, int(image_hash, 16))
+        return buckets
+
+    def find(self, session, image_hash, max_distance):
+        '''
+        Return (post_id, distance) pairs of posts whose hashes differ from
+        the given one in at most max_distance bits, closest first. Return
+        None if the index isn't available yet.
+        '''
+        with self._locked_data(session) as buckets:
+            if buckets is None:
+                return None
+            return _find(buckets, int(image_hash, 16), max_distance)
+
+    def apply_changes(self, generations, changes):
+        '''
+        Apply list of (post_id, new_hash) recorded by a committed
+        transaction.
+        '''
+        def apply(buckets):
+            for post_id, new_hash in changes:
+                if new_hash:
+                    _add(buckets, post_id, int(new_hash, 16))
+                else:
+                    _remove(buckets, post_id)
+        self.apply_committed(generations, apply)
+
+
+_INDEX = SimilarityIndex()
+
+
+def get_index():
+    return _INDEX
+
+
+def _scan(session, image_hash, max_distance):
+    value = int(image_hash, 16)
+    distances = {}
+    for post_id, other_hash in session \
+            .query(db.Post.post_id, db.Post.image_hash) \
+            .filter(db.Post.image_hash.isnot(None)) \
+            .yield_per(10000):
+        distance = _get_distance(value, int(other_hash, 16))
+        if distance <= max_distance:
+            distances[post_id] = distance
+    return _sort_matches(distances)
+
+
+def find_similar(image_hash, exclude_post_id=None):
+    '''
+    Return (post_id, distance) pairs of the posts closest to the hash, up to
+    the configured maximum distance and number of results.
+    '''
+    verify_enabled()
+    matches = _INDEX.find(db.session, image_hash, get_max_distance())
+    if matches is None:
+        matches = _scan(db.session, image_hash, get_max_distance())
+    return [
+        (post_id, distance) for post_id, distance in matches
+        if post_id != exclude_post_id][0:get_max_results()]
+
+
+def _get_pending(session):
+    info = db.get_transaction_info(session)
+    if 'similarity_changes' not in info:
+        info['similarity_changes'] = {'changes': [], 'generations': []}
+    return info['similarity_changes']
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def _after_flush(session, _flush_context):
+    if not is_enabled():
+        return
+    pending = _get_pending(session)
+    changes = pending['changes']
+    for entity in list(session.new) + list(session.dirty):
+        if not isinstance(entity, db.Post) or entity in session.deleted:
+            continue
+        history = sqlalchemy.inspect(entity).attrs.image_hash.history
+        if not history.has_changes():
+            continue
+        changes.append((entity.post_id, entity.image_hash))
+    for entity in session.deleted:
+        if isinstance(entity, db.Post):
+            changes.append((entity.post_id, None))
+    # once per transaction or savepoint, like in tag_index
+    if changes and not pending['generations']:
+        pending['generations'].append(
+            db.bump_index_generation(session, _INDEX.name))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _after_commit(session):
+    pending = db.pop_committed_info(session, 'similarity_changes')
+    if pending:
+        _INDEX.apply_changes(pending['generations'], pending['changes'])
@@ -137,11 +137,17 @@ def get_default_category(lock=False):
 
 
 def get_default_category_name():
-    if cache.has(DEFAULT_CATEGORY_NAME_CACHE_KEY):
+    try:
         return cache.get(DEFAULT_CATEGORY_NAME_CACHE_KEY)
+    except KeyError:
+        pass
+    generations = cache.get_generations()
     default_category = try_get_default_category()
     default_category_name = default_category.name if default_category else None
-    cache.put(DEFAULT_CATEGORY_NAME_CACHE_KEY, default_category_name)
+    cache.put(
+        DEFAULT_CATEGORY_NAME_CACHE_KEY,
+        default_category_name,
+        generations=generations)
     return default_category_name
 
 
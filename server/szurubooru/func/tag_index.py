@@ -0,0 +1,217 @@
+'''
+In-process inverted index mapping tags to the posts that use them. It lets
+post searches resolve combinations of plain tag names with set operations
+instead of running a subquery per tag.
+
+The index follows the changes committed through this process; changes made
+by other processes cause it to be loaded again (see loadable_index).
+'''
+
+import array
+import bisect
+import sqlalchemy
+from szurubooru import config, db
+from szurubooru.func import loadable_index
+
+
+def _get_config():
+    return config.config.get('tag_index') or {}
+
+
+def is_enabled():
+    return bool(_get_config().get('enabled'))
+
+
+def get_max_results():
+    return int(_get_config().get('max_results') or 5000)
+
+
+_EMPTY = array.array('I')
+
+
+def _contains(sorted_array, value):
+    pos = bisect.bisect_left(sorted_array, value)
+    return pos < len(sorted_array) and sorted_array[pos] == value
+
+
+def _intersect(sorted_arrays):
+    ''' Intersect sorted arrays, iterating over the shortest one. '''
+    sorted_arrays = sorted(sorted_arrays, key=len)
+    result = []
+    for value in sorted_arrays[0]:
+        for other in sorted_arrays[1:]:
+            pos = bisect.bisect_left(other, value)
+            if pos == len(other) or other[pos] != value:
+                break
+        else:
+            result.append(value)
+    return result
+
+
+class TagIndex(loadable_index.LoadableIndex):
+    name = 'tag_index'
+
+    def _load(self, session):
+        post_ids = {}
+        for tag_id, post_id in session \
+                .query(db.PostTag.tag_id, db.PostTag.post_id) \
+                .order_by(db.PostTag.tag_id, db.PostTag.post_id) \
+                .yield_per(10000):
+            if tag_id not in post_ids:
+                post_ids[tag_id] = array.array('I')
+            post_ids[tag_id].append(post_id)
+        tag_ids = {
+            name.lower(): tag_id
+            for tag_id, name
+            in session.query(db.TagName.tag_id, db.TagName.name)}
+        return post_ids, tag_ids
+
+    @staticmethod
+    def _get_post_ids(data, name):
+        post_ids, tag_ids = data
+        return post_ids.get(tag_ids.get(name.lower()), _EMPTY)
+
+    def get_post_ids(self, session, name):
+        with self._locked_data(session) as data:
+            if data is None:
+                return None
+            return list(self._get_post_ids(data, name))
+
+    def resolve(self, session, included, excluded):
+        '''
+        Return sorted list of posts that have at least one tag from each of
+        the included groups of tag names, and none of the excluded tags.
+        Return None if the index isn't available yet.
+        '''
+        assert included
+        with self._locked_data(session) as data:
+            if data is None:
+                return None
+            sorted_arrays = []
+            for names in included:
+                if len(names) == 1:
+                    sorted_arrays.append(self._get_post_ids(data, names[0]))
+                else:
+                    post_ids = set()
+                    for name in names:
+                        post_ids.update(self._get_post_ids(data, name))
+                    sorted_arrays.append(sorted(post_ids))
+            result = _intersect(sorted_arrays)
+            for name in excluded:
+                if not result:
+                    break
+                excluded_ids = self._get_post_ids(data, name)
+                result = [
+                    post_id for post_id in result
+                    if not _contains(excluded_ids, post_id)]
+            return result
+
+    def apply_changes(self, generations, changes):
+        '''
+        Apply changes recorded by a committed transaction: lists of
+        (tag_id, post_id) pairs and of (name, tag_id) pairs.
+        '''
+        def apply(data):
+            post_ids_by_tag, tag_ids = data
+            for tag_id, post_id in changes['removed']:
+                post_ids = post_ids_by_tag.get(tag_id)
+                if post_ids is None:
+                    continue
+                pos = bisect.bisect_left(post_ids, post_id)
+                if pos < len(post_ids) and post_ids[pos] == post_id:
+                    del post_ids[pos]
+            for tag_id, post_id in changes['added']:
+                if tag_id not in post_ids_by_tag:
+                    post_ids_by_tag[tag_id] = array.array('I')
+                post_ids = post_ids_by_tag[tag_id]
+                pos = bisect.bisect_left(post_ids, post_id)
+                if pos == len(post_ids) or post_ids[pos] != post_id:
+                    post_ids.insert(pos, post_id)
+            for name, tag_id in changes['removed_names']:
+                if tag_ids.get(name.lower()) == tag_id:
+                    del tag_ids[name.lower()]
+            for name, tag_id in changes['added_names']:
+                tag_ids[name.lower()] = tag_id
+        self.apply_committed(generations, apply)
+
+
+_INDEX = TagIndex()
+
+
+def get_index():
+    return _INDEX
+
+
+def _get_pending(session):
+    info = db.get_transaction_info(session)
+    if 'tag_index_changes' not in info:
+        info['tag_index_changes'] = {
+            'added': [],
+            'removed': [],
+            'added_names': [],
+            'removed_names': [],
+            'generations': [],
+            'all': False,
+        }
+    return info['tag_index_changes']
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'before_flush')
+def _before_flush(session, _flush_context, _instances):
+    if not is_enabled():
+        return
+    pending = _get_pending(session)
+    deleted_post_ids = []
+    for entity in session.deleted:
+        if isinstance(entity, db.Post):
+            deleted_post_ids.append(entity.post_id)
+        elif isinstance(entity, db.Tag):
+            pending['all'] = True
+    if deleted_post_ids:
+        pending['removed'].extend(
+            session
+            .query(db.PostTag.tag_id, db.PostTag.post_id)
+            .filter(db.PostTag.post_id.in_(deleted_post_ids))
+            .all())
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def _after_flush(session, _flush_context):
+    if not is_enabled():
+        return
+    pending = _get_pending(session)
+    for entity in list(session.new) + list(session.dirty) \
+            + list(session.deleted):
+        if isinstance(entity, db.TagName):
+            if entity in session.deleted:
+                pending['removed_names'].append(
+                    (entity.name, entity.tag_id))
+                continue
+            history = sqlalchemy.inspect(entity).attrs.name.history
+            for name in history.deleted or ():
+                pending['removed_names'].append((name, entity.tag_id))
+            if entity in session.new or history.has_changes():
+                pending['added_names'].append((entity.name, entity.tag_id))
+        elif isinstance(entity, db.Post) and entity not in session.deleted:
+            history = sqlalchemy.inspect(entity).attrs.tags.history
+            for tag in history.added or ():
+                pending['added'].append((tag.tag_id, entity.post_id))
+            for tag in history.deleted or ():
+                pending['removed'].append((tag.tag_id, entity.post_id))
+    # bump the generation once per transaction (or savepoint) with changes
+    if not pending['generations'] and (pending['all'] or any(
+            pending[key] for key in (
+                'added', 'removed', 'added_names', 'removed_names'))):
+        pending['generations'].append(
+            db.bump_index_generation(session, _INDEX.name))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _after_commit(session):
+    pending = db.pop_committed_info(session, 'tag_index_changes')
+    if not pending:
+        return
+    if pending['all']:
+        _INDEX.invalidate()
+        return
+    _INDEX.apply_changes(pending['generations'], pending)
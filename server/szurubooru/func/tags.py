@@ -1,10 +1,24 @@
+import contextlib
 import datetime
+import fcntl
+import gzip
 import json
+import logging
 import os
 import re
+import threading
+import time
 import sqlalchemy
 from szurubooru import config, db, errors
-from szurubooru.func import util, tag_categories
+from szurubooru.func import util, tag_categories, cache, files
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # pylint: disable=invalid-name
+
+
+logger = logging.getLogger(__name__)
 
 
 class TagNotFoundError(errors.NotFoundError):
@@ -91,7 +105,11 @@ def serialize_tag(tag, options=None):
         options)
 
 
-def export_to_json():
+def _get_export_config():
+    return config.config.get('tag_export') or {}
+
+
+def _collect_export_data():
     tags = {}
     categories = {}
 
@@ -132,14 +150,189 @@ def export_to_json():
         tags[result[0]]['category'] = categories[result[1]]['name']
         tags[result[0]]['usages'] = result[2]
 
-    output = {
+    return {
         'categories': list(categories.values()),
         'tags': list(tags.values()),
     }
 
+
+def _read_previous_export(export_path):
+    try:
+        with open(export_path, 'r') as handle:
+            return json.loads(handle.read())
+    except (IOError, ValueError):
+        return None
+
+
+def _create_delta(previous_output, output):
+    previous_tags = {
+        tag['names'][0]: tag for tag in previous_output.get('tags', [])}
+    current_tags = {tag['names'][0]: tag for tag in output['tags']}
+    return {
+        'version': output['version'],
+        'baseVersion': previous_output.get('version', 0),
+        'categories': output['categories'],
+        'tags': [
+            tag for name, tag in current_tags.items()
+            if previous_tags.get(name) != tag],
+        'removedTags': [
+            name for name in previous_tags if name not in current_tags],
+    }
+
+
+def _get_compressors():
+    compressors = {'gzip': ('.gz', lambda data: gzip.compress(data, 9))}
+    if brotli:
+        compressors['br'] = ('.br', brotli.compress)
+    return compressors
+
+
+def _write_artifacts(output, content):
+    '''
+    Write compressed variants of the export, as well as a copy named after
+    its checksum that can be cached forever, and a manifest pointing to it.
+    The delta version is left out of the copy and recorded in the manifest
+    instead, so that its name only changes along with the tags.
+    Files belonging to older exports are removed, except for the previous
+    one, which clients may still be downloading.
+    '''
+    data_dir = config.config['data_dir']
+    manifest_path = os.path.join(data_dir, 'tags-manifest.json')
+    unversioned_output = {
+        key: value for key, value in output.items() if key != 'version'}
+    hashed_content = json.dumps(
+        unversioned_output, separators=(',', ':')).encode('utf-8')
+    checksum = util.get_sha1(hashed_content)[:16]
+    hashed_name = 'tags.%s.json' % checksum
+
+    previous_manifest = _read_previous_export(manifest_path) or {}
+    kept_names = {hashed_name, previous_manifest.get('path')}
+
+    manifest = {
+        'path': hashed_name,
+        'checksum': checksum,
+        'size': len(hashed_content),
+        'encodings': {},
+    }
+    if 'version' in output:
+        manifest['version'] = output['version']
+    files.write_atomically(
+        os.path.join(data_dir, hashed_name), hashed_content)
+    for encoding, (suffix, compress) in _get_compressors().items():
+        files.write_atomically(
+            os.path.join(data_dir, 'tags.json' + suffix),
+            compress(content.encode('utf-8')))
+        compressed_content = compress(hashed_content)
+        files.write_atomically(
+            os.path.join(data_dir, hashed_name + suffix), compressed_content)
+        manifest['encodings'][encoding] = {
+            'path': hashed_name + suffix,
+            'size': len(compressed_content),
+        }
+    files.write_atomically(
+        manifest_path,
+        json.dumps(manifest, separators=(',', ':')).encode('utf-8'))
+
+    for name in os.listdir(data_dir):
+        match = re.match(r'^(tags\.[0-9a-f]+\.json)(\.gz|\.br)?$', name)
+        if match and match.group(1) not in kept_names:
+            os.unlink(os.path.join(data_dir, name))
+
+
+@contextlib.contextmanager
+def _export_lock():
+    '''
+    Hold an exclusive lock on a file in the data directory, so that exports
+    running in different server processes don't overwrite each other's
+    files or hand out the same delta version twice.
+    '''
+    lock_path = os.path.join(config.config['data_dir'], 'tags.lock')
+    with open(lock_path, 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def _export_to_json():
+    with _export_lock():
+        _export_to_json_unlocked()
+
+
+def _export_to_json_unlocked():
+    output = _collect_export_data()
     export_path = os.path.join(config.config['data_dir'], 'tags.json')
-    with open(export_path, 'w') as handle:
-        handle.write(json.dumps(output, separators=(',', ':')))
+    export_config = _get_export_config()
+
+    if export_config.get('delta'):
+        previous_output = _read_previous_export(export_path)
+        output['version'] = (previous_output or {}).get('version', 0) + 1
+        if previous_output:
+            files.write_atomically(
+                os.path.join(config.config['data_dir'], 'tags-delta.json'),
+                json.dumps(
+                    _create_delta(previous_output, output),
+                    separators=(',', ':')).encode('utf-8'))
+
+    content = json.dumps(output, separators=(',', ':'))
+    files.write_atomically(export_path, content.encode('utf-8'))
+    if export_config.get('artifacts'):
+        _write_artifacts(output, content)
+
+
+class _ExportScheduler(object):
+    '''
+    Runs the export in a background thread once no changes have been
+    reported for a while, so that a burst of edits costs a single export.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self._timer = None
+        self._deadline = None
+
+    def schedule(self, delay, max_delay):
+        with self._lock:
+            now = time.time()
+            if self._deadline is None:
+                self._deadline = now + max(delay, max_delay)
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(
+                max(0, min(delay, self._deadline - now)), self._run)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _run(self):
+        with self._lock:
+            self._timer = None
+            self._deadline = None
+        with self._export_lock:
+            try:
+                _export_to_json()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Failed to export tags')
+            finally:
+                db.session.remove()
+
+
+_export_scheduler = _ExportScheduler()
+
+
+def export_to_json():
+    '''
+    Export tags to tags.json. If configured, the export is postponed and
+    done in the background; changes reported in the meantime are coalesced.
+    '''
+    export_config = _get_export_config()
+    delay = float(export_config.get('delay') or 0)
+    if delay > 0:
+        _export_scheduler.schedule(
+            delay, float(export_config.get('max_delay') or 0))
+    else:
+        _export_to_json()
 
 
 def try_get_tag_by_name(name):
@@ -161,32 +354,66 @@ def get_tags_by_names(names):
     names = util.icase_unique(names)
     if len(names) == 0:
         return []
-    expr = sqlalchemy.sql.false()
-    for name in names:
-        expr = expr | (sqlalchemy.func.lower(db.TagName.name) == name.lower())
-    return db.session.query(db.Tag).join(db.TagName).filter(expr).all()
+    return db.session \
+        .query(db.Tag) \
+        .join(db.TagName) \
+        .filter(sqlalchemy.func.lower(db.TagName.name).in_(
+            _lower_list(names))) \
+        .order_by(db.Tag.tag_id) \
+        .all()
+
+
+def get_tag_ids_by_names(names):
+    '''
+    Return ids of tags having any of given names or aliases. The lookups are
+    cached until tags change, one entry per set of names.
+    '''
+    names = tuple(sorted(set(name.lower() for name in names)))
+    if not names:
+        return []
+    key = ('tag-id', names)
+    try:
+        return cache.get(key)
+    except KeyError:
+        pass
+    generations = cache.get_generations(('tag',))
+    tag_ids = sorted(set(
+        tag_id for tag_id, in db.session
+        .query(db.TagName.tag_id)
+        .filter(sqlalchemy.func.lower(db.TagName.name).in_(names))))
+    cache.put(key, tag_ids, dependencies=('tag',), generations=generations)
+    return tag_ids
 
 
 def get_or_create_tags_by_names(names):
     names = util.icase_unique(names)
     existing_tags = get_tags_by_names(names)
+    existing_tags_by_name = {}
+    for existing_tag in existing_tags:
+        for name in _get_names(existing_tag):
+            existing_tags_by_name[name.lower()] = existing_tag
+
+    missing_names = [
+        name for name in names if name.lower() not in existing_tags_by_name]
+    if not missing_names:
+        return existing_tags, []
+
+    # the names are known to be free, so skip the checks done by create_tag
+    for name in missing_names:
+        _verify_name_validity(name)
+    category = tag_categories.get_category_by_name(
+        tag_categories.get_default_category_name())
+    creation_time = datetime.datetime.utcnow()
     new_tags = []
-    tag_category_name = tag_categories.get_default_category_name()
-    for name in names:
-        found = False
-        for existing_tag in existing_tags:
-            if _check_name_intersection(
-                    _get_names(existing_tag), [name], False):
-                found = True
-                break
-        if not found:
-            new_tag = create_tag(
-                names=[name],
-                category_name=tag_category_name,
-                suggestions=[],
-                implications=[])
-            db.session.add(new_tag)
-            new_tags.append(new_tag)
+    for name in missing_names:
+        new_tag = db.Tag()
+        new_tag.creation_time = creation_time
+        new_tag.names = [db.TagName(name, 0)]
+        new_tag.category = category
+        new_tag.suggestions = []
+        new_tag.implications = []
+        new_tags.append(new_tag)
+    db.session.add_all(new_tags)
     return existing_tags, new_tags
 
 
@@ -232,10 +459,28 @@ def merge_tags(source_tag, target_tag):
             .where(pt2.post_id == pt1.post_id)
             .where(pt2.tag_id == target_tag.tag_id))
         .values(tag_id=target_tag.tag_id))
-    db.session.execute(update_stmt)
+    result = db.session.execute(update_stmt)
+    db.tag.adjust_post_counts(
+        db.session, {target_tag.tag_id: result.rowcount})
     delete(source_tag)
 
 
+def get_tag_ids_with_stale_post_counts():
+    actual_count = sqlalchemy \
+        .select([sqlalchemy.func.count(db.PostTag.post_id)]) \
+        .where(db.PostTag.tag_id == db.Tag.tag_id) \
+        .as_scalar()
+    return [
+        tag_id for tag_id, in db.session
+        .query(db.Tag.tag_id)
+        .filter(db.Tag.post_count != actual_count)
+        .order_by(db.Tag.tag_id.asc())]
+
+
+def update_tag_post_counts(tag_ids=None):
+    db.tag.update_post_counts(db.session, tag_ids)
+
+
 def create_tag(names, category_name, suggestions, implications):
     tag = db.Tag()
     tag.creation_time = datetime.datetime.utcnow()
@@ -261,9 +506,7 @@ def update_tag_names(tag, names):
         _verify_name_validity(name)
 
     # check for existing tags
-    expr = sqlalchemy.sql.false()
-    for name in names:
-        expr = expr | (sqlalchemy.func.lower(db.TagName.name) == name.lower())
+    expr = sqlalchemy.func.lower(db.TagName.name).in_(_lower_list(names))
     if tag.tag_id:
         expr = expr & (db.TagName.tag_id != tag.tag_id)
     existing_tags = db.session.query(db.TagName).filter(expr).all()
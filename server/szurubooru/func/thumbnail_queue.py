@@ -0,0 +1,106 @@
+'''
+Persistent queue of posts waiting for their thumbnails. Each queued post is
+an empty file in the data directory, so the queue survives restarts and can
+be consumed by any number of worker processes: a worker claims a post by
+renaming its file, which only one of them can succeed at.
+'''
+
+import os
+import socket
+import time
+from szurubooru import config
+
+
+_QUEUE_DIR = 'thumbnail-queue'
+
+
+def _get_config():
+    return config.config.get('thumbnails') or {}
+
+
+def is_enabled():
+    return bool(_get_config().get('queue'))
+
+
+def get_claim_timeout():
+    return int(_get_config().get('queue_timeout') or 600)
+
+
+def _get_queue_path():
+    return os.path.join(config.config['data_dir'], _QUEUE_DIR)
+
+
+def _get_claim_suffix():
+    # the claim time is a part of the name, as renaming keeps the old mtime
+    return '.%d.%s-%d' % (time.time(), socket.gethostname(), os.getpid())
+
+
+class Job(object):
+    def __init__(self, post_id, path):
+        self.post_id = post_id
+        self.path = path
+
+
+def add(post_id):
+    queue_path = _get_queue_path()
+    os.makedirs(queue_path, exist_ok=True)
+    with open(os.path.join(queue_path, str(post_id)), 'wb'):
+        pass
+
+
+def _list(claimed):
+    try:
+        entries = list(os.scandir(_get_queue_path()))
+    except FileNotFoundError:
+        return []
+    return [entry for entry in entries if entry.name.isdigit() != claimed]
+
+
+def _get_mtime(entry):
+    try:
+        return entry.stat().st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+def get_queued_post_ids():
+    return sorted(int(entry.name) for entry in _list(claimed=False))
+
+
+def claim():
+    ''' Take the oldest queued post. Return None if the queue is empty. '''
+    for entry in sorted(_list(claimed=False), key=_get_mtime):
+        claimed_path = entry.path + _get_claim_suffix()
+        try:
+            os.rename(entry.path, claimed_path)
+        except FileNotFoundError:
+            # another worker was faster
+            continue
+        return Job(int(entry.name), claimed_path)
+    return None
+
+
+def complete(job):
+    try:
+        os.unlink(job.path)
+    except FileNotFoundError:
+        pass
+
+
+def release_stale_jobs():
+    '''
+    Put back posts claimed by workers that didn't finish them in time, most
+    likely because they were killed. Return number of released posts.
+    '''
+    deadline = time.time() - get_claim_timeout()
+    released = 0
+    for entry in _list(claimed=True):
+        post_id, claim_time, _ = entry.name.split('.', 2)
+        if int(claim_time) > deadline:
+            continue
+        try:
+            os.rename(entry.path, os.path.join(_get_queue_path(), post_id))
+        except FileNotFoundError:
+            continue
+        released += 1
+    return released
@@ -46,8 +46,7 @@ def get_avatar_url(user):
             config.config['thumbnails']['avatar_width'])
     else:
         assert user.name
-        return '%s/avatars/%s.png' % (
-            config.config['data_url'].rstrip('/'), user.name.lower())
+        return files.get_url(get_avatar_path(user.name))
 
 
 def get_email(user, auth_user, force_show_email):
@@ -114,7 +113,7 @@ def get_user_count():
 def try_get_user_by_name(name):
     return db.session \
         .query(db.User) \
-        .filter(func.lower(db.User.name) == func.lower(name)) \
+        .filter(func.lower(db.User.name) == name.lower()) \
         .one_or_none()
 
 
@@ -129,8 +128,8 @@ def try_get_user_by_name_or_email(name_or_email):
     return (db.session
         .query(db.User)
         .filter(
-            (func.lower(db.User.name) == func.lower(name_or_email)) |
-            (func.lower(db.User.email) == func.lower(name_or_email)))
+            (func.lower(db.User.name) == name_or_email.lower()) |
+            (func.lower(db.User.email) == name_or_email.lower()))
         .one_or_none())
 
 
@@ -222,7 +221,7 @@ def update_user_avatar(user, avatar_style, avatar_content=None):
         user.avatar_style = user.AVATAR_GRAVATAR
     elif avatar_style == 'manual':
         user.avatar_style = user.AVATAR_MANUAL
-        avatar_path = 'avatars/' + user.name.lower() + '.png'
+        avatar_path = get_avatar_path(user.name)
         if not avatar_content:
             if files.has(avatar_path):
                 return
@@ -81,6 +81,14 @@ def get_sha1(source):
     return sha1.hexdigest()
 
 
+def get_sha1_from_file(handle, chunk_size=1024 * 1024):
+    ''' Hash the rest of a binary file without reading it all at once. '''
+    sha1 = hashlib.sha1()
+    for chunk in iter(lambda: handle.read(chunk_size), b''):
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+
 def flip(source):
     return {v: k for k, v in source.items()}
 
@@ -147,11 +155,11 @@ def parse_time_range(value):
 
 def icase_unique(source):
     target = []
-    target_low = []
+    target_low = set()
     for source_item in source:
         if source_item.lower() not in target_low:
             target.append(source_item)
-            target_low.append(source_item.lower())
+            target_low.add(source_item.lower())
     return target
 
 
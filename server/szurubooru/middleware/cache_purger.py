@@ -1,8 +1,55 @@
+import sqlalchemy
+from szurubooru import db
 from szurubooru.func import cache
-from szurubooru.rest import middleware
 
 
-@middleware.pre_hook
-def process_request(ctx):
-    if ctx.method != 'GET':
-        cache.purge()
+_RESOURCE_TYPES = {
+    'post': ('post',),
+    'post_tag': ('post', 'tag'),
+    'post_relation': ('post',),
+    'post_favorite': ('post',),
+    'post_score': ('post',),
+    'post_note': ('post',),
+    'post_feature': ('post',),
+    'tag': ('tag',),
+    'tag_name': ('tag',),
+    'tag_suggestion': ('tag',),
+    'tag_implication': ('tag',),
+    'tag_category': ('tag_category',),
+    'user': ('user',),
+    'comment': ('comment',),
+    'comment_score': ('comment',),
+    'snapshot': ('snapshot',),
+}
+
+
+def _get_resource_types(entity, is_dirty):
+    resource_types = set(_RESOURCE_TYPES.get(entity.__table__.name, ()))
+    # post.tags is a plain secondary relationship, so changes to post_tag
+    # never show up in the session as separate entities.
+    if isinstance(entity, db.Post) and (
+            not is_dirty
+            or sqlalchemy.inspect(entity).attrs.tags.history.has_changes()):
+        resource_types.add('tag')
+    return resource_types
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def _after_flush(session, _flush_context):
+    resource_types = db.get_transaction_info(session) \
+        .setdefault('modified_resource_types', set())
+    for entity in session.new:
+        resource_types.update(_get_resource_types(entity, False))
+    for entity in session.deleted:
+        resource_types.update(_get_resource_types(entity, False))
+    for entity in session.dirty:
+        if session.is_modified(entity):
+            resource_types.update(_get_resource_types(entity, True))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _after_commit(session):
+    resource_types = db.pop_committed_info(
+        session, 'modified_resource_types')
+    if resource_types:
+        cache.invalidate(resource_types)
@@ -0,0 +1,23 @@
+'''
+Add image hash to posts
+
+Revision ID: 1e280b5d5df1
+Created at: 2016-10-21 14:03:17.552301
+'''
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = '1e280b5d5df1'
+down_revision = '588f460509d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'post', sa.Column('image_hash', sa.Unicode(length=16), nullable=True))
+
+
+def downgrade():
+    op.drop_column('post', 'image_hash')
@@ -0,0 +1,31 @@
+'''
+Add post count to tags
+
+Revision ID: 403b8511f4df
+Created at: 2016-10-18 15:02:27.561013
+'''
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = '403b8511f4df'
+down_revision = 'aa6b82b7ea4c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'tag',
+        sa.Column(
+            'post_count', sa.Integer(), nullable=False, server_default='0'))
+    op.execute(
+        'UPDATE tag SET post_count = '
+        '(SELECT COUNT(post_id) FROM post_tag WHERE tag_id = tag.id)')
+    op.create_index(
+        op.f('ix_tag_post_count'), 'tag', ['post_count'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_tag_post_count'), table_name='tag')
+    op.drop_column('tag', 'post_count')
@@ -0,0 +1,40 @@
+'''
+Add case insensitive name indexes
+
+Revision ID: 588f460509d1
+Created at: 2016-10-19 10:26:51.018622
+'''
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = '588f460509d1'
+down_revision = '403b8511f4df'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_tag_name_lower_name', 'tag_name', [sa.text('lower(name)')])
+    op.create_index('ix_user_lower_name', 'user', [sa.text('lower(name)')])
+    op.create_index('ix_user_lower_email', 'user', [sa.text('lower(email)')])
+
+    if op.get_bind().dialect.name == 'postgresql':
+        # lets wildcard searches (ILIKE) use an index as well
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.execute(
+            'CREATE INDEX ix_tag_name_name_trgm '
+            'ON tag_name USING gin (name gin_trgm_ops)')
+        op.execute(
+            'CREATE INDEX ix_user_name_trgm '
+            'ON "user" USING gin (name gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_user_name_trgm', table_name='user')
+        op.drop_index('ix_tag_name_name_trgm', table_name='tag_name')
+    op.drop_index('ix_user_lower_email', table_name='user')
+    op.drop_index('ix_user_lower_name', table_name='user')
+    op.drop_index('ix_tag_name_lower_name', table_name='tag_name')
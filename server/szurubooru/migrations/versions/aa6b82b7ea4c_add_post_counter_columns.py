@@ -0,0 +1,78 @@
+'''
+Add post counter columns
+
+Revision ID: aa6b82b7ea4c
+Created at: 2016-10-18 12:11:43.194528
+'''
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = 'aa6b82b7ea4c'
+down_revision = '9837fc981ec7'
+branch_labels = None
+depends_on = None
+
+
+COUNT_COLUMNS = {
+    'tag_count':
+        'SELECT COUNT(tag_id) FROM post_tag WHERE post_id = post.id',
+    'score':
+        'SELECT COALESCE(SUM(score), 0) FROM post_score '
+        'WHERE post_id = post.id',
+    'favorite_count':
+        'SELECT COUNT(post_id) FROM post_favorite WHERE post_id = post.id',
+    'feature_count':
+        'SELECT COUNT(post_id) FROM post_feature WHERE post_id = post.id',
+    'comment_count':
+        'SELECT COUNT(post_id) FROM comment WHERE post_id = post.id',
+    'note_count':
+        'SELECT COUNT(post_id) FROM post_note WHERE post_id = post.id',
+    'relation_count':
+        'SELECT COUNT(child_id) FROM post_relation '
+        'WHERE parent_id = post.id OR child_id = post.id',
+}
+
+TIME_COLUMNS = {
+    'last_favorite_time':
+        'SELECT MAX(time) FROM post_favorite WHERE post_id = post.id',
+    'last_feature_time':
+        'SELECT MAX(time) FROM post_feature WHERE post_id = post.id',
+    'last_comment_creation_time':
+        'SELECT MAX(creation_time) FROM comment WHERE post_id = post.id',
+    'last_comment_edit_time':
+        'SELECT MAX(last_edit_time) FROM comment WHERE post_id = post.id',
+}
+
+
+def upgrade():
+    for column_name in COUNT_COLUMNS:
+        op.add_column(
+            'post',
+            sa.Column(
+                column_name,
+                sa.Integer(),
+                nullable=False,
+                server_default='0'))
+    for column_name in TIME_COLUMNS:
+        op.add_column(
+            'post', sa.Column(column_name, sa.DateTime(), nullable=True))
+
+    op.execute(
+        'UPDATE post SET ' + ', '.join(
+            '%s = (%s)' % (column_name, query)
+            for column_name, query
+            in list(COUNT_COLUMNS.items()) + list(TIME_COLUMNS.items())))
+
+    for column_name in list(COUNT_COLUMNS) + list(TIME_COLUMNS):
+        op.create_index(
+            op.f('ix_post_%s' % column_name),
+            'post',
+            [column_name],
+            unique=False)
+
+
+def downgrade():
+    for column_name in list(COUNT_COLUMNS) + list(TIME_COLUMNS):
+        op.drop_index(op.f('ix_post_%s' % column_name), table_name='post')
+        op.drop_column('post', column_name)
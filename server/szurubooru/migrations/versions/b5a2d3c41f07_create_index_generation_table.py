@@ -0,0 +1,30 @@
+'''
+Create index generation table
+
+Revision ID: b5a2d3c41f07
+Created at: 2016-11-02 19:24:53.614275
+'''
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = 'b5a2d3c41f07'
+down_revision = '1e280b5d5df1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table = op.create_table(
+        'index_generation',
+        sa.Column('name', sa.Unicode(length=32), nullable=False),
+        sa.Column('value', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name'))
+    op.bulk_insert(table, [
+        {'name': 'tag_index', 'value': 0},
+        {'name': 'similarity', 'value': 0},
+    ])
+
+
+def downgrade():
+    op.drop_table('index_generation')
@@ -3,7 +3,7 @@ import cgi
 import json
 import re
 from datetime import datetime
-from szurubooru.func import util
+from szurubooru.func import util, files
 from szurubooru.rest import errors, middleware, routes, context
 
 
@@ -28,26 +28,73 @@ def _get_headers(env):
     return headers
 
 
-def _create_context(env):
+class _FieldStorage(cgi.FieldStorage):
+    '''
+    Spools uploaded files to the data directory. Every spooled file is also
+    recorded in spooled_files, which is set on a subclass created for each
+    request, since nested parts are parsed by new instances of the class.
+    '''
+
+    temporary_file = None
+    spooled_files = None
+
+    def make_file(self):
+        if not self._binary_file:
+            return super().make_file()
+        handle, self.temporary_file = files.create_temporary_file()
+        self.spooled_files.append(self.temporary_file)
+        return handle
+
+
+def _get_file(field):
+    if isinstance(field, list):
+        return [_get_file(item) for item in field]
+    if field.temporary_file:
+        field.file.close()
+        return field.temporary_file
+    return field.value
+
+
+def _decode_ndjson(body):
+    ''' Decode newline-delimited JSON into a list of objects. '''
+    try:
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        items = [
+            json.loads(line) for line in body.splitlines() if line.strip()]
+    except (ValueError, UnicodeDecodeError):
+        raise errors.HttpBadRequest(
+            'ValidationError',
+            'Could not decode the request body. Each line must hold '
+            'a JSON object encoded as UTF-8.')
+    if not all(isinstance(item, dict) for item in items):
+        raise errors.HttpBadRequest(
+            'ValidationError', 'Each line must hold a JSON object.')
+    return items
+
+
+def _parse_request(env, field_storage_class):
     method = env['REQUEST_METHOD']
     path = urllib.parse.unquote('/' + env['PATH_INFO'].lstrip('/'))
     headers = _get_headers(env)
 
-    files = {}
+    uploaded_files = {}
     params = dict(urllib.parse.parse_qsl(env.get('QUERY_STRING', '')))
 
     if 'multipart' in env.get('CONTENT_TYPE', ''):
-        form = cgi.FieldStorage(fp=env['wsgi.input'], environ=env)
+        form = field_storage_class(fp=env['wsgi.input'], environ=env)
         if not form.list:
             raise errors.HttpBadRequest(
                 'ValidationError', 'No files attached.')
         body = form.getvalue('metadata')
         for key in form:
-            files[key] = form.getvalue(key)
+            uploaded_files[key] = _get_file(form[key])
     else:
         body = env['wsgi.input'].read()
 
-    if body:
+    if body and 'ndjson' in env.get('CONTENT_TYPE', ''):
+        params['items'] = _decode_ndjson(body)
+    elif body:
         try:
             if isinstance(body, bytes):
                 body = body.decode('utf-8')
@@ -60,42 +107,59 @@ def _create_context(env):
                 'Could not decode the request body. The JSON '
                 'was incorrect or was not encoded as UTF-8.')
 
-    return context.Context(method, path, headers, params, files)
+    return context.Context(method, path, headers, params, uploaded_files)
+
+
+def _create_context(env):
+    spooled_files = []
+    field_storage_class = type(
+        '_FieldStorage', (_FieldStorage,), {'spooled_files': spooled_files})
+    try:
+        return _parse_request(env, field_storage_class)
+    except BaseException:
+        # the context that would delete them doesn't exist yet
+        for temporary_file in spooled_files:
+            temporary_file.delete()
+        raise
 
 
 def application(env, start_response):
     try:
         try:
             ctx = _create_context(env)
-            if 'application/json' not in ctx.get_header('Accept'):
-                raise errors.HttpNotAcceptable(
-                    'ValidationError',
-                    'This API only supports JSON responses.')
-
-            for url, allowed_methods in routes.routes.items():
-                match = re.fullmatch(url, ctx.url)
-                if not match:
-                    continue
-                if ctx.method not in allowed_methods:
-                    raise errors.HttpMethodNotAllowed(
+            try:
+                if 'application/json' not in ctx.get_header('Accept'):
+                    raise errors.HttpNotAcceptable(
                         'ValidationError',
-                        'Allowed methods: %r' % allowed_methods)
-
-                for hook in middleware.pre_hooks:
-                    hook(ctx)
-                handler = allowed_methods[ctx.method]
-                try:
-                    response = handler(ctx, match.groupdict())
-                finally:
-                    for hook in middleware.post_hooks:
+                        'This API only supports JSON responses.')
+
+                for url, allowed_methods in routes.routes.items():
+                    match = re.fullmatch(url, ctx.url)
+                    if not match:
+                        continue
+                    if ctx.method not in allowed_methods:
+                        raise errors.HttpMethodNotAllowed(
+                            'ValidationError',
+                            'Allowed methods: %r' % allowed_methods)
+
+                    for hook in middleware.pre_hooks:
                         hook(ctx)
-
-                start_response('200', [('content-type', 'application/json')])
-                return (_dump_json(response).encode('utf-8'),)
-
-            raise errors.HttpNotFound(
-                'ValidationError',
-                'Requested path ' + ctx.url + ' was not found.')
+                    handler = allowed_methods[ctx.method]
+                    try:
+                        response = handler(ctx, match.groupdict())
+                    finally:
+                        for hook in middleware.post_hooks:
+                            hook(ctx)
+
+                    start_response(
+                        '200', [('content-type', 'application/json')])
+                    return (_dump_json(response).encode('utf-8'),)
+
+                raise errors.HttpNotFound(
+                    'ValidationError',
+                    'Requested path ' + ctx.url + ' was not found.')
+            finally:
+                ctx.delete_temporary_files()
 
         except Exception as ex:
             for exception_type, handler in errors.error_handlers.items():
@@ -1,5 +1,5 @@
 from szurubooru import errors
-from szurubooru.func import net
+from szurubooru.func import net, files
 
 
 def _lower_first(source):
@@ -56,6 +56,13 @@ class Context():
         raise errors.MissingRequiredFileError(
             'Required file %r is missing.' % name)
 
+    def delete_temporary_files(self):
+        ''' Delete uploaded files that weren't stored anywhere. '''
+        for value in self._files.values():
+            for content in value if isinstance(value, list) else [value]:
+                if isinstance(content, files.TemporaryFile):
+                    content.delete()
+
     def has_param(self, name):
         return name in self._params
 
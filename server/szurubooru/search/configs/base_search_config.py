@@ -17,10 +17,35 @@ class BaseSearchConfig(object):
     def create_around_query(self):
         raise NotImplementedError()
 
+    def finalize_query(self, query):
+        for column, order in self.default_sort_columns:
+            if order == self.SORT_ASC:
+                query = query.order_by(column.asc())
+            else:
+                query = query.order_by(column.desc())
+        return query
+
     @property
     def id_column(self):
         return None
 
+    @property
+    def default_sort_columns(self):
+        '''
+        Sort columns applied after the ones requested by the user, as pairs
+        of column and order. The last one must be unique, so that the order
+        is total, which is required by cursor based paging.
+        '''
+        return []
+
+    @property
+    def dependencies(self):
+        '''
+        Resource types whose modification invalidates cached results of this
+        search. None means any modification does.
+        '''
+        return None
+
     @property
     def anonymous_filter(self):
         return None
@@ -14,8 +14,20 @@ class CommentSearchConfig(BaseSearchConfig):
     def create_around_query(self):
         raise NotImplementedError()
 
-    def finalize_query(self, query):
-        return query.order_by(db.Comment.creation_time.desc())
+    @property
+    def id_column(self):
+        return db.Comment.comment_id
+
+    @property
+    def default_sort_columns(self):
+        return [
+            (db.Comment.creation_time, self.SORT_DESC),
+            (db.Comment.comment_id, self.SORT_ASC),
+        ]
+
+    @property
+    def dependencies(self):
+        return ('comment', 'user', 'post')
 
     @property
     def anonymous_filter(self):
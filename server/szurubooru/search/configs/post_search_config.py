@@ -1,7 +1,8 @@
-from sqlalchemy.orm import subqueryload, lazyload, defer, aliased
+import sqlalchemy
+from sqlalchemy.orm import subqueryload, lazyload, aliased
 from sqlalchemy.sql.expression import func
 from szurubooru import db, errors
-from szurubooru.func import util
+from szurubooru.func import util, tags, tag_index, similarity
 from szurubooru.search import criteria, tokens
 from szurubooru.search.configs import util as search_util
 from szurubooru.search.configs.base_search_config import BaseSearchConfig
@@ -78,8 +79,152 @@ def _create_user_filter():
     return wrapper
 
 
+def _create_similar_filter():
+    ''' Filter by looks, using perceptual hash of the given post. '''
+    def wrapper(query, criterion, negated):
+        if not isinstance(criterion, criteria.PlainCriterion):
+            raise errors.SearchError('Expected a single post ID.')
+        if not similarity.is_enabled():
+            raise errors.SearchError('Similarity search is disabled.')
+        try:
+            post_id = int(criterion.value)
+        except ValueError:
+            raise errors.SearchError('Invalid post ID: %r.' % criterion.value)
+        image_hash = db.session \
+            .query(db.Post.image_hash) \
+            .filter(db.Post.post_id == post_id) \
+            .scalar()
+        post_ids = []
+        if image_hash:
+            matches = similarity.find_similar(
+                image_hash, exclude_post_id=post_id)
+            post_ids = [similar_post_id for similar_post_id, _ in matches]
+        if post_ids:
+            expr = db.Post.post_id.in_(post_ids)
+        else:
+            expr = sqlalchemy.sql.false()
+        if negated:
+            expr = ~expr
+        return query.filter(expr)
+    return wrapper
+
+
+class _IndexedTagsCriterion(object):
+    '''
+    Combination of anonymous tokens that can be resolved using the tag index.
+    '''
+
+    def __init__(self, included, excluded, original_tokens):
+        self.original_text = ' '.join(
+            repr(token.criterion) for token in original_tokens)
+        self.included = included
+        self.excluded = excluded
+        self.original_tokens = original_tokens
+
+    @property
+    def cache_key(self):
+        return (
+            'indexed-tags',
+            tuple(sorted(tuple(sorted(names)) for names in self.included)),
+            tuple(sorted(self.excluded)))
+
+    def __hash__(self):
+        return hash(self.cache_key)
+
+    def __repr__(self):
+        return self.original_text
+
+
+def _get_indexable_names(criterion):
+    if isinstance(criterion, criteria.PlainCriterion):
+        names = [criterion.value]
+    elif isinstance(criterion, criteria.ArrayCriterion):
+        names = criterion.values
+    else:
+        return None
+    if any('*' in name for name in names):
+        return None
+    return names
+
+
+def _use_tag_index(search_query):
+    included = []
+    excluded = []
+    indexed_tokens = []
+    other_tokens = []
+    for token in search_query.anonymous_tokens:
+        names = _get_indexable_names(token.criterion)
+        if names is None:
+            other_tokens.append(token)
+            continue
+        if token.negated:
+            excluded.extend(names)
+        else:
+            included.append(names)
+        indexed_tokens.append(token)
+    if not included:
+        return
+    search_query.anonymous_tokens = [
+        tokens.AnonymousToken(
+            _IndexedTagsCriterion(included, excluded, indexed_tokens),
+            False)
+    ] + other_tokens
+
+
+def _create_tag_filter():
+    '''
+    Filter by tag names. Plain names are resolved to tag ids up front, so
+    that only tokens with wildcards need to match against tag names.
+    '''
+    pattern_filter = search_util.create_subquery_filter(
+        db.Post.post_id,
+        db.PostTag.post_id,
+        db.TagName.name,
+        search_util.create_str_filter,
+        lambda subquery: subquery.join(db.Tag).join(db.TagName))
+
+    def wrapper(query, criterion, negated):
+        names = _get_indexable_names(criterion)
+        if names is None:
+            return pattern_filter(query, criterion, negated)
+        tag_ids = tags.get_tag_ids_by_names(names)
+        if not tag_ids:
+            expr = sqlalchemy.sql.false()
+        else:
+            subquery = db.session.query(db.PostTag.post_id)
+            if len(tag_ids) == 1:
+                subquery = subquery.filter(db.PostTag.tag_id == tag_ids[0])
+            else:
+                subquery = subquery.filter(db.PostTag.tag_id.in_(tag_ids))
+            expr = db.Post.post_id.in_(subquery.subquery('t'))
+        if negated:
+            expr = ~expr
+        return query.filter(expr)
+    return wrapper
+
+
+def _create_anonymous_filter():
+    tag_filter = _create_tag_filter()
+
+    def wrapper(query, criterion, negated):
+        if not isinstance(criterion, _IndexedTagsCriterion):
+            return tag_filter(query, criterion, negated)
+        post_ids = tag_index.get_index().resolve(
+            db.session, criterion.included, criterion.excluded)
+        if post_ids is None or len(post_ids) > tag_index.get_max_results():
+            for token in criterion.original_tokens:
+                query = tag_filter(query, token.criterion, token.negated)
+            return query
+        if not post_ids:
+            return query.filter(sqlalchemy.sql.false())
+        return query.filter(db.Post.post_id.in_(post_ids))
+    return wrapper
+
+
 class PostSearchConfig(BaseSearchConfig):
     def on_search_query_parsed(self, search_query):
+        if tag_index.is_enabled():
+            _use_tag_index(search_query)
         new_special_tokens = []
         for token in search_query.special_tokens:
             if token.value in ('fav', 'liked', 'disliked'):
@@ -108,27 +253,21 @@ class PostSearchConfig(BaseSearchConfig):
         return db.session.query(db.Post) \
             .options(
                 lazyload('*'),
-                # use config optimized for official client
-                # defer(db.Post.score),
-                # defer(db.Post.favorite_count),
-                # defer(db.Post.comment_count),
-                defer(db.Post.last_favorite_time),
-                defer(db.Post.feature_count),
-                defer(db.Post.last_feature_time),
-                defer(db.Post.last_comment_creation_time),
-                defer(db.Post.last_comment_edit_time),
-                defer(db.Post.note_count),
-                defer(db.Post.tag_count),
                 strategy(db.Post.tags).subqueryload(db.Tag.names),
-                strategy(db.Post.tags).defer(db.Tag.post_count),
                 strategy(db.Post.tags).lazyload(db.Tag.implications),
                 strategy(db.Post.tags).lazyload(db.Tag.suggestions))
 
     def create_count_query(self, _disable_eager_loads):
         return db.session.query(db.Post)
 
-    def finalize_query(self, query):
-        return query.order_by(db.Post.post_id.desc())
+    @property
+    def default_sort_columns(self):
+        return [(db.Post.post_id, self.SORT_DESC)]
+
+    @property
+    def dependencies(self):
+        # posts are serialized with the categories of their tags
+        return ('post', 'tag', 'tag_category', 'user', 'comment')
 
     @property
     def id_column(self):
@@ -136,23 +275,13 @@ class PostSearchConfig(BaseSearchConfig):
 
     @property
     def anonymous_filter(self):
-        return search_util.create_subquery_filter(
-            db.Post.post_id,
-            db.PostTag.post_id,
-            db.TagName.name,
-            search_util.create_str_filter,
-            lambda subquery: subquery.join(db.Tag).join(db.TagName))
+        return _create_anonymous_filter()
 
     @property
     def named_filters(self):
         return util.unalias_dict({
             'id': search_util.create_num_filter(db.Post.post_id),
-            'tag': search_util.create_subquery_filter(
-                db.Post.post_id,
-                db.PostTag.post_id,
-                db.TagName.name,
-                search_util.create_str_filter,
-                lambda subquery: subquery.join(db.Tag).join(db.TagName)),
+            'tag': _create_tag_filter(),
             'score': search_util.create_num_filter(db.Post.score),
             ('uploader', 'upload', 'submit'):
                 _create_user_filter(),
@@ -185,6 +314,7 @@ class PostSearchConfig(BaseSearchConfig):
                     db.Post.type, _type_transformer),
             'content-checksum': search_util.create_str_filter(
                 db.Post.checksum),
+            'similar': _create_similar_filter(),
             'file-size': search_util.create_num_filter(db.Post.file_size),
             ('image-width', 'width'):
                 search_util.create_num_filter(db.Post.canvas_width),
@@ -13,8 +13,20 @@ class SnapshotSearchConfig(BaseSearchConfig):
     def create_around_query(self):
         raise NotImplementedError()
 
-    def finalize_query(self, query):
-        return query.order_by(db.Snapshot.creation_time.desc())
+    @property
+    def id_column(self):
+        return db.Snapshot.snapshot_id
+
+    @property
+    def default_sort_columns(self):
+        return [
+            (db.Snapshot.creation_time, self.SORT_DESC),
+            (db.Snapshot.snapshot_id, self.SORT_DESC),
+        ]
+
+    @property
+    def dependencies(self):
+        return ('snapshot', 'user')
 
     @property
     def named_filters(self):
@@ -15,7 +15,6 @@ class TagSearchConfig(BaseSearchConfig):
                 defer(db.Tag.first_name),
                 defer(db.Tag.suggestion_count),
                 defer(db.Tag.implication_count),
-                defer(db.Tag.post_count),
                 strategy(db.Tag.names),
                 strategy(db.Tag.suggestions).joinedload(db.Tag.names),
                 strategy(db.Tag.implications).joinedload(db.Tag.names))
@@ -26,8 +25,20 @@ class TagSearchConfig(BaseSearchConfig):
     def create_around_query(self):
         raise NotImplementedError()
 
-    def finalize_query(self, query):
-        return query.order_by(db.Tag.first_name.asc())
+    @property
+    def id_column(self):
+        return db.Tag.tag_id
+
+    @property
+    def default_sort_columns(self):
+        return [
+            (db.Tag.first_name, self.SORT_ASC),
+            (db.Tag.tag_id, self.SORT_ASC),
+        ]
+
+    @property
+    def dependencies(self):
+        return ('tag', 'tag_category', 'post')
 
     @property
     def anonymous_filter(self):
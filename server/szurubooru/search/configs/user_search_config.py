@@ -14,8 +14,20 @@ class UserSearchConfig(BaseSearchConfig):
     def create_around_query(self):
         raise NotImplementedError()
 
-    def finalize_query(self, query):
-        return query.order_by(db.User.name.asc())
+    @property
+    def id_column(self):
+        return db.User.user_id
+
+    @property
+    def default_sort_columns(self):
+        return [
+            (db.User.name, self.SORT_ASC),
+            (db.User.user_id, self.SORT_ASC),
+        ]
+
+    @property
+    def dependencies(self):
+        return ('user',)
 
     @property
     def anonymous_filter(self):
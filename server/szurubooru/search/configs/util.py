@@ -48,19 +48,26 @@ def create_num_filter(column):
     return wrapper
 
 
+def _match_str(column, value, transformer):
+    # exact matches are written so that they can use lower(column) indexes
+    if transformer is wildcard_transformer and '*' not in value:
+        return sqlalchemy.func.lower(column) == value.lower()
+    return column.ilike(transformer(value))
+
+
 def apply_str_criterion_to_column(
         column, criterion, transformer=wildcard_transformer):
     '''
     Decorate SQLAlchemy filter on given column using supplied criterion.
     '''
     if isinstance(criterion, criteria.PlainCriterion):
-        expr = column.ilike(transformer(criterion.value))
+        expr = _match_str(column, criterion.value, transformer)
     elif isinstance(criterion, criteria.ArrayCriterion):
         expr = sqlalchemy.sql.false()
         for value in criterion.values:
-            expr = expr | column.ilike(transformer(value))
+            expr = expr | _match_str(column, value, transformer)
     elif isinstance(criterion, criteria.RangedCriterion):
-        expr = column.ilike(transformer(criterion.original_text))
+        expr = _match_str(column, criterion.original_text, transformer)
     else:
         assert False
     return expr
@@ -12,8 +12,12 @@ class RangedCriterion(_BaseCriterion):
         self.min_value = min_value
         self.max_value = max_value
 
+    @property
+    def cache_key(self):
+        return ('range', self.min_value, self.max_value)
+
     def __hash__(self):
-        return hash(('range', self.min_value, self.max_value))
+        return hash(self.cache_key)
 
 
 class PlainCriterion(_BaseCriterion):
@@ -21,8 +25,12 @@ class PlainCriterion(_BaseCriterion):
         super().__init__(original_text)
         self.value = value
 
+    @property
+    def cache_key(self):
+        return ('plain', self.value)
+
     def __hash__(self):
-        return hash(self.value)
+        return hash(self.cache_key)
 
 
 class ArrayCriterion(_BaseCriterion):
@@ -30,5 +38,9 @@ class ArrayCriterion(_BaseCriterion):
         super().__init__(original_text)
         self.values = values
 
+    @property
+    def cache_key(self):
+        return tuple(['array'] + self.values)
+
     def __hash__(self):
-        return hash(tuple(['array'] + self.values))
+        return hash(self.cache_key)
@@ -0,0 +1,141 @@
+'''
+Keyset (seek) paging support. A cursor is an opaque token holding the sort
+key of the row it points at, so a page can be located with an indexed
+comparison instead of skipping all the preceding rows.
+'''
+
+import base64
+import binascii
+import json
+from datetime import datetime
+import sqlalchemy
+from szurubooru import errors
+from szurubooru.func import util
+from szurubooru.search import tokens
+
+
+DIRECTION_NEXT = 'next'
+DIRECTION_PREV = 'prev'
+
+_DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+class Cursor(object):
+    def __init__(self, direction, values):
+        self.direction = direction
+        self.values = values
+
+    @property
+    def is_backwards(self):
+        return self.direction == DIRECTION_PREV
+
+
+def _get_fingerprint(search_query):
+    return util.get_sha1(repr(search_query.cache_key))[:12]
+
+
+def _serialize_value(value):
+    if isinstance(value, datetime):
+        return {'datetime': value.isoformat()}
+    return value
+
+
+def _deserialize_value(value):
+    if isinstance(value, dict):
+        for datetime_format in _DATETIME_FORMATS:
+            try:
+                return datetime.strptime(value['datetime'], datetime_format)
+            except ValueError:
+                pass
+        raise ValueError('Invalid date: %r' % value)
+    return value
+
+
+def encode(search_query, direction, values):
+    payload = json.dumps(
+        [
+            _get_fingerprint(search_query),
+            direction,
+            [_serialize_value(value) for value in values],
+        ],
+        separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')) \
+        .decode('ascii') \
+        .rstrip('=')
+
+
+def decode(text, search_query, value_count):
+    try:
+        payload = base64.urlsafe_b64decode(
+            text.encode('ascii') + b'=' * (-len(text) % 4))
+        fingerprint, direction, values = json.loads(payload.decode('utf-8'))
+        values = [_deserialize_value(value) for value in values]
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        raise errors.SearchError('Invalid cursor.')
+    if fingerprint != _get_fingerprint(search_query):
+        raise errors.SearchError('Cursor does not match the query.')
+    if direction not in (DIRECTION_NEXT, DIRECTION_PREV) \
+            or len(values) != value_count:
+        raise errors.SearchError('Invalid cursor.')
+    return Cursor(direction, values)
+
+
+def _is_nullable(column):
+    try:
+        underlying_column = column.property.columns[0]
+    except (AttributeError, IndexError):
+        return True
+    if isinstance(underlying_column, sqlalchemy.Column):
+        return underlying_column.nullable \
+            and not underlying_column.primary_key
+    return True
+
+
+def _is_ascending(order, backwards):
+    return (order == tokens.SortToken.SORT_ASC) != backwards
+
+
+def are_nulls_largest(dialect):
+    ''' Return whether the database sorts NULLs after all other values. '''
+    return dialect.name in ('postgresql', 'oracle')
+
+
+def apply_order(db_query, sort_columns, backwards):
+    '''
+    Order the query by given columns, reversed for backwards cursors. NULLs
+    are left where the database puts them, so that the order is the same as
+    with offset paging and can use plain indexes.
+    '''
+    for column, order in sort_columns:
+        if _is_ascending(order, backwards):
+            db_query = db_query.order_by(column.asc())
+        else:
+            db_query = db_query.order_by(column.desc())
+    return db_query
+
+
+def create_filter(sort_columns, cursor, nulls_largest):
+    '''
+    Return expression matching rows that come after the cursor (or before
+    it, for backwards cursors) in the order defined by apply_order.
+    '''
+    backwards = cursor.is_backwards
+    expr = sqlalchemy.sql.false()
+    for (column, order), value in reversed(
+            list(zip(sort_columns, cursor.values))):
+        is_ascending = _is_ascending(order, backwards)
+        nulls_last = is_ascending == nulls_largest
+        if value is None:
+            if nulls_last:
+                expr = column.is_(None) & expr
+            else:
+                expr = column.isnot(None) | (column.is_(None) & expr)
+            continue
+        if is_ascending:
+            beyond = column > value
+        else:
+            beyond = column < value
+        if nulls_last and _is_nullable(column):
+            beyond = beyond | column.is_(None)
+        expr = beyond | ((column == value) & expr)
+    return expr
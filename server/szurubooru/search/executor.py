@@ -1,7 +1,12 @@
+import json
 import sqlalchemy
 from szurubooru import db, errors
 from szurubooru.func import cache
-from szurubooru.search import tokens, parser
+from szurubooru.search import tokens, parser, cursors
+
+
+# below this many rows, counting exactly is cheap enough to not bother
+_EXACT_COUNT_THRESHOLD = 10000
 
 
 def _format_dict_keys(source):
@@ -20,6 +25,27 @@ def _get_order(order, default_order):
     return order
 
 
+def _get_estimated_count(db_query):
+    '''
+    Return the number of rows the database planner expects the query to
+    yield, or None if the estimate is unavailable or small enough that an
+    exact count is cheap.
+    '''
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        return None
+    statement = db_query.statement.order_by(None)
+    compiled = statement.compile(dialect=connection.dialect)
+    plan = connection.execute(
+        'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = int(plan[0]['Plan']['Plan Rows'])
+    if estimate < _EXACT_COUNT_THRESHOLD:
+        return None
+    return estimate
+
+
 class Executor(object):
     '''
     Class for search parsing and execution. Handles plaintext parsing and
@@ -57,6 +83,21 @@ class Executor(object):
             next_filter_query.one_or_none(),
             prev_filter_query.one_or_none()]
 
+    def get_ids(self, query_text):
+        ''' Return ids of all matching entities in ascending order. '''
+        search_query = self.parser.parse(query_text)
+        self.config.on_search_query_parsed(search_query)
+        filter_query = (
+            self.config
+                .create_around_query()
+                .options(sqlalchemy.orm.lazyload('*')))
+        filter_query = self._prepare_db_query(
+            filter_query, search_query, False)
+        return [
+            row[0] for row in filter_query
+            .order_by(None)
+            .order_by(self.config.id_column.asc())]
+
     def get_around_and_serialize(self, ctx, entity_id, serializer):
         entities = self.get_around(ctx.get_param_as_string('query'), entity_id)
         return {
@@ -64,10 +105,11 @@ class Executor(object):
             'prev': serializer(entities[1]),
         }
 
-    def execute(self, query_text, page, page_size):
+    def execute(self, query_text, page, page_size, estimate_count=False):
         '''
         Parse input and return tuple containing total record count and filtered
-        entities.
+        entities. With estimate_count, the total of large result sets may be
+        replaced by the database planner estimate.
         '''
 
         search_query = self.parser.parse(query_text)
@@ -78,9 +120,17 @@ class Executor(object):
             if token.name == 'random':
                 disable_eager_loads = True
 
-        key = (id(self.config), hash(search_query), page, page_size)
-        if cache.has(key):
-            return cache.get(key)
+        key = (
+            type(self.config).__name__,
+            search_query.cache_key,
+            page,
+            page_size)
+        try:
+            count, entity_ids = cache.get(key)
+            return (count, self._get_entities(entity_ids, disable_eager_loads))
+        except KeyError:
+            pass
+        generations = cache.get_generations(self.config.dependencies)
 
         filter_query = self.config.create_filter_query(disable_eager_loads)
         filter_query = filter_query.options(sqlalchemy.orm.lazyload('*'))
@@ -90,25 +140,121 @@ class Executor(object):
             .limit(page_size) \
             .all()
 
-        count_query = self.config.create_count_query(disable_eager_loads)
-        count_query = count_query.options(sqlalchemy.orm.lazyload('*'))
-        count_query = self._prepare_db_query(count_query, search_query, False)
-        count_statement = count_query \
-            .statement \
-            .with_only_columns([sqlalchemy.func.count()]) \
-            .order_by(None)
-        count = db.session.execute(count_statement).scalar()
+        count = self._count(search_query, disable_eager_loads, estimate_count)
+
+        cache.put(
+            key,
+            (count, self._get_entity_ids(entities)),
+            dependencies=self.config.dependencies,
+            generations=generations)
+        return (count, entities)
+
+    def execute_with_cursor(
+            self, query_text, cursor_text, page_size, estimate_count=False):
+        '''
+        Parse input and return tuple containing total record count, filtered
+        entities and cursors pointing to the next and previous page (None if
+        there are no such pages). Unlike with page numbers, the cost of
+        retrieving a page doesn't grow with its distance from the first page.
+        '''
+
+        search_query = self.parser.parse(query_text)
+        self.config.on_search_query_parsed(search_query)
+
+        for token in search_query.sort_tokens:
+            if token.name == 'random':
+                raise errors.SearchError(
+                    'Random sorting cannot be used with cursors.')
+        if self.config.id_column is None:
+            raise errors.SearchError(
+                'Cursors are not supported in this context.')
+
+        key = (
+            type(self.config).__name__,
+            search_query.cache_key,
+            'cursor',
+            cursor_text,
+            page_size)
+        try:
+            count, entity_ids, next_cursor, prev_cursor = cache.get(key)
+            return (
+                count,
+                self._get_entities(entity_ids, False),
+                next_cursor,
+                prev_cursor)
+        except KeyError:
+            pass
+        generations = cache.get_generations(self.config.dependencies)
+
+        sort_columns = self._get_sort_columns(search_query) \
+            + self.config.default_sort_columns
+        cursor = None
+        if cursor_text:
+            cursor = cursors.decode(
+                cursor_text, search_query, len(sort_columns))
+        backwards = cursor is not None and cursor.is_backwards
+
+        filter_query = self.config.create_filter_query(False)
+        filter_query = filter_query.options(sqlalchemy.orm.lazyload('*'))
+        filter_query = self._apply_filters(filter_query, search_query)
+        if cursor:
+            filter_query = filter_query.filter(
+                cursors.create_filter(
+                    sort_columns,
+                    cursor,
+                    cursors.are_nulls_largest(db.session.get_bind().dialect)))
+        filter_query = cursors.apply_order(
+            filter_query, sort_columns, backwards)
+        filter_query = filter_query.add_columns(*[
+            column.label('cursor_%d' % i)
+            for i, (column, _order) in enumerate(sort_columns)])
+        rows = filter_query.limit(page_size + 1).all()
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if backwards:
+            rows.reverse()
+
+        next_cursor = None
+        prev_cursor = None
+        if rows:
+            if has_more or backwards:
+                next_cursor = cursors.encode(
+                    search_query, cursors.DIRECTION_NEXT, rows[-1][1:])
+            if (has_more and backwards) or (cursor and not backwards):
+                prev_cursor = cursors.encode(
+                    search_query, cursors.DIRECTION_PREV, rows[0][1:])
 
-        ret = (count, entities)
-        cache.put(key, ret)
-        return ret
+        count = self._count(search_query, False, estimate_count)
 
-    def execute_and_serialize(self, ctx, serializer):
+        entities = [row[0] for row in rows]
+        cache.put(
+            key,
+            (count, self._get_entity_ids(entities), next_cursor, prev_cursor),
+            dependencies=self.config.dependencies,
+            generations=generations)
+        return (count, entities, next_cursor, prev_cursor)
+
+    def execute_and_serialize(self, ctx, serializer, estimate_count=False):
         query = ctx.get_param_as_string('query')
-        page = ctx.get_param_as_int('page', default=1, min=1)
         page_size = ctx.get_param_as_int(
             'pageSize', default=100, min=1, max=100)
-        count, entities = self.execute(query, page, page_size)
+        if ctx.has_param('cursor'):
+            cursor = ctx.get_param_as_string('cursor')
+            count, entities, next_cursor, prev_cursor = \
+                self.execute_with_cursor(
+                    query, cursor, page_size, estimate_count=estimate_count)
+            return {
+                'query': query,
+                'cursor': cursor,
+                'pageSize': page_size,
+                'total': count,
+                'nextCursor': next_cursor,
+                'prevCursor': prev_cursor,
+                'results': [serializer(entity) for entity in entities],
+            }
+        page = ctx.get_param_as_int('page', default=1, min=1)
+        count, entities = self.execute(
+            query, page, page_size, estimate_count=estimate_count)
         return {
             'query': query,
             'page': page,
@@ -117,9 +263,89 @@ class Executor(object):
             'results': [serializer(entity) for entity in entities],
         }
 
+    def _get_entity_ids(self, entities):
+        return [
+            getattr(entity, self.config.id_column.key) for entity in entities]
+
+    def _get_entities(self, entity_ids, disable_eager_loads):
+        '''
+        Load entities of cached search results into the current session, in
+        the cached order. Only their ids are cached, since entities can't be
+        shared between sessions.
+        '''
+        if not entity_ids:
+            return []
+        id_column = self.config.id_column
+        entities_by_id = {
+            getattr(entity, id_column.key): entity
+            for entity in self.config
+            .create_filter_query(disable_eager_loads)
+            .filter(id_column.in_(entity_ids))
+            .all()}
+        return [
+            entities_by_id[entity_id]
+            for entity_id in entity_ids
+            if entity_id in entities_by_id]
+
+    def _count(self, search_query, disable_eager_loads, estimate_count):
+        '''
+        Return the total record count. It doesn't depend on paging nor
+        sorting, so it's cached separately from the result pages.
+        '''
+        key = (
+            type(self.config).__name__,
+            'count',
+            search_query.filter_cache_key)
+        estimate_key = key + ('estimate',)
+        for cached_key in (key, estimate_key) if estimate_count else (key,):
+            try:
+                return cache.get(cached_key)
+            except KeyError:
+                pass
+        generations = cache.get_generations(self.config.dependencies)
+
+        count_query = self.config.create_count_query(disable_eager_loads)
+        count_query = count_query.options(sqlalchemy.orm.lazyload('*'))
+        count_query = self._prepare_db_query(count_query, search_query, False)
+
+        if estimate_count:
+            count = _get_estimated_count(count_query)
+            if count is not None:
+                cache.put(
+                    estimate_key,
+                    count,
+                    dependencies=self.config.dependencies,
+                    generations=generations)
+                return count
+
+        count_statement = count_query \
+            .statement \
+            .with_only_columns([sqlalchemy.func.count()]) \
+            .order_by(None)
+        count = db.session.execute(count_statement).scalar()
+        cache.put(
+            key,
+            count,
+            dependencies=self.config.dependencies,
+            generations=generations)
+        return count
+
     def _prepare_db_query(self, db_query, search_query, use_sort):
         ''' Parse input and return SQLAlchemy query. '''
 
+        db_query = self._apply_filters(db_query, search_query)
+
+        if use_sort:
+            for column, order in self._get_sort_columns(search_query):
+                if order == tokens.SortToken.SORT_ASC:
+                    db_query = db_query.order_by(column.asc())
+                elif order == tokens.SortToken.SORT_DESC:
+                    db_query = db_query.order_by(column.desc())
+
+        db_query = self.config.finalize_query(db_query)
+        return db_query
+
+    def _apply_filters(self, db_query, search_query):
         for token in search_query.anonymous_tokens:
             if not self.config.anonymous_filter:
                 raise errors.SearchError(
@@ -146,20 +372,19 @@ class Executor(object):
             db_query = self.config.special_filters[token.value](
                 db_query, token.negated)
 
-        if use_sort:
-            for token in search_query.sort_tokens:
-                if token.name not in self.config.sort_columns:
-                    raise errors.SearchError(
-                        'Unknown sort token: %r. '
-                        'Available sort tokens: %r.' % (
-                            token.name,
-                            _format_dict_keys(self.config.sort_columns)))
-                column, default_order = self.config.sort_columns[token.name]
-                order = _get_order(token.order, default_order)
-                if order == token.SORT_ASC:
-                    db_query = db_query.order_by(column.asc())
-                elif order == token.SORT_DESC:
-                    db_query = db_query.order_by(column.desc())
-
-        db_query = self.config.finalize_query(db_query)
         return db_query
+
+    def _get_sort_columns(self, search_query):
+        ''' Return list of (column, order) pairs requested by the query. '''
+        sort_columns = []
+        for token in search_query.sort_tokens:
+            if token.name not in self.config.sort_columns:
+                raise errors.SearchError(
+                    'Unknown sort token: %r. '
+                    'Available sort tokens: %r.' % (
+                        token.name,
+                        _format_dict_keys(self.config.sort_columns)))
+            column, default_order = self.config.sort_columns[token.name]
+            sort_columns.append(
+                (column, _get_order(token.order, default_order)))
+        return sort_columns
@@ -74,12 +74,22 @@ class SearchQuery():
         self.special_tokens = []
         self.sort_tokens = []
 
+    @property
+    def filter_cache_key(self):
+        ''' Like cache_key, but ignores the sort style tokens. '''
+        return (
+            tuple(token.cache_key for token in self.anonymous_tokens),
+            tuple(token.cache_key for token in self.named_tokens),
+            tuple(token.cache_key for token in self.special_tokens))
+
+    @property
+    def cache_key(self):
+        ''' Return a representation that is stable across processes. '''
+        return self.filter_cache_key + (
+            tuple(token.cache_key for token in self.sort_tokens),)
+
     def __hash__(self):
-        return hash((
-            tuple(self.anonymous_tokens),
-            tuple(self.named_tokens),
-            tuple(self.special_tokens),
-            tuple(self.sort_tokens)))
+        return hash(self.cache_key)
 
 
 class Parser(object):
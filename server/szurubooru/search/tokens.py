@@ -3,8 +3,12 @@ class AnonymousToken(object):
         self.criterion = criterion
         self.negated = negated
 
+    @property
+    def cache_key(self):
+        return (self.criterion.cache_key, self.negated)
+
     def __hash__(self):
-        return hash((self.criterion, self.negated))
+        return hash(self.cache_key)
 
 
 class NamedToken(AnonymousToken):
@@ -12,8 +16,12 @@ class NamedToken(AnonymousToken):
         super().__init__(criterion, negated)
         self.name = name
 
+    @property
+    def cache_key(self):
+        return (self.name, self.criterion.cache_key, self.negated)
+
     def __hash__(self):
-        return hash((self.name, self.criterion, self.negated))
+        return hash(self.cache_key)
 
 
 class SortToken(object):
@@ -26,8 +34,12 @@ class SortToken(object):
         self.name = name
         self.order = order
 
+    @property
+    def cache_key(self):
+        return (self.name, self.order)
+
     def __hash__(self):
-        return hash((self.name, self.order))
+        return hash(self.cache_key)
 
 
 class SpecialToken(object):
@@ -35,5 +47,9 @@ class SpecialToken(object):
         self.value = value
         self.negated = negated
 
+    @property
+    def cache_key(self):
+        return (self.value, self.negated)
+
     def __hash__(self):
-        return hash((self.value, self.negated))
+        return hash(self.cache_key)
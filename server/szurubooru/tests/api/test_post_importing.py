@@ -0,0 +1,265 @@
+from unittest.mock import patch, call
+import pytest
+import sqlalchemy
+from szurubooru import api, db, errors
+# pylint: disable=unused-import
+from szurubooru.middleware import cache_purger
+from szurubooru.func import (
+    tags, net, cache, snapshots, tag_index, similarity, thumbnail_queue)
+
+
+@pytest.fixture(autouse=True)
+def inject_config(tmpdir, config_injector):
+    config_injector({
+        'data_dir': str(tmpdir.mkdir('data')),
+        'data_url': 'example.com',
+        'tag_name_regex': '^[^\\s]+$',
+        'thumbnails': {
+            'post_width': 300,
+            'post_height': 300,
+        },
+        'privileges': {
+            'posts:import': db.User.RANK_POWER,
+            'posts:create:anonymous': db.User.RANK_REGULAR,
+            'posts:create:identified': db.User.RANK_REGULAR,
+            'tags:create': db.User.RANK_REGULAR,
+        },
+    })
+
+
+def test_importing_posts(
+        context_factory, user_factory, tag_factory, tag_category_factory,
+        read_asset):
+    auth_user = user_factory(rank=db.User.RANK_POWER)
+    tag_category_factory(default=True)
+    db.session.add(tag_factory(names=['existing', 'alias']))
+    db.session.flush()
+    with patch('szurubooru.func.tags.export_to_json'):
+        result = api.post_api.import_posts(
+            context_factory(
+                params={
+                    'items': [
+                        {'safety': 'safe', 'tags': ['existing', 'new']},
+                        {'safety': 'unsafe', 'tags': ['ALIAS', 'new']},
+                    ],
+                },
+                files={
+                    'content0': read_asset('png.png'),
+                    'content1': read_asset('jpeg.jpg'),
+                },
+                user=auth_user))
+        tags.export_to_json.assert_called_once_with()
+    db.session.expire_all()
+    post1_id = result['results'][0]['postId']
+    post2_id = result['results'][1]['postId']
+    assert result == {'results': [
+        {'index': 0, 'status': 'created', 'postId': post1_id},
+        {'index': 1, 'status': 'created', 'postId': post2_id},
+    ]}
+    post1 = db.session.query(db.Post).get(post1_id)
+    post2 = db.session.query(db.Post).get(post2_id)
+    assert post1.user == auth_user
+    assert post1.safety == db.Post.SAFETY_SAFE
+    assert post2.safety == db.Post.SAFETY_UNSAFE
+    assert sorted(tag.names[0].name for tag in post1.tags) \
+        == ['existing', 'new']
+    assert sorted(tag.names[0].name for tag in post2.tags) \
+        == ['existing', 'new']
+    assert db.session.query(db.Tag).count() == 2
+    assert db.session.query(db.Snapshot).count() == 3
+
+
+def test_importing_posts_with_failures(
+        context_factory, user_factory, post_factory, read_asset):
+    existing_post = post_factory()
+    existing_post.checksum = 'ad3ba6f7e8a4c1b5a6c4db3bb36d8ee9fb1e2d45'
+    db.session.add(existing_post)
+    db.session.flush()
+    with patch('szurubooru.func.tags.export_to_json'), \
+            patch('szurubooru.func.util.get_sha1') as get_sha1:
+        get_sha1.side_effect = lambda content: {
+            b'existing': existing_post.checksum,
+        }.get(content, 'checksum-%d' % len(content))
+        result = api.post_api.import_posts(
+            context_factory(
+                params={
+                    'items': [
+                        {'safety': 'safe'},
+                        {'safety': 'invalid'},
+                        {'safety': 'safe'},
+                        {'safety': 'safe'},
+                        {'safety': 'safe'},
+                        'invalid',
+                    ],
+                },
+                files={
+                    'content0': b'existing',
+                    'content1': read_asset('png.png'),
+                    'content2': read_asset('png.png'),
+                    'content3': read_asset('png.png'),
+                },
+                user=user_factory(rank=db.User.RANK_POWER)))
+    results = result['results']
+    assert [item['status'] for item in results] == [
+        'duplicate', 'error', 'created', 'duplicate', 'error', 'error']
+    assert results[0]['otherPostId'] == existing_post.post_id
+    assert results[1]['name'] == 'InvalidPostSafetyError'
+    assert results[3]['otherPostId'] == results[2]['postId']
+    assert results[4]['name'] == 'MissingRequiredFileError'
+    assert results[5]['name'] == 'InvalidParameterError'
+    assert db.session.query(db.Post).count() == 2
+
+
+@pytest.mark.parametrize('error', [
+    errors.ProcessingError('Failed to process'),
+    sqlalchemy.exc.IntegrityError('statement', {}, Exception()),
+    OSError('No space left on device'),
+])
+def test_importing_posts_with_failures_after_flush(
+        tmpdir, config_injector, context_factory, user_factory, tag_factory,
+        read_asset, error):
+    config_injector({
+        'data_dir': str(tmpdir.join('data')),
+        'data_url': 'example.com',
+        'thumbnails': {'post_width': 300, 'post_height': 300, 'queue': True},
+        'privileges': {
+            'posts:import': db.User.RANK_POWER,
+            'posts:create:identified': db.User.RANK_REGULAR,
+        },
+        'tag_index': {'enabled': True},
+        'similarity': {'enabled': True},
+    })
+    tag_index.get_index().invalidate()
+    similarity.get_index().invalidate()
+    db.session.add(tag_factory(names=['tag']))
+    db.session.commit()
+    assert tag_index.get_index().get_post_ids(db.session, 'tag') == []
+    assert similarity.get_index().find(db.session, '0' * 16, 0) == []
+    cache.put(('posts',), [], dependencies=('post',))
+    original_create = snapshots.create
+
+    def create_snapshot(entity, user):
+        if entity.source == 'bad':
+            raise error
+        original_create(entity, user)
+
+    try:
+        with patch('szurubooru.func.tags.export_to_json'), \
+                patch('szurubooru.func.snapshots.create') as create, \
+                patch.object(tag_index.TagIndex, '_load') as load_tags, \
+                patch.object(similarity.SimilarityIndex, '_load') \
+                as load_hashes:
+            create.side_effect = create_snapshot
+            result = api.post_api.import_posts(
+                context_factory(
+                    params={
+                        'items': [
+                            {'safety': 'safe', 'tags': ['tag']},
+                            {'safety': 'safe', 'tags': ['tag'],
+                             'source': 'bad'},
+                            {'safety': 'safe', 'tags': ['tag']},
+                        ],
+                    },
+                    files={
+                        'content0': read_asset('png.png'),
+                        'content1': read_asset('jpeg.jpg'),
+                        'content2': read_asset('gif.gif'),
+                    },
+                    user=user_factory(rank=db.User.RANK_POWER)))
+            results = result['results']
+            assert [item['status'] for item in results] \
+                == ['created', 'error', 'created']
+            post_ids = [results[0]['postId'], results[2]['postId']]
+            assert not cache.has(('posts',))
+            assert tag_index.get_index().get_post_ids(db.session, 'tag') \
+                == post_ids
+            for content, expected_post_ids in [
+                    (read_asset('png.png'), post_ids[0:1]),
+                    (read_asset('jpeg.jpg'), []),
+                    (read_asset('gif.gif'), post_ids[1:2])]:
+                matches = similarity.get_index().find(
+                    db.session, similarity.get_image_hash(content), 0)
+                assert [post_id for post_id, _ in matches] \
+                    == expected_post_ids
+            assert thumbnail_queue.get_queued_post_ids() == post_ids
+            assert not load_tags.called
+            assert not load_hashes.called
+    finally:
+        tag_index.get_index().invalidate()
+        similarity.get_index().invalidate()
+    assert db.session.query(db.Post).count() == 2
+
+
+def test_importing_posts_from_urls(context_factory, user_factory, read_asset):
+    with patch('szurubooru.func.tags.export_to_json'), \
+            patch('szurubooru.func.net.download'):
+        net.download.return_value = read_asset('png.png')
+        result = api.post_api.import_posts(
+            context_factory(
+                params={
+                    'anonymous': True,
+                    'items': [
+                        {'safety': 'safe', 'contentUrl': 'example.com'},
+                    ],
+                },
+                user=user_factory(rank=db.User.RANK_POWER)))
+        net.download.assert_called_once_with('example.com')
+    post = db.session.query(db.Post).get(result['results'][0]['postId'])
+    assert post.source == 'example.com'
+    assert post.user is None
+
+
+def test_importing_posts_in_bulk(
+        context_factory, user_factory, tag_factory, read_asset):
+    db.session.add(tag_factory(names=['tag']))
+    db.session.flush()
+    ctx = context_factory(
+        params={
+            'items': [
+                {'safety': 'safe', 'tags': ['tag']},
+                {'safety': 'safe', 'tags': ['tag']},
+            ],
+        },
+        files={
+            'content0': read_asset('png.png'),
+            'content1': read_asset('jpeg.jpg'),
+        },
+        user=user_factory(rank=db.User.RANK_POWER))
+    with patch('szurubooru.func.tags.export_to_json'), \
+            patch('szurubooru.func.posts.get_post_ids_by_checksums') \
+            as get_post_ids_by_checksums, \
+            patch('szurubooru.func.tags.get_tags_by_names') \
+            as get_tags_by_names:
+        get_post_ids_by_checksums.return_value = {}
+        get_tags_by_names.side_effect = lambda names: \
+            db.session.query(db.Tag).all()
+        api.post_api.import_posts(ctx)
+        get_post_ids_by_checksums.assert_called_once()
+        assert [
+            call_args for call_args in get_tags_by_names.call_args_list
+            if call_args[0][0]
+        ] == [call(['tag', 'tag'])]
+
+
+def test_trying_to_import_posts_without_privileges(
+        context_factory, user_factory):
+    with pytest.raises(errors.AuthError):
+        api.post_api.import_posts(
+            context_factory(
+                params={'items': []},
+                user=user_factory(rank=db.User.RANK_REGULAR)))
+
+
+def test_trying_to_import_posts_anonymously_without_privileges(
+        config_injector, context_factory, user_factory):
+    config_injector({
+        'privileges': {
+            'posts:import': db.User.RANK_POWER,
+            'posts:create:anonymous': db.User.RANK_ADMINISTRATOR,
+        },
+    })
+    with pytest.raises(errors.AuthError):
+        api.post_api.import_posts(
+            context_factory(
+                params={'items': [], 'anonymous': True},
+                user=user_factory(rank=db.User.RANK_POWER)))
@@ -0,0 +1,81 @@
+from unittest.mock import patch
+import pytest
+from szurubooru import api, db, errors
+from szurubooru.func import posts, similarity, util
+
+
+@pytest.fixture(autouse=True)
+def inject_config(config_injector):
+    config_injector({
+        'privileges': {'posts:reverse_search': db.User.RANK_REGULAR},
+        'similarity': {'enabled': True, 'max_distance': 10},
+    })
+    similarity.get_index().invalidate()
+    yield
+    similarity.get_index().invalidate()
+
+
+def test_reverse_searching(
+        user_factory, post_factory, context_factory, read_asset):
+    content = read_asset('png.png')
+    image_hash = similarity.get_image_hash(content)
+    exact_post = post_factory(id=1)
+    exact_post.checksum = util.get_sha1(content)
+    exact_post.image_hash = image_hash
+    similar_post = post_factory(id=2)
+    similar_post.image_hash = '%016x' % (int(image_hash, 16) ^ 0b101)
+    other_post = post_factory(id=3)
+    other_post.image_hash = '%016x' % (int(image_hash, 16) ^ (2 ** 64 - 1))
+    db.session.add_all([exact_post, similar_post, other_post])
+    db.session.commit()
+    with patch('szurubooru.func.posts.serialize_post'):
+        posts.serialize_post.side_effect = lambda post, *_args, **_kwargs: \
+            'serialized post %d' % post.post_id if post else None
+        result = api.post_api.get_posts_by_image(
+            context_factory(
+                files={'content': content},
+                user=user_factory(rank=db.User.RANK_REGULAR)))
+    assert result == {
+        'exactPost': 'serialized post 1',
+        'similarPosts': [
+            {'distance': 0, 'post': 'serialized post 1'},
+            {'distance': 2, 'post': 'serialized post 2'},
+        ],
+    }
+
+
+def test_reverse_searching_without_matches(
+        user_factory, context_factory, read_asset):
+    result = api.post_api.get_posts_by_image(
+        context_factory(
+            files={'content': read_asset('png.png')},
+            user=user_factory(rank=db.User.RANK_REGULAR)))
+    assert result == {'exactPost': None, 'similarPosts': []}
+
+
+def test_reverse_searching_when_disabled(
+        config_injector, user_factory, context_factory, read_asset):
+    config_injector({
+        'privileges': {'posts:reverse_search': db.User.RANK_REGULAR},
+        'similarity': {'enabled': False},
+    })
+    with pytest.raises(similarity.SimilaritySearchDisabledError):
+        api.post_api.get_posts_by_image(
+            context_factory(
+                files={'content': read_asset('png.png')},
+                user=user_factory(rank=db.User.RANK_REGULAR)))
+
+
+def test_trying_to_omit_content(user_factory, context_factory):
+    with pytest.raises(errors.MissingRequiredFileError):
+        api.post_api.get_posts_by_image(
+            context_factory(user=user_factory(rank=db.User.RANK_REGULAR)))
+
+
+def test_trying_to_reverse_search_without_privileges(
+        user_factory, context_factory, read_asset):
+    with pytest.raises(errors.AuthError):
+        api.post_api.get_posts_by_image(
+            context_factory(
+                files={'content': read_asset('png.png')},
+                user=user_factory(rank=db.User.RANK_ANONYMOUS)))
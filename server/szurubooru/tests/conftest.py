@@ -8,6 +8,7 @@ import pytest
 import freezegun
 import sqlalchemy
 from szurubooru import config, db, rest
+from szurubooru.func import cache
 
 
 class QueryCounter(object):
@@ -88,6 +89,7 @@ def session(query_logger):  # pylint: disable=unused-argument
         for table in reversed(db.Base.metadata.sorted_tables):
             db.session.execute(table.delete())
         db.session.commit()
+        cache.purge()
 
 
 @pytest.fixture
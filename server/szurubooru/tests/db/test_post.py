@@ -1,4 +1,6 @@
 from datetime import datetime
+from unittest.mock import MagicMock
+from sqlalchemy.dialects import postgresql
 from szurubooru import db
 
 
@@ -136,3 +138,62 @@ def test_tracking_tag_count(post_factory, tag_factory):
     db.session.refresh(post)
     assert len(post.tags) == 0
     assert post.tag_count == 0
+
+
+def test_tracking_comment_count(post_factory, user_factory, comment_factory):
+    user = user_factory()
+    post = post_factory()
+    comment1 = comment_factory(post=post, user=user)
+    comment1.creation_time = datetime(1997, 1, 1)
+    comment2 = comment_factory(post=post, user=user)
+    comment2.creation_time = datetime(1998, 1, 1)
+    db.session.add_all([user, post, comment1, comment2])
+    db.session.flush()
+    assert post.comment_count == 2
+    assert post.last_comment_creation_time == datetime(1998, 1, 1)
+    db.session.delete(comment2)
+    db.session.flush()
+    assert post.comment_count == 1
+    assert post.last_comment_creation_time == datetime(1997, 1, 1)
+
+
+def test_tracking_relation_count(post_factory):
+    post = post_factory()
+    related_post = post_factory()
+    db.session.add_all([post, related_post])
+    db.session.flush()
+    post.relations.append(related_post)
+    db.session.flush()
+    assert post.relation_count == 1
+    assert related_post.relation_count == 1
+    db.session.delete(related_post)
+    db.session.flush()
+    assert post.relation_count == 0
+
+
+def test_tracking_score(post_factory, user_factory):
+    user = user_factory()
+    post = post_factory()
+    db.session.add_all([user, post])
+    db.session.flush()
+    score = db.PostScore(
+        post=post, user=user, score=1, time=datetime(1997, 1, 1))
+    db.session.add(score)
+    db.session.flush()
+    assert post.score == 1
+    score.score = -1
+    db.session.flush()
+    assert post.score == -1
+    db.session.delete(score)
+    db.session.flush()
+    assert post.score == 0
+
+
+def test_locking_posts_before_updating_counters():
+    session = MagicMock()
+    db.post.update_counters(session, [2, 1])
+    lock_stmt, update_stmt = [
+        call[0][0].compile(dialect=postgresql.dialect())
+        for call in session.execute.call_args_list]
+    assert str(lock_stmt).endswith('FOR UPDATE')
+    assert str(update_stmt).startswith('UPDATE post')
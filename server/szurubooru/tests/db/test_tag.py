@@ -98,3 +98,22 @@ def test_tracking_post_count(post_factory, tag_factory):
     db.session.commit()
     db.session.refresh(tag)
     assert tag.post_count == 0
+
+
+def test_tracking_post_count_when_replacing_tags(post_factory, tag_factory):
+    tag1 = tag_factory()
+    tag2 = tag_factory()
+    post = post_factory()
+    post.tags = [tag1]
+    db.session.add_all([tag1, tag2, post])
+    db.session.flush()
+    assert tag1.post_count == 1
+    assert tag2.post_count == 0
+    post.tags = [tag1, tag2]
+    db.session.flush()
+    assert tag1.post_count == 1
+    assert tag2.post_count == 1
+    post.tags = [tag2]
+    db.session.flush()
+    assert tag1.post_count == 0
+    assert tag2.post_count == 1
@@ -0,0 +1,242 @@
+from datetime import timedelta
+import pytest
+from szurubooru.func import cache
+
+
+def _create_item(key, value, size=1):
+    return cache.LruCacheItem(key, value, size=size)
+
+
+def test_getting_missing_item():
+    lru_cache = cache.LruCache(max_size=10)
+    assert not lru_cache.has('key')
+    with pytest.raises(KeyError):
+        lru_cache.get('key')
+    assert lru_cache.misses == 2
+    assert lru_cache.hits == 0
+
+
+def test_inserting_and_getting_item():
+    lru_cache = cache.LruCache(max_size=10)
+    lru_cache.insert_item(_create_item('key', 'value'))
+    assert lru_cache.has('key')
+    assert lru_cache.get('key') == 'value'
+    assert lru_cache.hits == 1
+    assert lru_cache.size == 1
+
+
+def test_replacing_item():
+    lru_cache = cache.LruCache(max_size=10)
+    lru_cache.insert_item(_create_item('key', 'value1', size=3))
+    lru_cache.insert_item(_create_item('key', 'value2', size=4))
+    assert lru_cache.get('key') == 'value2'
+    assert len(lru_cache) == 1
+    assert lru_cache.size == 4
+
+
+def test_evicting_least_recently_used_item():
+    lru_cache = cache.LruCache(max_size=3)
+    lru_cache.insert_item(_create_item('key1', 'value1'))
+    lru_cache.insert_item(_create_item('key2', 'value2'))
+    lru_cache.insert_item(_create_item('key3', 'value3'))
+    lru_cache.get('key1')
+    lru_cache.insert_item(_create_item('key4', 'value4'))
+    assert lru_cache.has('key1')
+    assert not lru_cache.has('key2')
+    assert lru_cache.has('key3')
+    assert lru_cache.has('key4')
+    assert lru_cache.evictions == 1
+    assert lru_cache.size == 3
+
+
+def test_evicting_by_size():
+    lru_cache = cache.LruCache(max_size=10)
+    lru_cache.insert_item(_create_item('key1', 'value1', size=4))
+    lru_cache.insert_item(_create_item('key2', 'value2', size=4))
+    lru_cache.insert_item(_create_item('key3', 'value3', size=8))
+    assert not lru_cache.has('key1')
+    assert not lru_cache.has('key2')
+    assert lru_cache.has('key3')
+    assert lru_cache.evictions == 2
+    assert lru_cache.size == 8
+
+
+def test_skipping_items_larger_than_cache():
+    lru_cache = cache.LruCache(max_size=10)
+    lru_cache.insert_item(_create_item('key1', 'value1', size=4))
+    lru_cache.insert_item(_create_item('key2', 'value2', size=11))
+    assert lru_cache.has('key1')
+    assert not lru_cache.has('key2')
+    assert lru_cache.evictions == 0
+
+
+def test_expiring_items(fake_datetime):
+    lru_cache = cache.LruCache(max_size=10, delta=timedelta(minutes=1))
+    with fake_datetime('1997-01-01 00:00:00'):
+        lru_cache.insert_item(_create_item('key', 'value'))
+    with fake_datetime('1997-01-01 00:01:00'):
+        assert lru_cache.get('key') == 'value'
+    with fake_datetime('1997-01-01 00:01:01'):
+        assert not lru_cache.has('key')
+    assert len(lru_cache) == 0
+    assert lru_cache.size == 0
+
+
+def test_removing_items():
+    lru_cache = cache.LruCache(max_size=10)
+    lru_cache.insert_item(_create_item('key1', 'value1'))
+    lru_cache.insert_item(_create_item('key2', 'value2'))
+    lru_cache.remove_item('key1')
+    lru_cache.remove_item('missing')
+    assert not lru_cache.has('key1')
+    assert lru_cache.has('key2')
+    lru_cache.remove_all()
+    assert not lru_cache.has('key2')
+    assert lru_cache.size == 0
+
+
+def test_estimating_item_size():
+    small_item = cache.LruCacheItem('key', (1, ['a']))
+    big_item = cache.LruCacheItem('key', (1, ['a' * 1000]))
+    assert 0 < small_item.size < big_item.size
+
+
+def test_module_functions():
+    cache.purge()
+    cache.put('key', 'value')
+    assert cache.has('key')
+    assert cache.get('key') == 'value'
+    cache.remove('key')
+    assert not cache.has('key')
+    assert cache.get_stats()['items'] == 0
+
+
+def test_invalidating_dependent_items():
+    lru_cache = cache.LruCache(max_size=10)
+    lru_cache.insert_item(
+        cache.LruCacheItem('key1', 'value1', size=1, dependencies=['a']))
+    lru_cache.insert_item(
+        cache.LruCacheItem('key2', 'value2', size=1, dependencies=['a', 'b']))
+    lru_cache.insert_item(
+        cache.LruCacheItem('key3', 'value3', size=1, dependencies=['c']))
+    lru_cache.invalidate(['b'])
+    assert lru_cache.has('key1')
+    assert not lru_cache.has('key2')
+    assert lru_cache.has('key3')
+    lru_cache.invalidate(['a', 'c'])
+    assert len(lru_cache) == 0
+    assert lru_cache.size == 0
+
+
+def test_invalidating_items_without_dependencies():
+    lru_cache = cache.LruCache(max_size=10)
+    lru_cache.insert_item(cache.LruCacheItem('key1', 'value1', size=1))
+    lru_cache.insert_item(
+        cache.LruCacheItem('key2', 'value2', size=1, dependencies=[]))
+    lru_cache.invalidate(['a'])
+    assert not lru_cache.has('key1')
+    assert lru_cache.has('key2')
+
+
+@pytest.fixture
+def sqlite_backend_factory(tmpdir):
+    def factory(max_size=10 * 1024, delta=None):
+        return cache.SqliteBackend(
+            str(tmpdir.join('cache.sqlite')), max_size=max_size, delta=delta)
+    return factory
+
+
+def test_sqlite_backend_putting_and_getting(sqlite_backend_factory):
+    backend = sqlite_backend_factory()
+    assert not backend.has(('key', 1))
+    backend.put(('key', 1), (5, ['value']), dependencies=['post'])
+    assert backend.has(('key', 1))
+    assert backend.get(('key', 1)) == (5, ['value'])
+    backend.remove(('key', 1))
+    with pytest.raises(KeyError):
+        backend.get(('key', 1))
+    assert backend.get_stats()['hits'] == 1
+    assert backend.get_stats()['misses'] == 2
+
+
+def test_sqlite_backend_sharing_between_workers(sqlite_backend_factory):
+    worker1 = sqlite_backend_factory()
+    worker2 = sqlite_backend_factory()
+    worker1.put('posts', 'value1', dependencies=['post'])
+    worker1.put('users', 'value2', dependencies=['user'])
+    worker1.put('other', 'value3')
+    assert worker2.get('posts') == 'value1'
+    worker2.invalidate(['post'])
+    assert not worker1.has('posts')
+    assert worker1.has('users')
+    assert not worker1.has('other')
+    worker2.purge()
+    assert not worker1.has('users')
+
+
+def test_sqlite_backend_evicting(sqlite_backend_factory):
+    backend = sqlite_backend_factory(max_size=150)
+    backend.put('key1', b'x' * 40)
+    backend.put('key2', b'x' * 40)
+    backend.get('key1')
+    backend.put('key3', b'x' * 40)
+    assert backend.has('key1')
+    assert not backend.has('key2')
+    assert backend.has('key3')
+    assert backend.get_stats()['evictions'] == 1
+
+
+def test_sqlite_backend_expiring(sqlite_backend_factory, fake_datetime):
+    backend = sqlite_backend_factory(delta=timedelta(minutes=1))
+    with fake_datetime('1997-01-01 00:00:00'):
+        backend.put('key', 'value')
+    with fake_datetime('1997-01-01 00:00:59'):
+        assert backend.has('key')
+    with fake_datetime('1997-01-01 00:01:01'):
+        assert not backend.has('key')
+
+
+def test_measuring_entities(post_factory, user_factory):
+    post = post_factory()
+    bare_size = cache.LruCacheItem('key', post).size
+    post.user = user_factory(name='x' * 10000)
+    assert cache.LruCacheItem('key', post).size > bare_size + 10000
+
+
+def test_memory_backend_dropping_values_computed_before_invalidation():
+    backend = cache.MemoryBackend(max_size=1024)
+    generations = backend.get_generations(['post'])
+    backend.invalidate(['post'])
+    backend.put('key1', 'value', ['post'], generations=generations)
+    assert not backend.has('key1')
+    generations = backend.get_generations(['post'])
+    backend.invalidate(['user'])
+    backend.put('key2', 'value', ['post'], generations=generations)
+    assert backend.has('key2')
+
+
+def test_sqlite_backend_dropping_values_computed_before_invalidation(
+        sqlite_backend_factory):
+    worker1 = sqlite_backend_factory()
+    worker2 = sqlite_backend_factory()
+    generations = worker1.get_generations(['post'])
+    worker2.invalidate(['post'])
+    worker1.put('key1', 'value', ['post'], generations=generations)
+    assert not worker2.has('key1')
+    generations = worker1.get_generations(['post'])
+    worker1.put('key2', 'value', ['post'], generations=generations)
+    assert worker2.has('key2')
+
+
+def test_sqlite_backend_tracking_total_size(sqlite_backend_factory):
+    backend = sqlite_backend_factory(max_size=1024)
+    backend.put('key1', b'x' * 40)
+    backend.put('key1', b'x' * 40)
+    backend.put('key2', b'x' * 40)
+    size = backend.get_stats()['size']
+    backend.put('key3', b'x' * 40)
+    backend.remove('key3')
+    assert backend.get_stats()['size'] == size
+    assert backend.get_stats()['items'] == 2
+    backend.purge()
+    assert backend.get_stats()['size'] == 0
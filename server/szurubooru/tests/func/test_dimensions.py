@@ -0,0 +1,51 @@
+import struct
+import pytest
+from szurubooru.func import dimensions
+
+
+@pytest.mark.parametrize('input_path,expected_dimensions', [
+    ('png.png', (100, 100)),
+    ('png-broken.png', (100, 100)),
+    ('jpeg.jpg', (100, 75)),
+    ('gif.gif', (1, 1)),
+    ('gif-animated.gif', (1, 1)),
+    ('webm.webm', (8, 8)),
+    ('mp4.mp4', (8, 8)),
+    ('flash.swf', None),
+    ('text.txt', None),
+])
+def test_get_dimensions(read_asset, input_path, expected_dimensions):
+    assert dimensions.get_dimensions(read_asset(input_path)) \
+        == expected_dimensions
+
+
+@pytest.mark.parametrize('input_path', [
+    'png.png', 'jpeg.jpg', 'gif.gif', 'webm.webm', 'mp4.mp4',
+])
+def test_get_dimensions_of_truncated_content(read_asset, input_path):
+    content = read_asset(input_path)
+    for length in range(0, min(len(content), 1000), 7):
+        result = dimensions.get_dimensions(content[0:length])
+        assert result is None or result == dimensions.get_dimensions(content)
+
+
+def test_get_jpeg_dimensions_after_exif():
+    content = b'\xFF\xD8' \
+        + b'\xFF\xE1' + struct.pack('>H', 6) + b'Exif' \
+        + b'\xFF\xFF' \
+        + b'\xFF\xC2' + struct.pack('>HBHH', 17, 8, 480, 640)
+    assert dimensions.get_dimensions(content) == (640, 480)
+
+
+def test_get_mp4_dimensions_skipping_audio_tracks():
+    def box(box_type, content):
+        return struct.pack('>I', len(content) + 8) + box_type + content
+
+    def tkhd(width, height):
+        return box(b'tkhd', b'\x00' * 76 + struct.pack(
+            '>II', width << 16, height << 16))
+
+    content = box(b'ftyp', b'isom\x00\x00\x02\x00') \
+        + box(b'mdat', b'\x00' * 100) \
+        + box(b'moov', box(b'trak', tkhd(0, 0)) + box(b'trak', tkhd(64, 48)))
+    assert dimensions.get_dimensions(content) == (64, 48)
@@ -0,0 +1,255 @@
+import errno
+import os
+from unittest.mock import patch
+import pytest
+from szurubooru import errors
+from szurubooru.func import files
+
+
+class FakeS3Error(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3Body(object):
+    def __init__(self, content):
+        self.content = content
+
+    def read(self):
+        return self.content
+
+
+class FakeS3Client(object):
+    ''' Stand-in for the boto3 S3 client, keeping objects in memory. '''
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        content = Body.read() if hasattr(Body, 'read') else Body
+        self.objects[Bucket, Key] = (content, ContentType)
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3Error('404')
+        return {'ContentLength': len(self.objects[Bucket, Key][0])}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3Error('NoSuchKey')
+        return {'Body': FakeS3Body(self.objects[Bucket, Key][0])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self.objects[Bucket, Key] = \
+            self.objects[CopySource['Bucket'], CopySource['Key']]
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=0):
+        keys = sorted(
+            key for bucket, key in self.objects
+            if bucket == Bucket and key.startswith(Prefix))
+        page = keys[ContinuationToken:ContinuationToken + 2]
+        response = {
+            'Contents': [
+                {'Key': key, 'Size': len(self.objects[Bucket, key][0])}
+                for key in page],
+            'IsTruncated': ContinuationToken + 2 < len(keys),
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = ContinuationToken + 2
+        return response
+
+
+def _create_temporary_file(content):
+    handle, temporary_file = files.create_temporary_file()
+    with handle:
+        handle.write(content)
+    return temporary_file
+
+
+def test_saving_bytes(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir)})
+    files.save('dir/test.dat', b'content')
+    assert files.get('dir/test.dat') == b'content'
+
+
+def test_temporary_file(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir)})
+    temporary_file = _create_temporary_file(b'content')
+    assert temporary_file.path.startswith(
+        str(tmpdir.join('temporary-uploads')))
+    assert len(temporary_file) == 7
+    assert temporary_file.read() == b'content'
+    assert temporary_file.read(3) == b'con'
+    temporary_file.delete()
+    assert not os.path.exists(temporary_file.path)
+
+
+def test_saving_temporary_file(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir)})
+    temporary_file = _create_temporary_file(b'content')
+    old_path = temporary_file.path
+    files.save('dir/test.dat', temporary_file)
+    assert not os.path.exists(old_path)
+    assert temporary_file.is_stored
+    assert temporary_file.path == str(tmpdir.join('dir/test.dat'))
+    assert files.get('dir/test.dat') == b'content'
+    temporary_file.delete()
+    assert files.get('dir/test.dat') == b'content'
+
+
+def test_sharded_layout(tmpdir, config_injector):
+    config_injector({
+        'data_dir': str(tmpdir),
+        'data_url': 'http://example.com/data/',
+        'storage': {'layout': 'sharded'},
+    })
+    files.save('posts/1.png', b'content')
+    assert tmpdir.join('posts/4a/47/1.png').read_binary() == b'content'
+    assert files.has('posts/1.png')
+    assert files.get('posts/1.png') == b'content'
+    assert files.get_local_path('posts/1.png') \
+        == str(tmpdir.join('posts/4a/47/1.png'))
+    assert files.get_url('posts/1.png') \
+        == 'http://example.com/data/posts/4a/47/1.png'
+    files.move('posts/1.png', 'posts/2.png')
+    assert not files.has('posts/1.png')
+    assert files.get('posts/2.png') == b'content'
+    files.delete('posts/2.png')
+    assert not files.has('posts/2.png')
+
+
+@pytest.mark.parametrize('path,expected_key', [
+    ('posts/1.png', 'posts/4a/47/1.png'),
+    ('generated-thumbnails/2x-webp/1.webp',
+        'generated-thumbnails/2x-webp/36/b6/1.webp'),
+    ('tags.json', 'tags.json'),
+])
+def test_get_sharded_key(path, expected_key):
+    assert files.get_sharded_key(path) == expected_key
+
+
+def test_s3_storage(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir)})
+    client = FakeS3Client()
+    storage = files.S3Storage('bucket', prefix='data/', client=client)
+    assert not storage.has('posts/1.png')
+    assert storage.get('posts/1.png') is None
+    storage.save('posts/1.png', b'content')
+    assert client.objects['bucket', 'data/posts/1.png'] \
+        == (b'content', 'image/png')
+    assert storage.has('posts/1.png')
+    assert storage.get('posts/1.png') == b'content'
+    assert storage.get_local_path('posts/1.png') is None
+    storage.move('posts/1.png', 'posts/2.png')
+    assert not storage.has('posts/1.png')
+    assert storage.get('posts/2.png') == b'content'
+    temporary_file = _create_temporary_file(b'uploaded')
+    storage.save('posts/3.dat', temporary_file)
+    assert storage.get('posts/3.dat') == b'uploaded'
+    assert not temporary_file.is_stored
+    for post_id in range(4, 7):
+        storage.save('posts/%d.dat' % post_id, b'x')
+    assert storage.get_usage() == 18
+    storage.delete('posts/2.png')
+    assert not storage.has('posts/2.png')
+
+
+@pytest.mark.parametrize('storage_config', [
+    {'backend': 'ftp'},
+    {'backend': 's3', 's3': {'bucket': None}},
+])
+def test_invalid_storage_config(tmpdir, config_injector, storage_config):
+    config_injector({'data_dir': str(tmpdir), 'storage': storage_config})
+    with pytest.raises(errors.ConfigError):
+        files.get_storage()
+
+
+@pytest.mark.parametrize('fsync', [False, True])
+def test_saving_atomically(tmpdir, config_injector, fsync):
+    config_injector({'data_dir': str(tmpdir), 'storage': {'fsync': fsync}})
+    files.save('dir/test.dat', b'old content')
+    files.save('dir/test.dat', b'new content')
+    assert files.get('dir/test.dat') == b'new content'
+    assert tmpdir.join('dir').listdir() == [tmpdir.join('dir/test.dat')]
+
+
+def test_saving_deduplicated(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir)})
+    files.save('dir/1.dat', b'content', deduplicate=True)
+    files.save('dir/2.dat', b'content', deduplicate=True)
+    files.save('dir/3.dat', b'other content', deduplicate=True)
+    assert files.get('dir/1.dat') == b'content'
+    assert os.path.samefile(
+        str(tmpdir.join('dir/1.dat')), str(tmpdir.join('dir/2.dat')))
+    assert files.get_disk_usage() == len(b'content') + len(b'other content')
+    files.save('dir/2.dat', b'new content')
+    assert files.get('dir/1.dat') == b'content'
+    assert files.get('dir/2.dat') == b'new content'
+
+
+def test_saving_deduplicated_content_again(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir)})
+    files.save('dir/test.dat', b'content', deduplicate=True)
+    inode = os.stat(str(tmpdir.join('dir/test.dat'))).st_ino
+    files.save('dir/test.dat', b'content', deduplicate=True)
+    assert os.stat(str(tmpdir.join('dir/test.dat'))).st_ino == inode
+
+
+def test_saving_deduplicated_without_hard_links(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir)})
+    with patch('os.link', side_effect=OSError(errno.EPERM, 'Not permitted')):
+        files.save('dir/1.dat', b'content', deduplicate=True)
+        files.save('dir/2.dat', b'content', deduplicate=True)
+    assert files.get('dir/1.dat') == b'content'
+    assert files.get('dir/2.dat') == b'content'
+    assert tmpdir.join('dir').listdir(sort=True) == [
+        tmpdir.join('dir/1.dat'), tmpdir.join('dir/2.dat')]
+
+
+def test_saving_with_deduplication_disabled(tmpdir, config_injector):
+    config_injector({
+        'data_dir': str(tmpdir),
+        'storage': {'deduplicate': False},
+    })
+    files.save('dir/1.dat', b'content', deduplicate=True)
+    files.save('dir/2.dat', b'content', deduplicate=True)
+    assert files.get('dir/1.dat') == b'content'
+    assert not os.path.samefile(
+        str(tmpdir.join('dir/1.dat')), str(tmpdir.join('dir/2.dat')))
+    assert not tmpdir.join('.blobs').check()
+
+
+@pytest.mark.parametrize('fsync', [False, True])
+def test_writing_atomically(tmpdir, config_injector, fsync):
+    config_injector({'data_dir': str(tmpdir), 'storage': {'fsync': fsync}})
+    path = str(tmpdir.join('test.dat'))
+    files.write_atomically(path, b'old content')
+    files.write_atomically(path, b'new content')
+    with open(path, 'rb') as handle:
+        assert handle.read() == b'new content'
+    assert tmpdir.listdir() == [tmpdir.join('test.dat')]
+
+
+def test_batched_sync(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir), 'storage': {'fsync': True}})
+    with files.batched_sync():
+        files.save('dir/1.dat', b'content 1')
+        files.save('dir/1.dat', b'content 2')
+        files.save('other-dir/2.dat', b'content 3')
+        assert not files.has('dir/1.dat')
+    assert files.get('dir/1.dat') == b'content 2'
+    assert files.get('other-dir/2.dat') == b'content 3'
+    assert len(tmpdir.join('dir').listdir()) == 1
+
+
+def test_batched_sync_failing(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir), 'storage': {'fsync': True}})
+    with pytest.raises(RuntimeError):
+        with files.batched_sync():
+            files.save('dir/1.dat', b'content')
+            raise RuntimeError()
+    assert tmpdir.join('dir').listdir() == []
@@ -0,0 +1,175 @@
+import subprocess
+from unittest.mock import patch
+import pytest
+from szurubooru import errors
+from szurubooru.func import images
+
+
+@pytest.fixture
+def popen_counter():
+    popen = subprocess.Popen
+    with patch('subprocess.Popen') as mock:
+        mock.side_effect = popen
+        yield mock
+
+
+@pytest.mark.parametrize('input_file,expected_width,expected_height', [
+    ('png.png', 100, 100),
+    ('jpeg.jpg', 100, 75),
+    ('gif.gif', 1, 1),
+    ('webm.webm', 8, 8),
+    ('mp4.mp4', 8, 8),
+])
+def test_getting_dimensions(
+        read_asset, input_file, expected_width, expected_height):
+    image = images.Image(read_asset(input_file))
+    assert image.width == expected_width
+    assert image.height == expected_height
+
+
+@pytest.mark.parametrize('input_file,expected_width,expected_height', [
+    ('png.png', 30, 30),
+    ('jpeg.jpg', 30, 22),
+    ('gif-animated.gif', 30, 30),
+    ('webm.webm', 30, 30),
+    ('mp4.mp4', 30, 30),
+])
+def test_creating_thumbnail_in_single_run(
+        read_asset, popen_counter, input_file, expected_width,
+        expected_height):
+    image = images.Image(read_asset(input_file))
+    image.resize_fill(30, 20)
+    assert (image.width, image.height) == (expected_width, expected_height)
+    thumbnail = images.Image(image.to_jpeg())
+    assert (thumbnail.width, thumbnail.height) \
+        == (expected_width, expected_height)
+    # one probe and one conversion, plus the probe of the result
+    assert popen_counter.call_count == 3
+
+
+@pytest.mark.parametrize('input_file', [
+    'png.png', 'gif-animated.gif', 'webm.webm',
+])
+def test_creating_variants_in_single_run(
+        read_asset, popen_counter, input_file):
+    image = images.Image(read_asset(input_file))
+    outputs = image.to_variants([
+        (30, 20, 'jpeg'),
+        (60, 40, 'webp'),
+        (30, 20, 'png'),
+    ])
+    # one probe and one conversion
+    assert popen_counter.call_count == 2
+    assert outputs[0][0:3] == b'\xFF\xD8\xFF'
+    assert outputs[1][8:12] == b'WEBP'
+    assert outputs[2][0:4] == b'\x89PNG'
+    sizes = [
+        (images.Image(output).width, images.Image(output).height)
+        for output in outputs]
+    assert sizes == [(30, 30), (60, 60), (30, 30)]
+
+
+def test_creating_variants_without_encoder(read_asset):
+    image = images.Image(read_asset('png.png'))
+    with patch.dict(images._ENCODERS, {
+            'webp': (['-vcodec', 'missing', '-f', 'webp'], 'WEBP', True)}):
+        outputs = image.to_variants([
+            (30, 20, 'jpeg'),
+            (60, 40, 'webp'),
+            (30, 20, 'png'),
+        ])
+    assert outputs[0][0:3] == b'\xFF\xD8\xFF'
+    assert outputs[1] is None
+    assert outputs[2][0:4] == b'\x89PNG'
+
+
+def test_creating_variants_of_broken_content(read_asset):
+    image = images.Image(read_asset('png-broken.png'))
+    with pytest.raises(errors.ProcessingError):
+        image.to_variants([(30, 20, 'jpeg'), (30, 20, 'png')])
+
+
+def test_creating_variants_in_unknown_format(read_asset):
+    image = images.Image(read_asset('png.png'))
+    with pytest.raises(errors.ProcessingError):
+        image.to_variants([(30, 20, 'bmp')])
+
+
+def test_reading_files_in_place(tmpdir, read_asset, popen_counter):
+    path = str(tmpdir.join('image.dat'))
+    with open(path, 'wb') as handle:
+        handle.write(read_asset('png.png'))
+    image = images.Image(path=path)
+    image.resize_fill(20, 10)
+    png = image.to_png()
+    assert popen_counter.call_count == 2
+    assert all(path in call[0][0] for call in popen_counter.call_args_list)
+    thumbnail = images.Image(png)
+    assert (thumbnail.width, thumbnail.height) == (20, 20)
+
+
+def test_resizing_broken_image(read_asset):
+    image = images.Image(read_asset('png-broken.png'))
+    with pytest.raises(errors.ProcessingError):
+        image.resize_fill(30, 30)
+
+
+@pytest.mark.skipif(images.PIL is None, reason='Pillow is not installed')
+@pytest.mark.parametrize(
+    'input_file,expected_backend,expected_width,expected_height', [
+        ('png.png', 'pillow', 30, 30),
+        ('jpeg.jpg', 'pillow', 30, 22),
+        ('gif.gif', 'pillow', 30, 30),
+        ('gif-animated.gif', 'ffmpeg', 30, 30),
+        ('webm.webm', 'ffmpeg', 30, 30),
+        ('mp4.mp4', 'ffmpeg', 30, 30),
+        ('png-broken.png', 'pillow', None, None),
+    ])
+def test_creating_thumbnail_with_pillow(
+        config_injector, read_asset, popen_counter, input_file,
+        expected_backend, expected_width, expected_height):
+    config_injector({'thumbnails': {'backend': 'pillow'}})
+    image = images.Image(read_asset(input_file))
+    assert image.backend == expected_backend
+    if expected_width is None:
+        with pytest.raises(errors.ProcessingError):
+            image.resize_fill(30, 20)
+            image.to_jpeg()
+        return
+    image.resize_fill(30, 20)
+    jpeg = image.to_jpeg()
+    if expected_backend == 'pillow':
+        assert popen_counter.call_count == 0
+    config_injector({})
+    thumbnail = images.Image(jpeg)
+    assert (thumbnail.width, thumbnail.height) \
+        == (expected_width, expected_height)
+
+
+@pytest.mark.skipif(images.PIL is None, reason='Pillow is not installed')
+def test_reading_files_in_place_with_pillow(
+        tmpdir, config_injector, read_asset, popen_counter):
+    config_injector({'thumbnails': {'backend': 'pillow'}})
+    path = str(tmpdir.join('image.dat'))
+    with open(path, 'wb') as handle:
+        handle.write(read_asset('png.png'))
+    image = images.Image(path=path)
+    assert (image.width, image.height) == (100, 100)
+    image.resize_fill(20, 10)
+    thumbnail = images.Image(image.to_png())
+    assert (thumbnail.width, thumbnail.height) == (20, 20)
+    assert popen_counter.call_count == 0
+
+
+@pytest.mark.skipif(images.PIL is None, reason='Pillow is not installed')
+def test_creating_variants_with_pillow(
+        config_injector, read_asset, popen_counter):
+    config_injector({'thumbnails': {'backend': 'pillow'}})
+    image = images.Image(read_asset('jpeg.jpg'))
+    outputs = image.to_variants([(30, 20, 'jpeg'), (60, 40, 'png')])
+    assert popen_counter.call_count == 0
+    config_injector({})
+    sizes = [
+        (images.Image(output).width, images.Image(output).height)
+        for output in outputs]
+    assert sizes == [(30, 22), (60, 45)]
@@ -1,3 +1,4 @@
+import io
 import pytest
 from szurubooru.func import mime
 
@@ -15,6 +16,12 @@ def test_get_mime_type(read_asset, input_path, expected_mime_type):
     assert mime.get_mime_type(read_asset(input_path)) == expected_mime_type
 
 
+def test_get_mime_type_from_file(read_asset):
+    handle = io.BytesIO(read_asset('png.png'))
+    assert mime.get_mime_type_from_file(handle) == 'image/png'
+    assert handle.tell() == 0
+
+
 def test_get_mime_type_for_empty_file():
     assert mime.get_mime_type(b'') == 'application/octet-stream'
 
@@ -74,3 +81,27 @@ def test_is_image(input_mime_type, expected_state):
 ])
 def test_is_animated_gif(read_asset, input_path, expected_state):
     assert mime.is_animated_gif(read_asset(input_path)) == expected_state
+
+
+@pytest.mark.parametrize('input_path,expected_state', [
+    ('gif.gif', False),
+    ('gif-animated.gif', True),
+    ('png.png', False),
+])
+def test_is_animated_gif_from_file(read_asset, input_path, expected_state):
+    handle = io.BytesIO(read_asset(input_path))
+    assert mime.is_animated_gif_from_file(handle) == expected_state
+    assert handle.tell() == 0
+
+
+def test_is_animated_gif_stops_at_second_frame(read_asset):
+    content = read_asset('gif-animated.gif')
+    second_frame = content.index(b'\x2C', content.index(b'\x2C') + 1)
+    # anything after the second image separator is never looked at
+    assert mime.is_animated_gif(content[:second_frame + 1])
+    assert mime.is_animated_gif(content[:second_frame + 1] + b'garbage')
+
+
+def test_is_animated_gif_with_truncated_content(read_asset):
+    content = read_asset('gif-animated.gif')
+    assert not mime.is_animated_gif(content[:30])
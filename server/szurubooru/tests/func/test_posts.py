@@ -2,8 +2,10 @@ import os
 from unittest.mock import patch
 from datetime import datetime
 import pytest
-from szurubooru import db
-from szurubooru.func import (posts, users, comments, tags, images, files, util)
+from szurubooru import db, errors
+from szurubooru.func import (
+    posts, users, comments, tags, images, files, util, dimensions,
+    similarity, thumbnail_queue)
 
 
 @pytest.mark.parametrize('input_mime_type,expected_url', [
@@ -157,6 +159,9 @@ def test_serialize_post(
             'canvasHeight': 300,
             'contentUrl': 'http://example.com/posts/1.jpg',
             'thumbnailUrl': 'http://example.com/generated-thumbnails/1.jpg',
+            'thumbnailVariants': {
+                '1x-jpeg': 'http://example.com/generated-thumbnails/1.jpg',
+            },
             'flags': ['loop'],
             'tags': ['tag1', 'tag3'],
             'relations': [],
@@ -223,6 +228,19 @@ def test_get_post_by_id(post_factory):
         posts.get_post_by_id('-')
 
 
+def test_get_post_ids_by_checksums(post_factory):
+    post1 = post_factory()
+    post2 = post_factory()
+    post1.checksum = 'checksum1'
+    post2.checksum = 'checksum2'
+    db.session.add_all([post1, post2])
+    db.session.flush()
+    assert posts.get_post_ids_by_checksums([]) == {}
+    assert posts.get_post_ids_by_checksums(
+        ['checksum1', 'checksum2', 'checksum3', 'checksum1']) \
+        == {'checksum1': post1.post_id, 'checksum2': post2.post_id}
+
+
 def test_create_post(user_factory, fake_datetime):
     with patch('szurubooru.func.posts.update_post_content'), \
             patch('szurubooru.func.posts.update_post_tags'), \
@@ -232,7 +250,8 @@ def test_create_post(user_factory, fake_datetime):
         assert post.creation_time == datetime(1997, 1, 1)
         assert post.last_edit_time is None
         posts.update_post_tags.assert_called_once_with(post, ['tag'])
-        posts.update_post_content.assert_called_once_with(post, 'content')
+        posts.update_post_content.assert_called_once_with(
+            post, 'content', check_for_duplicates=True)
 
 
 @pytest.mark.parametrize('input_safety,expected_safety', [
@@ -342,6 +361,9 @@ def test_update_post_content_to_existing_content(
     db.session.flush()
     with pytest.raises(posts.PostAlreadyUploadedError):
         posts.update_post_content(another_post, read_asset('png.png'))
+    posts.update_post_content(
+        another_post, read_asset('png.png'), check_for_duplicates=False)
+    assert another_post.checksum == post.checksum
 
 
 def test_update_post_content_with_broken_content(
@@ -361,8 +383,71 @@ def test_update_post_content_with_broken_content(
     db.session.add_all([post, another_post])
     posts.update_post_content(post, read_asset('png-broken.png'))
     db.session.flush()
-    assert post.canvas_width is None
-    assert post.canvas_height is None
+    # the header is intact, so its dimensions are still known
+    assert post.canvas_width == 100
+    assert post.canvas_height == 100
+    with patch('szurubooru.func.dimensions.get_dimensions'):
+        dimensions.get_dimensions.return_value = None
+        posts.update_post_content(
+            another_post,
+            read_asset('png-broken.png'),
+            check_for_duplicates=False)
+    db.session.flush()
+    assert another_post.canvas_width is None
+    assert another_post.canvas_height is None
+
+
+def test_update_post_content_from_temporary_file(
+        tmpdir, config_injector, post_factory, read_asset):
+    config_injector({
+        'data_dir': str(tmpdir.mkdir('data')),
+        'thumbnails': {
+            'post_width': 300,
+            'post_height': 300,
+        },
+    })
+    handle, content = files.create_temporary_file()
+    with handle:
+        handle.write(read_asset('jpeg.jpg'))
+    temporary_path = content.path
+    post = post_factory()
+    db.session.add(post)
+    posts.update_post_content(post, content)
+    db.session.flush()
+    assert post.mime_type == 'image/jpeg'
+    assert post.type == db.Post.TYPE_IMAGE
+    assert post.checksum == util.get_sha1(read_asset('jpeg.jpg'))
+    assert post.file_size == len(read_asset('jpeg.jpg'))
+    assert post.canvas_width == 100
+    assert post.canvas_height == 75
+    assert not os.path.exists(temporary_path)
+    assert files.get('posts/1.jpg') == read_asset('jpeg.jpg')
+    assert os.path.exists(str(tmpdir) + '/data/generated-thumbnails/1.jpg')
+
+
+@pytest.mark.parametrize('enabled', [True, False])
+def test_update_post_content_computing_image_hash(
+        tmpdir, config_injector, post_factory, read_asset, enabled):
+    config_injector({
+        'data_dir': str(tmpdir.mkdir('data')),
+        'thumbnails': {
+            'post_width': 300,
+            'post_height': 300,
+        },
+        'similarity': {'enabled': enabled},
+    })
+    post = post_factory()
+    db.session.add(post)
+    posts.update_post_content(post, read_asset('png.png'))
+    db.session.flush()
+    if enabled:
+        assert post.image_hash == \
+            similarity.get_image_hash(read_asset('png.png'))
+    else:
+        assert post.image_hash is None
+    posts.update_post_image_hash(post)
+    assert post.image_hash == \
+        similarity.get_image_hash(read_asset('png.png'))
 
 
 @pytest.mark.parametrize('input_content', [None, b'not a media file'])
@@ -490,6 +575,177 @@ def test_update_post_content_leaving_custom_thumbnail(
     assert os.path.exists(str(tmpdir) + '/data/generated-thumbnails/1.jpg')
 
 
+def test_generating_post_thumbnail_variants(
+        tmpdir, config_injector, read_asset, post_factory):
+    config_injector({
+        'data_dir': str(tmpdir.mkdir('data')),
+        'data_url': 'http://example.com/',
+        'thumbnails': {
+            'post_width': 30,
+            'post_height': 30,
+            'post_variants': [
+                {'scale': 2, 'format': 'jpeg'},
+                {'scale': 1, 'format': 'webp'},
+                {'scale': 1, 'format': 'jpeg'},
+            ],
+        },
+    })
+    post = post_factory(id=1)
+    db.session.add(post)
+    posts.update_post_content(post, read_asset('png.png'))
+    db.session.flush()
+    assert posts.get_post_thumbnail_variant_urls(post) == {
+        '1x-jpeg': 'http://example.com/generated-thumbnails/1.jpg',
+        '2x-jpeg': 'http://example.com/generated-thumbnails/2x-jpeg/1.jpg',
+        '1x-webp': 'http://example.com/generated-thumbnails/1x-webp/1.webp',
+    }
+    image = images.Image(files.get('generated-thumbnails/1.jpg'))
+    assert (image.width, image.height) == (30, 30)
+    image = images.Image(files.get('generated-thumbnails/2x-jpeg/1.jpg'))
+    assert (image.width, image.height) == (60, 60)
+    assert files.get('generated-thumbnails/1x-webp/1.webp')[8:12] == b'WEBP'
+
+
+def test_generating_post_thumbnail_variants_of_broken_content(
+        tmpdir, config_injector, read_asset, post_factory):
+    config_injector({
+        'data_dir': str(tmpdir.mkdir('data')),
+        'thumbnails': {
+            'post_width': 30,
+            'post_height': 30,
+            'post_variants': [{'scale': 1, 'format': 'webp'}],
+        },
+    })
+    post = post_factory(id=1)
+    db.session.add(post)
+    posts.update_post_content(
+        post, read_asset('png-broken.png'), check_for_duplicates=False)
+    db.session.flush()
+    assert files.get('generated-thumbnails/1.jpg') == posts.EMPTY_PIXEL
+    assert files.get('generated-thumbnails/1x-webp/1.webp') \
+        == posts.EMPTY_PIXEL
+
+
+def test_generating_post_thumbnail_variants_without_encoder(
+        tmpdir, config_injector, read_asset, post_factory):
+    config_injector({
+        'data_dir': str(tmpdir.mkdir('data')),
+        'thumbnails': {
+            'post_width': 30,
+            'post_height': 30,
+            'post_variants': [
+                {'scale': 1, 'format': 'webp'},
+                {'scale': 2, 'format': 'jpeg'},
+            ],
+        },
+    })
+    post = post_factory(id=1)
+    db.session.add(post)
+    with patch.dict(images._ENCODERS, {
+            'webp': (['-vcodec', 'missing', '-f', 'webp'], 'WEBP', True)}):
+        posts.update_post_content(post, read_asset('png.png'))
+        db.session.flush()
+    image = images.Image(files.get('generated-thumbnails/1.jpg'))
+    assert (image.width, image.height) == (30, 30)
+    image = images.Image(files.get('generated-thumbnails/2x-jpeg/1.jpg'))
+    assert (image.width, image.height) == (60, 60)
+    assert files.get('generated-thumbnails/1x-webp/1.webp') \
+        == posts.EMPTY_PIXEL
+
+
+def test_invalid_post_thumbnail_variants(config_injector):
+    config_injector({
+        'thumbnails': {'post_variants': [{'scale': 1, 'format': 'bmp'}]},
+    })
+    with pytest.raises(errors.ConfigError):
+        posts.get_thumbnail_variants()
+
+
+def test_queueing_post_thumbnail(
+        tmpdir, config_injector, read_asset, post_factory):
+    config_injector({
+        'data_dir': str(tmpdir.mkdir('data')),
+        'thumbnails': {
+            'post_width': 300,
+            'post_height': 300,
+            'queue': True,
+        },
+    })
+    thumbnail_path = str(tmpdir) + '/data/generated-thumbnails/1.jpg'
+    post = post_factory(id=1)
+    db.session.add(post)
+    posts.update_post_content(post, read_asset('png.png'))
+    db.session.flush()
+    with open(thumbnail_path, 'rb') as handle:
+        assert handle.read() == posts.EMPTY_PIXEL
+    assert thumbnail_queue.get_queued_post_ids() == []
+    db.session.commit()
+    assert thumbnail_queue.get_queued_post_ids() == [1]
+
+    assert posts.generate_queued_post_thumbnail()
+    assert not posts.generate_queued_post_thumbnail()
+    assert thumbnail_queue.get_queued_post_ids() == []
+    with open(thumbnail_path, 'rb') as handle:
+        assert handle.read() != posts.EMPTY_PIXEL
+
+
+def test_queueing_post_thumbnail_of_rolled_back_post(
+        tmpdir, config_injector, read_asset, post_factory):
+    config_injector({
+        'data_dir': str(tmpdir.mkdir('data')),
+        'thumbnails': {
+            'post_width': 300,
+            'post_height': 300,
+            'queue': True,
+        },
+    })
+    post = post_factory(id=1)
+    db.session.add(post)
+    posts.update_post_content(post, read_asset('png.png'))
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+    assert thumbnail_queue.get_queued_post_ids() == []
+
+
+def test_queueing_post_thumbnail_around_rolled_back_savepoint(
+        tmpdir, config_injector, read_asset, post_factory):
+    config_injector({
+        'data_dir': str(tmpdir.mkdir('data')),
+        'thumbnails': {
+            'post_width': 300,
+            'post_height': 300,
+            'queue': True,
+        },
+    })
+    post1 = post_factory(id=1)
+    db.session.add(post1)
+    posts.update_post_content(post1, read_asset('png.png'))
+    db.session.flush()
+    db.session.begin_nested()
+    post2 = post_factory(id=2)
+    db.session.add(post2)
+    posts.update_post_content(post2, read_asset('jpeg.jpg'))
+    db.session.flush()
+    db.session.rollback()
+    db.session.begin_nested()
+    post3 = post_factory(id=3)
+    db.session.add(post3)
+    posts.update_post_content(post3, read_asset('gif.gif'))
+    db.session.commit()
+    assert thumbnail_queue.get_queued_post_ids() == []
+    db.session.commit()
+    assert thumbnail_queue.get_queued_post_ids() == [1, 3]
+
+
+def test_generating_queued_thumbnail_of_deleted_post(
+        tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir.mkdir('data'))})
+    thumbnail_queue.add(1)
+    assert posts.generate_queued_post_thumbnail()
+    assert thumbnail_queue.get_queued_post_ids() == []
+
+
 def test_update_post_tags(tag_factory):
     post = db.Post()
     with patch('szurubooru.func.tags.get_or_create_tags_by_names'):
@@ -604,3 +860,22 @@ def test_delete(post_factory):
     posts.delete(post)
     db.session.flush()
     assert posts.get_post_count() == 0
+
+
+def test_repairing_stale_counters(post_factory, tag_factory):
+    post = post_factory()
+    post.tags = [tag_factory(), tag_factory()]
+    other_post = post_factory()
+    db.session.add_all([post, other_post])
+    db.session.flush()
+    assert posts.get_post_ids_with_stale_counters() == []
+    db.session.execute(
+        db.Post.__table__.update().values(tag_count=5, score=3))
+    assert posts.get_post_ids_with_stale_counters() == [
+        post.post_id, other_post.post_id]
+    posts.update_post_counters([post.post_id])
+    assert posts.get_post_ids_with_stale_counters() == [other_post.post_id]
+    posts.update_post_counters()
+    assert posts.get_post_ids_with_stale_counters() == []
+    assert post.tag_count == 2
+    assert other_post.score == 0
@@ -0,0 +1,203 @@
+import random
+from unittest.mock import patch
+import pytest
+from szurubooru import db
+from szurubooru.func import images, similarity
+
+
+@pytest.fixture(autouse=True)
+def inject_config(config_injector):
+    config_injector({
+        'similarity': {'enabled': True, 'max_distance': 10},
+    })
+    similarity.get_index().invalidate()
+    yield
+    similarity.get_index().invalidate()
+
+
+def _get_distance(image_hash1, image_hash2):
+    return bin(int(image_hash1, 16) ^ int(image_hash2, 16)).count('1')
+
+
+@pytest.mark.parametrize('input_path', [
+    'png.png', 'jpeg.jpg', 'gif-animated.gif', 'webm.webm', 'mp4.mp4',
+])
+def test_get_image_hash(read_asset, input_path):
+    image_hash = similarity.get_image_hash(read_asset(input_path))
+    assert len(image_hash) == 16
+    assert int(image_hash, 16) >= 0
+
+
+def test_get_image_hash_of_resized_image(read_asset):
+    image = images.Image(read_asset('jpeg.jpg'))
+    image.resize_fill(50, 37)
+    original_hash = similarity.get_image_hash(read_asset('jpeg.jpg'))
+    resized_hash = similarity.get_image_hash(image.to_png())
+    assert _get_distance(original_hash, resized_hash) <= 4
+
+
+def test_get_image_hash_of_broken_content(read_asset):
+    assert similarity.get_image_hash(read_asset('png-broken.png')) is None
+
+
+def test_finding_matches_brute_force():
+    randomizer = random.Random(0)
+    base = randomizer.getrandbits(64)
+    values = {}
+    for post_id in range(1, 501):
+        value = base
+        for _ in range(randomizer.randint(0, 20)):
+            value ^= 1 << randomizer.randint(0, 63)
+        values[post_id] = value
+    buckets = similarity._create_buckets()
+    for post_id, value in values.items():
+        similarity._add(buckets, post_id, value)
+    for max_distance in (0, 3, 4, 10, 15):
+        expected = sorted(
+            (
+                (post_id, bin(base ^ value).count('1'))
+                for post_id, value in values.items()
+                if bin(base ^ value).count('1') <= max_distance),
+            key=lambda item: (item[1], item[0]))
+        assert similarity._find(buckets, base, max_distance) == expected
+
+
+def test_index_following_changes(post_factory):
+    post1 = post_factory(id=1)
+    post2 = post_factory(id=2)
+    post3 = post_factory(id=3)
+    post1.image_hash = '0000000000000000'
+    post2.image_hash = '0000000000000003'
+    post3.image_hash = 'ffffffffffffffff'
+    db.session.add_all([post1, post2, post3])
+    db.session.commit()
+    assert similarity.find_similar('0000000000000001') == [(1, 1), (2, 1)]
+    assert similarity.find_similar(
+        '0000000000000001', exclude_post_id=1) == [(2, 1)]
+    post3.image_hash = '0000000000000001'
+    db.session.commit()
+    assert similarity.find_similar('0000000000000001') \
+        == [(3, 0), (1, 1), (2, 1)]
+    db.session.delete(post1)
+    db.session.commit()
+    assert similarity.find_similar('0000000000000001') == [(3, 0), (2, 1)]
+    post2.image_hash = None
+    db.session.rollback()
+    assert similarity.find_similar('0000000000000001') == [(3, 0), (2, 1)]
+    post2.image_hash = None
+    db.session.commit()
+    assert similarity.find_similar('0000000000000001') == [(3, 0)]
+
+
+def test_index_following_changes_around_savepoints(post_factory):
+    post1 = post_factory(id=1)
+    post2 = post_factory(id=2)
+    db.session.add_all([post1, post2])
+    db.session.commit()
+    assert similarity.find_similar('0000000000000000') == []
+    post1.image_hash = '0000000000000000'
+    db.session.flush()
+    db.session.begin_nested()
+    post2.image_hash = '0000000000000001'
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+    with patch.object(similarity.SimilarityIndex, '_load') as load:
+        assert similarity.find_similar('0000000000000000') == [(1, 0)]
+        assert not load.called
+
+
+def test_index_replacing_hashes_of_indexed_posts():
+    buckets = similarity._create_buckets()
+    similarity._add(buckets, 1, 0)
+    similarity._add(buckets, 1, 0)
+    similarity._add(buckets, 1, 0xffff)
+    assert similarity._find(buckets, 0, 0) == []
+    assert similarity._find(buckets, 0xffff, 0) == [(1, 0)]
+    assert sum(
+        len(post_ids)
+        for chunk_buckets in buckets[0]
+        for post_ids, _values in chunk_buckets.values()) == 4
+
+
+def test_index_applying_changes_it_already_has(post_factory):
+    post = post_factory(id=1)
+    post.image_hash = '0000000000000000'
+    db.session.add(post)
+    db.session.commit()
+    index = similarity.get_index()
+    assert index.find(db.session, '0000000000000000', 0) == [(1, 0)]
+    # a commit made while loading can be both loaded and applied afterwards
+    generation = db.get_index_generation(db.session, 'similarity')
+    index.apply_changes([generation + 1], [(1, '0000000000000000')])
+    index.apply_changes([generation + 2], [(1, '000000000000ffff')])
+    db.bump_index_generation(db.session, 'similarity')
+    db.bump_index_generation(db.session, 'similarity')
+    with patch.object(similarity.SimilarityIndex, '_load') as load:
+        assert index.find(db.session, '0000000000000000', 0) == []
+        assert index.find(db.session, '000000000000ffff', 0) == [(1, 0)]
+        assert not load.called
+
+
+def test_find_similar_limits(config_injector, post_factory):
+    config_injector({
+        'similarity': {'enabled': True, 'max_distance': 1, 'max_results': 2},
+    })
+    for post_id, image_hash in enumerate(
+            ['0000000000000000', '0000000000000001',
+             '0000000000000002', '0000000000000003'], 1):
+        post = post_factory(id=post_id)
+        post.image_hash = image_hash
+        db.session.add(post)
+    db.session.commit()
+    assert similarity.find_similar('0000000000000000') == [(1, 0), (2, 1)]
+
+
+def test_find_similar_with_zero_distance(config_injector, post_factory):
+    config_injector({'similarity': {'enabled': True, 'max_distance': 0}})
+    post1 = post_factory(id=1)
+    post2 = post_factory(id=2)
+    post1.image_hash = '0000000000000000'
+    post2.image_hash = '0000000000000001'
+    db.session.add_all([post1, post2])
+    db.session.commit()
+    assert similarity.get_max_distance() == 0
+    assert similarity.find_similar('0000000000000000') == [(1, 0)]
+
+
+def test_index_following_other_processes(post_factory):
+    post1 = post_factory(id=1)
+    post2 = post_factory(id=2)
+    post1.image_hash = '0000000000000000'
+    db.session.add_all([post1, post2])
+    db.session.commit()
+    assert similarity.find_similar('0000000000000000') == [(1, 0)]
+    # statements bypassing the session hooks, as if sent by another process
+    db.session.execute(
+        db.Post.__table__.update()
+        .where(db.Post.post_id == 2)
+        .values(image_hash='0000000000000001'))
+    db.bump_index_generation(db.session, 'similarity')
+    db.session.commit()
+    assert similarity.find_similar('0000000000000000') == [(1, 0), (2, 1)]
+
+
+def test_find_similar_while_loading_in_background(post_factory):
+    post1 = post_factory(id=1)
+    post2 = post_factory(id=2)
+    post1.image_hash = '0000000000000000'
+    post2.image_hash = '00000000000000ff'
+    db.session.add_all([post1, post2])
+    db.session.commit()
+    index = similarity.get_index()
+    with patch.object(index, '_start_loader'), \
+            patch.object(index, '_in_background', True):
+        assert index.find(db.session, '0000000000000000', 10) is None
+        assert similarity.find_similar('0000000000000001') \
+            == [(1, 1), (2, 7)]
+
+
+def test_find_similar_when_disabled(config_injector):
+    config_injector({'similarity': {'enabled': False}})
+    with pytest.raises(similarity.SimilaritySearchDisabledError):
+        similarity.find_similar('0000000000000000')
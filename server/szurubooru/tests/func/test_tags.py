@@ -1,9 +1,15 @@
 import os
+import fcntl
+import gzip
 import json
+import threading
+import time
 from unittest.mock import patch
 from datetime import datetime
 import pytest
 from szurubooru import db
+# pylint: disable=unused-import
+from szurubooru.middleware import cache_purger
 from szurubooru.func import tags, tag_categories, cache
 
 
@@ -134,6 +140,127 @@ def test_export_to_json(
         }
 
 
+def test_export_to_json_with_delta(tmpdir, config_injector, tag_factory):
+    config_injector({
+        'data_dir': str(tmpdir),
+        'tag_export': {'delta': True},
+    })
+    tag1 = tag_factory(names=['tag1'])
+    tag2 = tag_factory(names=['tag2'])
+    db.session.add_all([tag1, tag2])
+    db.session.flush()
+    tags.export_to_json()
+    assert not os.path.exists(os.path.join(str(tmpdir), 'tags-delta.json'))
+
+    tag1.names[0].name = 'renamed'
+    tag3 = tag_factory(names=['tag3'])
+    db.session.add(tag3)
+    db.session.flush()
+    tags.export_to_json()
+
+    with open(os.path.join(str(tmpdir), 'tags.json'), 'r') as handle:
+        assert json.loads(handle.read())['version'] == 2
+    with open(os.path.join(str(tmpdir), 'tags-delta.json'), 'r') as handle:
+        delta = json.loads(handle.read())
+    assert delta['version'] == 2
+    assert delta['baseVersion'] == 1
+    assert sorted(tag['names'][0] for tag in delta['tags']) \
+        == ['renamed', 'tag3']
+    assert delta['removedTags'] == ['tag1']
+    assert sorted(os.listdir(str(tmpdir))) \
+        == ['tags-delta.json', 'tags.json', 'tags.lock']
+
+
+def test_export_to_json_with_artifacts(tmpdir, config_injector, tag_factory):
+    config_injector({
+        'data_dir': str(tmpdir),
+        'tag_export': {'artifacts': True},
+    })
+    tag = tag_factory(names=['tag1'])
+    db.session.add(tag)
+    db.session.flush()
+    tags.export_to_json()
+    with open(os.path.join(str(tmpdir), 'tags-manifest.json'), 'r') as handle:
+        first_manifest = json.loads(handle.read())
+    with open(os.path.join(str(tmpdir), 'tags.json'), 'rb') as handle:
+        content = handle.read()
+    with open(os.path.join(str(tmpdir), first_manifest['path']), 'rb') \
+            as handle:
+        assert handle.read() == content
+    with gzip.open(
+            os.path.join(str(tmpdir), 'tags.json.gz'), 'rb') as handle:
+        assert handle.read() == content
+    assert first_manifest['size'] == len(content)
+    assert first_manifest['encodings']['gzip']['path'] \
+        == first_manifest['path'] + '.gz'
+
+    tag.names[0].name = 'tag2'
+    db.session.flush()
+    tags.export_to_json()
+    tag.names[0].name = 'tag3'
+    db.session.flush()
+    tags.export_to_json()
+    with open(os.path.join(str(tmpdir), 'tags-manifest.json'), 'r') as handle:
+        manifest = json.loads(handle.read())
+    assert manifest['path'] != first_manifest['path']
+    assert not os.path.exists(
+        os.path.join(str(tmpdir), first_manifest['path']))
+    assert len([
+        name for name in os.listdir(str(tmpdir))
+        if name.endswith('.json') and name.count('.') == 2]) == 2
+
+
+def test_export_to_json_with_artifacts_and_delta(
+        tmpdir, config_injector, tag_factory):
+    config_injector({
+        'data_dir': str(tmpdir),
+        'tag_export': {'artifacts': True, 'delta': True},
+    })
+    db.session.add(tag_factory(names=['tag1']))
+    db.session.flush()
+    tags.export_to_json()
+    with open(os.path.join(str(tmpdir), 'tags-manifest.json'), 'r') as handle:
+        first_manifest = json.loads(handle.read())
+    tags.export_to_json()
+    with open(os.path.join(str(tmpdir), 'tags-manifest.json'), 'r') as handle:
+        manifest = json.loads(handle.read())
+    assert first_manifest['version'] == 1
+    assert manifest['version'] == 2
+    assert manifest['path'] == first_manifest['path']
+    with open(os.path.join(str(tmpdir), manifest['path']), 'r') as handle:
+        assert 'version' not in json.loads(handle.read())
+
+
+def test_export_to_json_in_background(config_injector):
+    config_injector({'tag_export': {'delay': 0.05, 'max_delay': 1}})
+    done = threading.Event()
+    with patch('szurubooru.func.tags._export_to_json'):
+        tags._export_to_json.side_effect = lambda: done.set()
+        tags.export_to_json()
+        tags.export_to_json()
+        tags.export_to_json()
+        assert not tags._export_to_json.called
+        assert done.wait(5)
+        time.sleep(0.1)
+        assert tags._export_to_json.call_count == 1
+
+
+def test_export_to_json_waiting_for_other_processes(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir), 'tag_export': {}})
+    export_path = os.path.join(str(tmpdir), 'tags.json')
+    with open(os.path.join(str(tmpdir), 'tags.lock'), 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        with patch('szurubooru.func.tags._collect_export_data'):
+            tags._collect_export_data.return_value = {}
+            thread = threading.Thread(target=tags.export_to_json)
+            thread.start()
+            time.sleep(0.1)
+            assert not os.path.exists(export_path)
+            fcntl.flock(handle, fcntl.LOCK_UN)
+            thread.join(5)
+    assert os.path.exists(export_path)
+
+
 @pytest.mark.parametrize('name_to_search,expected_to_find', [
     ('name', True),
     ('NAME', True),
@@ -196,6 +323,23 @@ def test_get_tag_by_names(names, expected_indexes, tag_factory):
     assert actual_ids == expected_ids
 
 
+def test_get_tag_ids_by_names(tag_factory):
+    tag1 = tag_factory(names=['tag1', 'alias1'])
+    tag2 = tag_factory(names=['tag2'])
+    db.session.add_all([tag1, tag2])
+    db.session.commit()
+    assert tags.get_tag_ids_by_names([]) == []
+    assert tags.get_tag_ids_by_names(['TAG1', 'alias1']) == [tag1.tag_id]
+    assert tags.get_tag_ids_by_names(['alias1', 'tag2', 'missing']) \
+        == sorted([tag1.tag_id, tag2.tag_id])
+    assert cache.has(('tag-id', ('alias1', 'missing', 'tag2')))
+    tag3 = tag_factory(names=['missing'])
+    db.session.add(tag3)
+    db.session.commit()
+    assert tags.get_tag_ids_by_names(['missing', 'tag2', 'alias1']) \
+        == sorted([tag1.tag_id, tag2.tag_id, tag3.tag_id])
+
+
 @pytest.mark.parametrize(
     'names,expected_indexes,expected_created_names', [
         ([], [], []),
@@ -251,6 +395,24 @@ def test_get_or_create_tags_by_names(
     assert actual_created_names == expected_created_names
 
 
+def test_get_or_create_tags_by_names_in_bulk(
+        query_counter, tag_factory, tag_category_factory, config_injector):
+    config_injector({'tag_name_regex': '.*'})
+    category = tag_category_factory(default=True)
+    existing_tag = tag_factory(names=['name1', 'alias1'], category=category)
+    db.session.add(existing_tag)
+    db.session.flush()
+    names = ['new%d' % i for i in range(100)] + ['ALIAS1']
+    with query_counter:
+        existing_tags, new_tags = tags.get_or_create_tags_by_names(names)
+        assert len(query_counter.statements) <= 3
+    assert existing_tags == [existing_tag]
+    assert [tag.names[0].name for tag in new_tags] == names[:-1]
+    assert all(tag.category == category for tag in new_tags)
+    db.session.flush()
+    assert tags.get_tag_by_name('new99').tag_id is not None
+
+
 def test_get_tag_siblings_for_unused(tag_factory):
     tag = tag_factory(names=['tag'])
     db.session.add(tag)
@@ -529,3 +691,22 @@ def test_update_tag_description(tag_factory):
     tag = tag_factory()
     tags.update_tag_description(tag, 'test')
     assert tag.description == 'test'
+
+
+def test_recounting_stale_post_counts(tag_factory, post_factory):
+    tag1 = tag_factory()
+    tag2 = tag_factory()
+    post = post_factory()
+    post.tags = [tag1, tag2]
+    db.session.add_all([tag1, tag2, post])
+    db.session.flush()
+    assert tags.get_tag_ids_with_stale_post_counts() == []
+    db.session.execute(db.Tag.__table__.update().values(post_count=5))
+    assert tags.get_tag_ids_with_stale_post_counts() == [
+        tag1.tag_id, tag2.tag_id]
+    tags.update_tag_post_counts([tag1.tag_id])
+    assert tags.get_tag_ids_with_stale_post_counts() == [tag2.tag_id]
+    tags.update_tag_post_counts()
+    assert tags.get_tag_ids_with_stale_post_counts() == []
+    assert tag1.post_count == 1
+    assert tag2.post_count == 1
@@ -0,0 +1,62 @@
+import os
+from unittest.mock import patch
+import pytest
+from szurubooru.func import thumbnail_queue
+
+
+@pytest.fixture(autouse=True)
+def inject_config(tmpdir, config_injector):
+    config_injector({
+        'data_dir': str(tmpdir.mkdir('data')),
+        'thumbnails': {'queue_timeout': 60},
+    })
+
+
+def test_is_enabled(config_injector):
+    assert not thumbnail_queue.is_enabled()
+    config_injector({'thumbnails': {'queue': True}})
+    assert thumbnail_queue.is_enabled()
+
+
+def test_claiming_in_order(tmpdir):
+    thumbnail_queue.add(2)
+    os.utime(str(tmpdir) + '/data/thumbnail-queue/2', (1, 1))
+    thumbnail_queue.add(1)
+    thumbnail_queue.add(3)
+    assert thumbnail_queue.get_queued_post_ids() == [1, 2, 3]
+    job = thumbnail_queue.claim()
+    assert job.post_id == 2
+    assert thumbnail_queue.get_queued_post_ids() == [1, 3]
+    thumbnail_queue.complete(job)
+    assert not os.path.exists(job.path)
+
+
+def test_claiming_from_empty_queue():
+    assert thumbnail_queue.claim() is None
+
+
+def test_claiming_posts_once():
+    thumbnail_queue.add(1)
+    assert thumbnail_queue.claim().post_id == 1
+    assert thumbnail_queue.claim() is None
+
+
+def test_requeueing_claimed_post():
+    thumbnail_queue.add(1)
+    job = thumbnail_queue.claim()
+    thumbnail_queue.add(1)
+    thumbnail_queue.complete(job)
+    assert thumbnail_queue.get_queued_post_ids() == [1]
+
+
+def test_releasing_stale_jobs():
+    thumbnail_queue.add(1)
+    thumbnail_queue.add(2)
+    with patch('time.time') as time:
+        time.return_value = 1000
+        thumbnail_queue.claim()
+        time.return_value = 1030
+        thumbnail_queue.claim()
+        time.return_value = 1061
+        assert thumbnail_queue.release_stale_jobs() == 1
+    assert len(thumbnail_queue.get_queued_post_ids()) == 1
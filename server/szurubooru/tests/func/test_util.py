@@ -1,3 +1,4 @@
+import io
 from datetime import datetime
 import pytest
 from szurubooru import errors
@@ -38,3 +39,9 @@ def test_parsing_date_time(fake_datetime, input, output):
 ])
 def test_icase_unique(input, output):
     assert util.icase_unique(input) == output
+
+
+def test_get_sha1_from_file():
+    content = b'content' * 1000
+    assert util.get_sha1_from_file(io.BytesIO(content), chunk_size=100) \
+        == util.get_sha1(content)
@@ -0,0 +1,110 @@
+import pytest
+from szurubooru import db
+from szurubooru.func import cache
+from szurubooru.middleware import cache_purger  # pylint: disable=unused-import
+
+
+@pytest.fixture(autouse=True)
+def populated_cache():
+    cache.purge()
+    cache.put('posts', 'dummy', dependencies=['post', 'tag'])
+    cache.put('tags', 'dummy', dependencies=['tag', 'tag_category'])
+    cache.put('users', 'dummy', dependencies=['user'])
+    cache.put('snapshots', 'dummy', dependencies=['snapshot', 'user'])
+    yield
+    cache.purge()
+
+
+def test_invalidating_on_insert(user_factory):
+    db.session.add(user_factory())
+    db.session.commit()
+    assert cache.has('posts')
+    assert cache.has('tags')
+    assert not cache.has('users')
+    assert not cache.has('snapshots')
+
+
+def test_invalidating_on_update(tag_category_factory):
+    category = tag_category_factory()
+    db.session.add(category)
+    db.session.commit()
+    cache.put('tags', 'dummy', dependencies=['tag', 'tag_category'])
+    category.color = 'new color'
+    db.session.commit()
+    assert cache.has('posts')
+    assert not cache.has('tags')
+    assert cache.has('users')
+
+
+def test_invalidating_on_post_tags_change(post_factory, tag_factory):
+    post = post_factory()
+    db.session.add(post)
+    db.session.commit()
+    cache.put('tags', 'dummy', dependencies=['tag', 'tag_category'])
+    post.tags = [tag_factory()]
+    db.session.commit()
+    assert not cache.has('posts')
+    assert not cache.has('tags')
+    assert cache.has('users')
+
+
+def test_invalidating_on_delete(user_factory):
+    user = user_factory()
+    db.session.add(user)
+    db.session.commit()
+    cache.put('users', 'dummy', dependencies=['user'])
+    db.session.delete(user)
+    db.session.commit()
+    assert not cache.has('users')
+    assert cache.has('posts')
+
+
+def test_invalidating_dependency_free_entries(user_factory):
+    cache.put('other', 'dummy')
+    db.session.add(user_factory())
+    db.session.commit()
+    assert not cache.has('other')
+
+
+def test_not_invalidating_on_rollback(user_factory):
+    db.session.add(user_factory())
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+    assert cache.has('users')
+
+
+def test_not_invalidating_without_changes():
+    db.session.commit()
+    assert cache.has('posts')
+    assert cache.has('users')
+
+
+def test_invalidating_after_rolled_back_savepoint(user_factory):
+    db.session.add(user_factory())
+    db.session.flush()
+    savepoint = db.session.begin_nested()
+    db.session.add(user_factory())
+    db.session.flush()
+    savepoint.rollback()
+    db.session.commit()
+    assert not cache.has('users')
+
+
+def test_invalidating_only_after_outermost_commit(user_factory):
+    savepoint = db.session.begin_nested()
+    db.session.add(user_factory())
+    db.session.flush()
+    savepoint.commit()
+    assert cache.has('users')
+    db.session.commit()
+    assert not cache.has('users')
+
+
+def test_not_invalidating_on_rolled_back_savepoint(user_factory):
+    savepoint = db.session.begin_nested()
+    db.session.add(user_factory())
+    db.session.flush()
+    savepoint.rollback()
+    db.session.commit()
+    assert cache.has('users')
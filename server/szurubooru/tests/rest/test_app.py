@@ -0,0 +1,81 @@
+import io
+import os
+import pytest
+from szurubooru import rest
+
+
+_BOUNDARY = 'boundary'
+
+
+def _create_multipart_body(metadata, content):
+    return (
+        '--{0}\r\n'
+        'Content-Disposition: form-data; name="metadata"\r\n\r\n'
+        '{1}\r\n'
+        '--{0}\r\n'
+        'Content-Disposition: form-data; name="content"; '
+        'filename="file.dat"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+        .format(_BOUNDARY, metadata).encode('utf-8')
+        + content
+        + '\r\n--{0}--\r\n'.format(_BOUNDARY).encode('utf-8'))
+
+
+def _create_env(body, stream=None):
+    return {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/posts/',
+        'CONTENT_TYPE': 'multipart/form-data; boundary=' + _BOUNDARY,
+        'CONTENT_LENGTH': str(len(body)),
+        'HTTP_ACCEPT': 'application/json',
+        'wsgi.input': stream or io.BytesIO(body),
+    }
+
+
+class _InterruptedStream(io.BytesIO):
+    ''' Stream that breaks down after the first chunks are read. '''
+
+    def __init__(self, content, limit):
+        super().__init__(content)
+        self._limit = limit
+
+    def _check(self):
+        if self.tell() >= self._limit:
+            raise ConnectionResetError('Connection reset by peer')
+
+    def read(self, size=-1):
+        self._check()
+        return super().read(size)
+
+    def readline(self, size=-1):
+        self._check()
+        return super().readline(size)
+
+
+@pytest.fixture(autouse=True)
+def inject_config(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir)})
+
+
+def _get_temporary_files(tmpdir):
+    path = str(tmpdir.join('temporary-uploads'))
+    return os.listdir(path) if os.path.exists(path) else []
+
+
+def test_deleting_spooled_files_of_invalid_requests(tmpdir):
+    body = _create_multipart_body('{invalid', b'x' * 10000)
+    statuses = []
+    rest.application(
+        _create_env(body),
+        lambda status, _headers: statuses.append(status))
+    assert statuses[0].startswith('400')
+    assert _get_temporary_files(tmpdir) == []
+
+
+def test_deleting_spooled_files_of_interrupted_requests(tmpdir):
+    body = _create_multipart_body('{}', b'x\n' * 100000)
+    with pytest.raises(ConnectionResetError):
+        rest.application(
+            _create_env(body, _InterruptedStream(body, len(body) // 2)),
+            lambda _status, _headers: None)
+    assert _get_temporary_files(tmpdir) == []
@@ -1,8 +1,9 @@
 # pylint: disable=unexpected-keyword-arg
+import os
 import unittest.mock
 import pytest
 from szurubooru import rest, errors
-from szurubooru.func import net
+from szurubooru.func import net, files
 
 
 def test_has_param():
@@ -27,6 +28,20 @@ def test_get_file_from_url():
         net.download.assert_called_once_with('example.com')
 
 
+def test_deleting_temporary_files(tmpdir, config_injector):
+    config_injector({'data_dir': str(tmpdir)})
+    handle, temporary_file = files.create_temporary_file()
+    handle.close()
+    ctx = rest.Context(
+        method=None,
+        url=None,
+        files={'key': temporary_file, 'key2': b'content'})
+    assert ctx.get_file('key') is temporary_file
+    assert os.path.exists(temporary_file.path)
+    ctx.delete_temporary_files()
+    assert not os.path.exists(temporary_file.path)
+
+
 def test_getting_list_parameter():
     ctx = rest.Context(
         method=None, url=None, params={'key': 'value', 'list': list('123')})
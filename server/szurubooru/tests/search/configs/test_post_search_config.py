@@ -1,7 +1,9 @@
 # pylint: disable=redefined-outer-name
 from datetime import datetime
+from unittest.mock import patch
 import pytest
 from szurubooru import db, errors, search
+from szurubooru.func import tag_index, similarity
 
 
 @pytest.fixture
@@ -625,6 +627,228 @@ def test_anonymous(
     verify_unpaged(input, expected_post_ids)
 
 
+@pytest.mark.parametrize('input,expected_post_ids', [
+    ('t1', [1, 3]),
+    ('t1 t2', [3]),
+    ('t1 -t2', [1]),
+    ('t1,t4a', [1, 3, 4]),
+    ('t1,t4a -t2', [1, 4]),
+    ('t1 -t2,t3', [1]),
+    ('t1 t5*', []),
+    ('t1 -t5*', [1, 3]),
+    ('T1 T2', [3]),
+    ('t1 missing', []),
+    ('-t1', [2, 4]),
+])
+def test_anonymous_with_tag_index(
+        verify_unpaged,
+        config_injector,
+        post_factory,
+        tag_factory,
+        input,
+        expected_post_ids):
+    config_injector({'tag_index': {'enabled': True}})
+    tag_index.get_index().invalidate()
+    tag1 = tag_factory(names=['t1'])
+    tag2 = tag_factory(names=['t2'])
+    post1 = post_factory(id=1)
+    post2 = post_factory(id=2)
+    post3 = post_factory(id=3)
+    post4 = post_factory(id=4)
+    post1.tags = [tag1]
+    post2.tags = [tag2]
+    post3.tags = [tag1, tag2]
+    post4.tags = [tag_factory(names=['t4a', 't4b'])]
+    db.session.add_all([post1, post2, post3, post4])
+    db.session.commit()
+    try:
+        verify_unpaged(input, expected_post_ids)
+    finally:
+        tag_index.get_index().invalidate()
+
+
+def test_tag_index_following_changes(
+        executor, config_injector, post_factory, tag_factory):
+    config_injector({'tag_index': {'enabled': True, 'max_results': 2}})
+    tag_index.get_index().invalidate()
+    tag1 = tag_factory(names=['t1'])
+    tag2 = tag_factory(names=['t2'])
+    post1 = post_factory(id=1)
+    post2 = post_factory(id=2)
+    post3 = post_factory(id=3)
+    post1.tags = [tag1]
+    post2.tags = [tag1, tag2]
+    db.session.add_all([post1, post2, post3])
+    db.session.commit()
+    try:
+        assert tag_index.get_index().get_post_ids(db.session, 't1') == [1, 2]
+        post3.tags = [tag1]
+        post2.tags = [tag2]
+        db.session.commit()
+        assert tag_index.get_index().get_post_ids(db.session, 't1') == [1, 3]
+        db.session.delete(post1)
+        db.session.commit()
+        assert tag_index.get_index().get_post_ids(db.session, 't1') == [3]
+        post3.tags = [tag2]
+        db.session.rollback()
+        assert tag_index.get_index().get_post_ids(db.session, 't1') == [3]
+        _count, posts = executor.execute('t2', page=1, page_size=100)
+        assert sorted(post.post_id for post in posts) == [2]
+    finally:
+        tag_index.get_index().invalidate()
+
+
+def test_tag_index_falling_back_to_sql(
+        verify_unpaged, config_injector, post_factory, tag_factory):
+    config_injector({'tag_index': {'enabled': True, 'max_results': 1}})
+    tag_index.get_index().invalidate()
+    tag = tag_factory(names=['t1'])
+    posts = [post_factory(id=i) for i in range(1, 4)]
+    for post in posts:
+        post.tags = [tag]
+    db.session.add_all(posts)
+    db.session.commit()
+    try:
+        verify_unpaged('t1', [1, 2, 3])
+    finally:
+        tag_index.get_index().invalidate()
+
+
+def test_tag_index_following_renames(
+        config_injector, post_factory, tag_factory):
+    config_injector({'tag_index': {'enabled': True}})
+    tag_index.get_index().invalidate()
+    tag = tag_factory(names=['t1'])
+    post = post_factory(id=1)
+    post.tags = [tag]
+    db.session.add(post)
+    db.session.commit()
+    try:
+        assert tag_index.get_index().get_post_ids(db.session, 't1') == [1]
+        with patch.object(tag_index.TagIndex, '_load') as load:
+            tag.names[0].name = 'T2'
+            db.session.commit()
+            assert tag_index.get_index().get_post_ids(db.session, 't1') == []
+            assert tag_index.get_index().get_post_ids(db.session, 't2') \
+                == [1]
+            assert not load.called
+    finally:
+        tag_index.get_index().invalidate()
+
+
+def test_tag_index_following_other_processes(
+        config_injector, post_factory, tag_factory):
+    config_injector({'tag_index': {'enabled': True}})
+    tag_index.get_index().invalidate()
+    tag = tag_factory(names=['t1'])
+    post1 = post_factory(id=1)
+    post2 = post_factory(id=2)
+    post1.tags = [tag]
+    db.session.add_all([post1, post2])
+    db.session.commit()
+    try:
+        assert tag_index.get_index().get_post_ids(db.session, 't1') == [1]
+        # statements bypassing the session hooks, as if sent by another
+        # process
+        db.session.execute(db.PostTag.__table__.insert().values(
+            post_id=2, tag_id=tag.tag_id))
+        db.bump_index_generation(db.session, 'tag_index')
+        db.session.commit()
+        assert tag_index.get_index().get_post_ids(db.session, 't1') \
+            == [1, 2]
+    finally:
+        tag_index.get_index().invalidate()
+
+
+def test_tag_index_reloading_after_changes_committed_while_loading(
+        config_injector, post_factory, tag_factory):
+    config_injector({'tag_index': {'enabled': True}})
+    index = tag_index.get_index()
+    index.invalidate()
+    tag = tag_factory(names=['t1'])
+    post1 = post_factory(id=1)
+    post2 = post_factory(id=2)
+    post1.tags = [tag]
+    db.session.add_all([post1, post2])
+    db.session.commit()
+    original_load = tag_index.TagIndex._load
+
+    def load_and_let_other_process_commit(self, session):
+        data = original_load(self, session)
+        session.execute(db.PostTag.__table__.insert().values(
+            post_id=2, tag_id=tag.tag_id))
+        db.bump_index_generation(session, 'tag_index')
+        session.commit()
+        return data
+
+    try:
+        with patch.object(
+                tag_index.TagIndex,
+                '_load',
+                load_and_let_other_process_commit):
+            assert index.get_post_ids(db.session, 't1') == [1]
+        assert index.get_post_ids(db.session, 't1') == [1, 2]
+    finally:
+        index.invalidate()
+
+
+def test_tag_index_loading_in_background(
+        verify_unpaged, config_injector, post_factory, tag_factory):
+    config_injector({'tag_index': {'enabled': True}})
+    index = tag_index.get_index()
+    index.invalidate()
+    post = post_factory(id=1)
+    post.tags = [tag_factory(names=['t1'])]
+    db.session.add(post)
+    db.session.commit()
+    with patch.object(index, '_start_loader'), \
+            patch.object(index, '_in_background', True):
+        assert index.get_post_ids(db.session, 't1') is None
+        assert index._start_loader.called
+        verify_unpaged('t1', [1])
+        index.load(db.session)
+        assert index.get_post_ids(db.session, 't1') == [1]
+    index.invalidate()
+
+
+@pytest.mark.parametrize('input,expected_post_ids', [
+    ('similar:1', [2, 3]),
+    ('similar:3', [1, 2]),
+    ('similar:4', []),
+    ('similar:5', []),
+    ('-similar:1', [1, 4]),
+])
+def test_filter_by_similar(
+        verify_unpaged, config_injector, post_factory, input,
+        expected_post_ids):
+    config_injector({'similarity': {'enabled': True, 'max_distance': 4}})
+    similarity.get_index().invalidate()
+    post1 = post_factory(id=1)
+    post2 = post_factory(id=2)
+    post3 = post_factory(id=3)
+    post4 = post_factory(id=4)
+    post1.image_hash = '0000000000000000'
+    post2.image_hash = '000000000000000f'
+    post3.image_hash = '0000000000000007'
+    db.session.add_all([post1, post2, post3, post4])
+    db.session.commit()
+    try:
+        verify_unpaged(input, expected_post_ids)
+    finally:
+        similarity.get_index().invalidate()
+
+
+@pytest.mark.parametrize('input,enabled', [
+    ('similar:1', False),
+    ('similar:x', True),
+    ('similar:1,2', True),
+])
+def test_filter_by_similar_errors(executor, config_injector, input, enabled):
+    config_injector({'similarity': {'enabled': enabled}})
+    with pytest.raises(errors.SearchError):
+        executor.execute(input, page=1, page_size=100)
+
+
 def test_own_liked(
         auth_executor,
         post_factory,
@@ -0,0 +1,128 @@
+# pylint: disable=redefined-outer-name
+from datetime import datetime
+import pytest
+from szurubooru import db, errors, search
+
+
+@pytest.fixture
+def post_executor():
+    return search.Executor(search.configs.PostSearchConfig())
+
+
+def _collect_forward(executor, query, page_size):
+    pages = []
+    cursor = ''
+    while cursor is not None:
+        _count, entities, cursor, _prev = executor.execute_with_cursor(
+            query, cursor, page_size)
+        pages.append(entities)
+    return pages
+
+
+def test_paging_forward(post_executor, post_factory):
+    posts = [post_factory(id=i) for i in range(1, 6)]
+    db.session.add_all(posts)
+    db.session.flush()
+    count, entities, next_cursor, prev_cursor = \
+        post_executor.execute_with_cursor('', '', 2)
+    assert count == 5
+    assert [post.post_id for post in entities] == [5, 4]
+    assert next_cursor
+    assert prev_cursor is None
+    pages = _collect_forward(post_executor, '', 2)
+    assert [[post.post_id for post in page] for page in pages] \
+        == [[5, 4], [3, 2], [1]]
+
+
+def test_paging_backward(post_executor, post_factory):
+    posts = [post_factory(id=i) for i in range(1, 6)]
+    db.session.add_all(posts)
+    db.session.flush()
+    _count, _entities, next_cursor, _prev_cursor = \
+        post_executor.execute_with_cursor('', '', 2)
+    _count, entities, next_cursor, prev_cursor = \
+        post_executor.execute_with_cursor('', next_cursor, 2)
+    assert [post.post_id for post in entities] == [3, 2]
+    _count, entities, next_cursor, prev_cursor = \
+        post_executor.execute_with_cursor('', prev_cursor, 2)
+    assert [post.post_id for post in entities] == [5, 4]
+    assert prev_cursor is None
+    assert next_cursor
+
+
+def test_paging_with_ties_and_nulls(post_factory):
+    executor = search.Executor(search.configs.PostSearchConfig())
+    posts = [post_factory(id=i) for i in range(1, 6)]
+    posts[0].last_edit_time = datetime(2016, 1, 1)
+    posts[1].last_edit_time = datetime(2016, 1, 2)
+    posts[2].last_edit_time = datetime(2016, 1, 2)
+    db.session.add_all(posts)
+    db.session.flush()
+    pages = _collect_forward(executor, 'sort:edit-date', 2)
+    post_ids = [post.post_id for page in pages for post in page]
+    assert post_ids == [3, 2, 1, 5, 4]
+
+
+def test_paging_tags(tag_factory):
+    executor = search.Executor(search.configs.TagSearchConfig())
+    db.session.add_all([tag_factory(names=[name]) for name in 'cabed'])
+    db.session.flush()
+    pages = _collect_forward(executor, '', 2)
+    assert [[tag.names[0].name for tag in page] for page in pages] \
+        == [['a', 'b'], ['c', 'd'], ['e']]
+
+
+def test_empty_result(post_executor):
+    count, entities, next_cursor, prev_cursor = \
+        post_executor.execute_with_cursor('', '', 2)
+    assert count == 0
+    assert entities == []
+    assert next_cursor is None
+    assert prev_cursor is None
+
+
+@pytest.mark.parametrize('cursor', ['garbage', '!!!', 'W10'])
+def test_invalid_cursor(post_executor, cursor):
+    with pytest.raises(errors.SearchError):
+        post_executor.execute_with_cursor('', cursor, 2)
+
+
+def test_cursor_from_different_query(post_executor, post_factory):
+    db.session.add_all([post_factory(id=i) for i in range(1, 4)])
+    db.session.flush()
+    _count, _entities, next_cursor, _prev_cursor = \
+        post_executor.execute_with_cursor('', '', 1)
+    with pytest.raises(errors.SearchError):
+        post_executor.execute_with_cursor('sort:score', next_cursor, 1)
+
+
+def test_random_sort(post_executor):
+    with pytest.raises(errors.SearchError):
+        post_executor.execute_with_cursor('sort:random', '', 2)
+
+
+@pytest.mark.parametrize('query', [
+    'sort:edit-date', 'sort:edit-date,asc', 'sort:edit-date,desc',
+])
+def test_paging_in_same_order_as_with_offsets(post_factory, query):
+    executor = search.Executor(search.configs.PostSearchConfig())
+    posts = [post_factory(id=i) for i in range(1, 7)]
+    posts[0].last_edit_time = datetime(2016, 1, 1)
+    posts[1].last_edit_time = datetime(2016, 1, 2)
+    posts[2].last_edit_time = datetime(2016, 1, 2)
+    posts[4].last_edit_time = datetime(2016, 1, 3)
+    db.session.add_all(posts)
+    db.session.flush()
+    _count, entities = executor.execute(query, 1, 100)
+    expected_post_ids = [post.post_id for post in entities]
+    pages = _collect_forward(executor, query, 2)
+    assert [post.post_id for page in pages for post in page] \
+        == expected_post_ids
+    # and back from the last page
+    cursor = executor.execute_with_cursor(query, '', 4)[2]
+    _count, entities, _next, prev_cursor = \
+        executor.execute_with_cursor(query, cursor, 4)
+    assert [post.post_id for post in entities] == expected_post_ids[4:]
+    _count, entities, _next, prev_cursor = \
+        executor.execute_with_cursor(query, prev_cursor, 4)
+    assert [post.post_id for post in entities] == expected_post_ids[0:4]
@@ -1,29 +1,59 @@
 import unittest.mock
 import pytest
-from szurubooru import search
+from szurubooru import db, search
 from szurubooru.func import cache
 
 
 def test_retrieving_from_cache():
     config = unittest.mock.MagicMock()
-    with unittest.mock.patch('szurubooru.func.cache.has'), \
-            unittest.mock.patch('szurubooru.func.cache.get'):
-        cache.has.side_effect = lambda *args: True
+    with unittest.mock.patch('szurubooru.func.cache.get'), \
+            unittest.mock.patch('szurubooru.func.cache.put'):
+        cache.get.return_value = (5, [])
         executor = search.Executor(config)
-        executor.execute('test:whatever', 1, 10)
+        assert executor.execute('test:whatever', 1, 10) == (5, [])
         assert cache.get.called
+        assert not cache.put.called
+        assert not config.create_filter_query.called
+
+
+def test_retrieving_from_shared_cache(
+        tmpdir, post_factory, tag_factory, tag_category_factory):
+    backend = cache.SqliteBackend(
+        str(tmpdir.join('cache.sqlite')), max_size=1024 ** 2)
+    category = tag_category_factory(name='meta')
+    post = post_factory(id=1)
+    post.tags = [tag_factory(names=['tag'], category=category)]
+    db.session.add(post)
+    db.session.commit()
+    executor = search.Executor(search.configs.PostSearchConfig())
+    with unittest.mock.patch('szurubooru.func.cache._BACKEND', backend):
+        executor.execute('', 1, 10)
+        executor.execute_with_cursor('', '', 10)
+        db.session.remove()
+        with unittest.mock.patch.object(
+                executor, '_apply_filters') as apply_filters:
+            count, posts = executor.execute('', 1, 10)
+            _count, cursor_posts, _next, _prev = \
+                executor.execute_with_cursor('', '', 10)
+            assert not apply_filters.called
+    assert count == 1
+    for result in (posts, cursor_posts):
+        assert [post.post_id for post in result] == [1]
+        assert result[0] in db.session
+        assert result[0].tags[0].category.name == 'meta'
 
 
 def test_putting_equivalent_queries_into_cache():
     config = search.configs.PostSearchConfig()
-    with unittest.mock.patch('szurubooru.func.cache.has'), \
+    with unittest.mock.patch('szurubooru.func.cache.get'), \
             unittest.mock.patch('szurubooru.func.cache.put'):
         hashes = []
 
-        def appender(key, _value):
-            hashes.append(key)
+        def appender(key, _value, **_kwargs):
+            if 'count' not in key and key[0] != 'tag-id':
+                hashes.append(key)
 
-        cache.has.side_effect = lambda *args: False
+        cache.get.side_effect = KeyError
         cache.put.side_effect = appender
         executor = search.Executor(config)
         executor.execute('safety:safe test', 1, 10)
@@ -38,14 +68,15 @@ def test_putting_equivalent_queries_into_cache():
 
 def test_putting_non_equivalent_queries_into_cache():
     config = search.configs.PostSearchConfig()
-    with unittest.mock.patch('szurubooru.func.cache.has'), \
+    with unittest.mock.patch('szurubooru.func.cache.get'), \
             unittest.mock.patch('szurubooru.func.cache.put'):
         hashes = []
 
-        def appender(key, _value):
-            hashes.append(key)
+        def appender(key, _value, **_kwargs):
+            if 'count' not in key and key[0] != 'tag-id':
+                hashes.append(key)
 
-        cache.has.side_effect = lambda *args: False
+        cache.get.side_effect = KeyError
         cache.put.side_effect = appender
         executor = search.Executor(config)
         args = [
@@ -102,14 +133,15 @@ def test_putting_non_equivalent_queries_into_cache():
 ])
 def test_putting_auth_dependent_queries_into_cache(user_factory, input):
     config = search.configs.PostSearchConfig()
-    with unittest.mock.patch('szurubooru.func.cache.has'), \
+    with unittest.mock.patch('szurubooru.func.cache.get'), \
             unittest.mock.patch('szurubooru.func.cache.put'):
         hashes = []
 
-        def appender(key, _value):
-            hashes.append(key)
+        def appender(key, _value, **_kwargs):
+            if 'count' not in key and key[0] != 'tag-id':
+                hashes.append(key)
 
-        cache.has.side_effect = lambda *args: False
+        cache.get.side_effect = KeyError
         cache.put.side_effect = appender
         executor = search.Executor(config)
 
@@ -123,3 +155,56 @@ def test_putting_auth_dependent_queries_into_cache(user_factory, input):
 
         executor.execute(input, 1, 1)
         assert len(set(hashes)) == 2
+
+
+def test_putting_counts_into_cache_regardless_of_paging_and_sorting():
+    config = search.configs.PostSearchConfig()
+    with unittest.mock.patch('szurubooru.func.cache.get'), \
+            unittest.mock.patch('szurubooru.func.cache.put'):
+        hashes = []
+
+        def appender(key, _value, **_kwargs):
+            if 'count' in key:
+                hashes.append(key)
+
+        cache.get.side_effect = KeyError
+        cache.put.side_effect = appender
+        executor = search.Executor(config)
+        executor.execute('safety:safe', 1, 10)
+        executor.execute('safety:safe', 2, 10)
+        executor.execute('safety:safe', 1, 20)
+        executor.execute('safety:safe sort:id', 1, 10)
+        assert len(set(hashes)) == 1
+        executor.execute('safety:sketchy', 1, 10)
+        assert len(set(hashes)) == 2
+
+
+def test_retrieving_count_from_cache(post_factory):
+    db.session.add_all([post_factory(), post_factory()])
+    db.session.flush()
+    executor = search.Executor(search.configs.PostSearchConfig())
+    assert executor.execute('', 1, 1)[0] == 2
+    db.session.add(post_factory())
+    db.session.flush()
+    count, entities = executor.execute('', 2, 1)
+    assert count == 2
+    assert len(entities) == 1
+
+
+def test_falling_back_to_exact_count_without_estimates(post_factory):
+    db.session.add_all([post_factory(), post_factory()])
+    db.session.flush()
+    executor = search.Executor(search.configs.PostSearchConfig())
+    assert executor.execute('', 1, 1, estimate_count=True)[0] == 2
+
+
+def test_getting_ids(post_factory):
+    db.session.add_all([
+        post_factory(id=3, safety=db.Post.SAFETY_SAFE),
+        post_factory(id=1, safety=db.Post.SAFETY_SAFE),
+        post_factory(id=2, safety=db.Post.SAFETY_UNSAFE),
+    ])
+    db.session.flush()
+    executor = search.Executor(search.configs.PostSearchConfig())
+    assert executor.get_ids('') == [1, 2, 3]
+    assert executor.get_ids('safety:safe sort:random') == [1, 3]